@@ -0,0 +1,162 @@
+"""Failover simulation for the sync lease.
+
+Runs several simulated replicas against an in-memory MongoDB on a simulated clock. Every replica renews the lease
+on its own schedule and, while it holds the lease, writes a fenced worksheet snapshot. The leader crashes, then the
+next leader stalls in the middle of a write (e.g. a long GC pause) and finishes it after losing the lease.
+The simulation reports how long the job had no owner, whether two replicas ever held the lease at once, and
+whether the stale write was rejected.
+
+Usage:
+    python -m bench.failover [--replicas 3] [--ttl 15] [--duration 180]
+"""
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+from bot.lease import Lease, fenced
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+TICK_SECONDS = 0.5
+SNAPSHOT_QUERY = {"spreadsheet": "bench", "worksheet": "period"}
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __call__(self) -> datetime:
+        return START + timedelta(seconds=self.elapsed)
+
+
+class Replica:
+    def __init__(self, index: int, collection, clock: SimulatedClock, ttl: float, renew_interval: float):
+        self.name = f"replica-{index}"
+        self.lease = Lease(collection, "spreadsheet_sync", self.name, ttl, clock)
+        self.renew_interval = renew_interval
+        # Replicas start at different moments, so their renewals don't line up
+        self.next_renewal = index * renew_interval / 3
+        self.crashed = False
+        self.paused_until = None
+        self.pending_token = None
+
+    def is_running(self, now: float) -> bool:
+        return not self.crashed and (self.paused_until is None or now >= self.paused_until)
+
+
+def write_snapshot(snapshots, token: int, writer: str) -> bool:
+    try:
+        snapshots.update_one(
+            fenced(SNAPSHOT_QUERY, token), {"$set": {"fencing_token": token, "writer": writer}}, upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def simulate(replica_count: int, ttl: float, duration: float) -> dict:
+    database = mongomock.MongoClient()["padel_bot"]
+    snapshots = database["worksheet_snapshots"]
+    snapshots.create_index([("spreadsheet", pymongo.ASCENDING), ("worksheet", pymongo.ASCENDING)], unique=True)
+    clock = SimulatedClock()
+    renew_interval = ttl / 3
+    replicas = [Replica(idx, database["leases"], clock, ttl, renew_interval) for idx in range(replica_count)]
+
+    crash_at = duration / 6
+    pause_at = duration / 2
+    pause_seconds = ttl * 2
+    crashed_leader = paused_leader = None
+    ownerless_since = 0.0
+    ownerless_periods = []
+    max_holders = 0
+    tokens = []
+    stale_write = None
+
+    while clock.elapsed < duration:
+        now = clock.elapsed
+        for replica in replicas:
+            if replica.paused_until is not None and now >= replica.paused_until:
+                # The stalled write completes with the token taken before the pause
+                stale_write = write_snapshot(snapshots, replica.pending_token, replica.name)
+                replica.paused_until = replica.pending_token = None
+            if not replica.is_running(now):
+                continue
+            if now >= replica.next_renewal:
+                replica.lease.acquire()
+                replica.next_renewal = now + renew_interval
+
+        holders = [replica for replica in replicas if replica.is_running(now) and replica.lease.held]
+        max_holders = max(max_holders, len(holders))
+        for replica in holders:
+            token = replica.lease.check()
+            if not tokens or tokens[-1] != token:
+                tokens.append(token)
+            write_snapshot(snapshots, token, replica.name)
+
+        if holders and ownerless_since is not None:
+            ownerless_periods.append(now - ownerless_since)
+            ownerless_since = None
+        elif not holders and ownerless_since is None:
+            ownerless_since = now
+
+        if crashed_leader is None and now >= crash_at and holders:
+            crashed_leader = holders[0]
+            crashed_leader.crashed = True
+        if paused_leader is None and now >= pause_at and holders and holders[0] is not crashed_leader:
+            paused_leader = holders[0]
+            paused_leader.pending_token = paused_leader.lease.check()
+            paused_leader.paused_until = now + pause_seconds
+        clock.elapsed += TICK_SECONDS
+
+    failovers = ownerless_periods[1:]
+    return {
+        "replicas": replica_count,
+        "ttl_s": ttl,
+        "renew_interval_s": round(renew_interval, 3),
+        "failovers": len(failovers),
+        "max_failover_s": max(failovers, default=0.0),
+        "max_concurrent_holders": max_holders,
+        "tokens_increasing": tokens == sorted(tokens),
+        "stale_write_rejected": stale_write is False,
+        "last_snapshot_writer": snapshots.find_one(SNAPSHOT_QUERY)["writer"],
+    }
+
+
+def find_violations(result: dict) -> list:
+    violations = []
+    if result["max_concurrent_holders"] > 1:
+        violations.append(f"{result['max_concurrent_holders']} replicas held the lease at once")
+    if result["max_failover_s"] > result["ttl_s"] + result["renew_interval_s"] + TICK_SECONDS:
+        violations.append(f"failover took {result['max_failover_s']}s")
+    if not result["tokens_increasing"]:
+        violations.append("fencing tokens went backwards")
+    if not result["stale_write_rejected"]:
+        violations.append("the write of the stalled replica was accepted")
+    return violations
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Simulate replica crashes against the sync lease")
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--ttl", type=float, default=15.0, help="Lease TTL in seconds")
+    parser.add_argument("--duration", type=float, default=180.0, help="Simulated seconds")
+    args = parser.parse_args()
+    if args.replicas < 3:
+        parser.error("at least 3 replicas are needed, one crashes and one stalls while another takes over")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = simulate(args.replicas, args.ttl, args.duration)
+    print(json.dumps(result, indent=2))
+    violations = find_violations(result)
+    for violation in violations:
+        print(f"VIOLATION {violation}")
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,193 @@
+"""Offline stand-ins for Telegram, MongoDB and the roster storage used by the benchmarks."""
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Optional, Tuple
+
+import mongomock
+import mongomock.aggregate
+from telegram.request import BaseRequest, RequestData
+
+import main
+from bot.backends import InMemoryBackend, register_backend
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally and records every outgoing request."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = []
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        self.requests.append((api_method, parameters))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, parameters)}).encode()
+
+    def _result(self, api_method: str, parameters: dict):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method == "getChatMember":
+            return {"status": "administrator", "user": {"id": parameters.get("user_id"), "is_bot": False, "first_name": "A"},
+                    "can_be_edited": False, "can_manage_chat": True, "can_change_info": True,
+                    "can_delete_messages": True, "can_invite_users": True, "can_restrict_members": True,
+                    "can_pin_messages": True, "can_promote_members": False, "can_manage_video_chats": True,
+                    "is_anonymous": False, "can_post_stories": False, "can_edit_stories": False,
+                    "can_delete_stories": False}
+        if api_method.startswith("send"):
+            self._message_id += 1
+            return {"message_id": self._message_id, "date": int(time.time()),
+                    "chat": {"id": parameters.get("chat_id", 0), "type": "private"}, "from": BOT_USER,
+                    "text": parameters.get("text", "")}
+        if api_method.startswith("edit") and "message_id" in parameters:
+            # Edits of chat messages return the edited message, only inline message edits return True
+            return {"message_id": parameters["message_id"], "date": int(time.time()),
+                    "chat": {"id": parameters.get("chat_id", 0), "type": "private"}, "from": BOT_USER,
+                    "text": parameters.get("text", "")}
+        return True
+
+    def sent_texts(self) -> list:
+        return [parameters.get("text") for method, parameters in self.requests if method == "sendMessage"]
+
+
+class CallCounter:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+
+    def record(self, name: str):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class CountingCollection:
+    """Proxies a collection, counting every operation as one round trip."""
+
+    def __init__(self, collection, counter: CallCounter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self._counter.record(f"{self._collection.name}.{name}")
+            return attribute(*args, **kwargs)
+
+        return call
+
+    def aggregate(self, pipeline: list, **kwargs):
+        # MongoDB serves a leading $match from an index, mongomock would copy the whole collection first
+        self._counter.record(f"{self._collection.name}.aggregate")
+        if pipeline and "$match" in pipeline[0]:
+            documents = list(self._collection.find(pipeline[0]["$match"]))
+            return mongomock.aggregate.process_pipeline(documents, self._collection.database, pipeline[1:], None)
+        return self._collection.aggregate(pipeline, **kwargs)
+
+
+class CountingDatabase:
+    def __init__(self, database, counter: CallCounter):
+        self._database = database
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name], self._counter)
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def install_database(db_latency: float = 0.0) -> Tuple[mongomock.Database, CallCounter]:
+    """Points the bot module at a fresh in-memory database.
+
+    Returns:
+        tuple: The raw database for seeding and the counter of round trips made through the bot.
+    """
+    raw_db = mongomock.MongoClient()["padel_bot"]
+    counter = CallCounter(db_latency)
+    counting_db = CountingDatabase(raw_db, counter)
+    main.db = counting_db
+    for attribute, value in list(vars(main).items()):
+        if attribute.endswith("_collection") and hasattr(value, "name"):
+            setattr(main, attribute, counting_db[value.name])
+    return raw_db, counter
+
+
+API_METHODS = (
+    "is_writable", "create_worksheet", "duplicate_worksheet", "has_worksheet", "ensure_size",
+    "read_grid", "write_range", "batch_update", "get_last_update_time",
+)
+
+
+class RecordingBackend(InMemoryBackend):
+    """In-memory storage counting calls like a remote API would see them."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        super().__init__(latency, error_rate, seed)
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+        self._in_call = False
+
+    def reset_stats(self):
+        self.calls.clear()
+        self.uploaded_bytes = 0
+
+
+def _recorded(method_name: str):
+    method = getattr(InMemoryBackend, method_name)
+
+    def call(self, *args, **kwargs):
+        if self._in_call:
+            # Backend methods calling each other are still a single API call
+            return method(self, *args, **kwargs)
+        self.calls[method_name] += 1
+        if method_name == "write_range":
+            self.uploaded_bytes += len(json.dumps(args[3]))
+        elif method_name == "batch_update":
+            self.uploaded_bytes += len(json.dumps(args[2]))
+        self._in_call = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._in_call = False
+
+    call.__name__ = method_name
+    return call
+
+
+for _method_name in API_METHODS:
+    setattr(RecordingBackend, _method_name, _recorded(_method_name))
+
+
+def install_backend(latency: float = 0.0, error_rate: float = 0.0) -> RecordingBackend:
+    """Registers a recording in-memory backend for groups with the memory storage."""
+    backend = RecordingBackend(latency, error_rate, seed=1)
+    register_backend(backend)
+    return backend
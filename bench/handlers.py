@@ -0,0 +1,278 @@
+"""End-to-end load test for the bot handlers.
+
+Builds the real application from main.build_application() on top of a recording fake Bot API transport,
+an in-memory MongoDB and an in-memory roster storage, replays synthetic traffic through the handlers and
+reports handler latency percentiles, throughput and backend calls per update.
+
+Usage:
+    python -m bench.handlers [--scenario registration_rush] [--players 500] [--courts 12]
+    python -m bench.handlers --save-baseline    # store the results as the new baseline
+    python -m bench.handlers --intake --db-latency-ms 2    # registrations through the batched intake
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+from telegram import Update
+
+import main
+from bot.metrics import DUPLICATE_UPDATES
+from bench.fakes import FakeTelegramRequest, install_backend, install_database
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+ADMIN_ID = 100
+GROUP_CHAT_ID = -1000
+FIRST_PLAYER_ID = 10_000
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_id = 0
+
+    def command(self, text: str, user_id: int, chat_id: int, chat_type: str = "group") -> dict:
+        self._update_id += 1
+        command = text.split()[0]
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": chat_type, "title": "Bench group"} if chat_type != "private"
+                else {"id": chat_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        }
+
+    def private_command(self, text: str, user_id: int) -> dict:
+        return self.command(text, user_id, user_id, "private")
+
+
+def next_game_date(game_day: int, now: datetime) -> datetime:
+    date = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    while date.weekday() != game_day:
+        date += timedelta(days=1)
+    return date
+
+
+def seed_group(db, courts: int, players: int, now: datetime) -> dict:
+    """Creates an admin, a group whose registration period is about to end and active members."""
+    game_day = now.weekday()
+    group = {
+        "group_id": str(GROUP_CHAT_ID),
+        "name": "Bench",
+        "spreadsheet": "bench",
+        "storage": "memory",
+        "court_limit": courts,
+        "week_range": 2,
+        "admin_id": ADMIN_ID,
+        "deleted_at": None,
+        "created_at": now,
+        "registration_open_till": now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1),
+        "game_day": game_day,
+        "sheet_layout": main.SHEET_LAYOUT_COMPACT,
+    }
+    db.admins.insert_one({"admin_id": ADMIN_ID, "username": "admin", "first_name": "Ad", "last_name": "Min",
+                          "groups": [group["group_id"]], "created_at": now})
+    db.groups.insert_one(group)
+    for player_id in range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + players):
+        db.members.insert_one({
+            "registration_name": f"Name{player_id}", "registration_surname": "Bench",
+            "registration_phone_number": "+10000000000", "registration_email": None,
+            "user_id": player_id, "messenger_first_name": f"User{player_id}", "messenger_last_name": None,
+            "messenger_username": f"user{player_id}", "created_at": now,
+            "groups": [{"group_id": group["group_id"], "status": "active", "blocked_till": None, "joined_at": now}],
+        })
+    return group
+
+
+def registration_spike(db, factory: UpdateFactory, players: int, courts: int) -> List[dict]:
+    """Registration opened and all players race for the courts of the first game date."""
+    now = datetime.now(timezone.utc)
+    group = seed_group(db, courts, players, now)
+    game_date = next_game_date(group["game_day"], group["registration_open_till"])
+    date_arg = game_date.strftime("%d.%m.%Y")
+    updates = [factory.private_command(f"/open_match_registration {group['group_id']}", ADMIN_ID)]
+    player_ids = list(range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + players))
+    updates += [factory.command(f"/register_game {date_arg}", player_id, GROUP_CHAT_ID) for player_id in player_ids]
+    return updates
+
+
+def registration_rush(db, factory: UpdateFactory, players: int, courts: int) -> List[dict]:
+    """The registration spike followed by a tenth of the players checking their matches and canceling."""
+    updates = registration_spike(db, factory, players, courts)
+    date_arg = updates[-1]["message"]["text"].split()[1]
+    player_ids = list(range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + players))
+    updates += [factory.private_command("/list_matches", player_id) for player_id in player_ids[::10]]
+    updates += [factory.command(f"/cancel_game {date_arg}", player_id, GROUP_CHAT_ID) for player_id in player_ids[::10]]
+    return updates
+
+
+def redelivery(db, factory: UpdateFactory, players: int, courts: int) -> List[dict]:
+    """The registration rush with every fifth update delivered twice and a tenth already handled by another instance."""
+    updates = registration_rush(db, factory, players, courts)
+    delivered = []
+    for idx, update in enumerate(updates):
+        delivered.append(update)
+        if idx % 5 == 1:
+            delivered.append(update)
+    for update in updates[5::10]:
+        db.processed_updates.insert_one({"_id": update["update_id"], "claimed_at": datetime.now(timezone.utc)})
+    return delivered
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "registration_spike": registration_spike,
+    "registration_rush": registration_rush,
+    "redelivery": redelivery,
+}
+
+
+def count_duplicate_matches(db) -> int:
+    """Returns the number of extra registrations of a player for the same match."""
+    duplicates = db.matches.aggregate([
+        {"$group": {"_id": {"group_id": "$group_id", "match_date": "$match_date", "user_id": "$user_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    return sum(duplicate["count"] - 1 for duplicate in duplicates)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def replay(scenario: str, players: int, courts: int, concurrency: int, db_latency: float,
+                 sheets_latency: float, intake: bool = False, telegram_latency: float = 0.0) -> dict:
+    db, db_counter = install_database(db_latency)
+    main.registration_intake.enabled = intake
+    backend = install_backend(sheets_latency)
+    request = FakeTelegramRequest(telegram_latency)
+    factory = UpdateFactory()
+    raw_updates = SCENARIOS[scenario](db, factory, players, courts)
+
+    app = main.build_application("123456:BENCH", request, concurrent_updates=1)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(update: Update):
+        async with semaphore:
+            started = time.perf_counter()
+            await app.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    async with app:
+        # Started, so tasks the handlers spawn (e.g. notifications) are tracked and awaited on stop
+        await app.start()
+        updates = [Update.de_json(raw_update, app.bot) for raw_update in raw_updates]
+        request.calls.clear()
+        started = time.perf_counter()
+        # The first update sets the scenario up (e.g. opens registration), the burst follows it
+        await process(updates[0])
+        await asyncio.gather(*(process(update) for update in updates[1:]))
+        # Queued registrations count as done once stored and confirmed
+        await main.registration_intake.drain()
+        duration = time.perf_counter() - started
+        await app.stop()
+
+    update_count = len(updates)
+    return {
+        "scenario": scenario,
+        "players": players,
+        "courts": courts,
+        "concurrency": concurrency,
+        "intake": intake,
+        "updates": update_count,
+        "duration_s": round(duration, 4),
+        "updates_per_s": round(update_count / duration, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+        "db_calls_per_update": round(db_counter.total() / update_count, 3),
+        "telegram_calls_per_update": round(sum(request.calls.values()) / update_count, 3),
+        "sheets_calls_per_update": round(sum(backend.calls.values()) / update_count, 3),
+        "db_calls": dict(sorted(db_counter.calls.items())),
+        "telegram_calls": dict(sorted(request.calls.items())),
+        "registered_matches": db.matches.count_documents({}),
+        "duplicate_matches": count_duplicate_matches(db),
+        "skipped_updates": {source: DUPLICATE_UPDATES.get(source) for source in ("memory", "mongo")},
+    }
+
+
+def compare_with_baseline(result: dict, baseline: dict, latency_tolerance: float) -> List[str]:
+    """Returns descriptions of the metrics that regressed against the baseline."""
+    regressions = []
+    if result["duplicate_matches"]:
+        regressions.append(f"duplicate_matches: {result['duplicate_matches']}")
+    for key in ("db_calls_per_update", "telegram_calls_per_update", "sheets_calls_per_update"):
+        if result[key] > baseline[key]:
+            regressions.append(f"{key}: {baseline[key]} -> {result[key]}")
+    for key in ("p95", "p99"):
+        allowed = baseline["latency_ms"][key] * (1 + latency_tolerance)
+        if result["latency_ms"][key] > allowed:
+            regressions.append(f"latency {key}: {baseline['latency_ms'][key]}ms -> {result['latency_ms'][key]}ms")
+    return regressions
+
+
+def baseline_path(result: dict) -> str:
+    return os.path.join(
+        BASELINE_DIR,
+        f"handlers_{result['scenario']}_{result['players']}x{result['courts']}_c{result['concurrency']}"
+        + ("_intake" if result.get("intake") else "") + ".json"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Replay synthetic traffic through the bot handlers")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="registration_rush")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--courts", type=int, default=12)
+    parser.add_argument("--concurrency", type=int, default=1, help="Updates processed at the same time")
+    parser.add_argument("--intake", action="store_true", help="Queue registrations and store them in batches")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="Simulated MongoDB round trip time")
+    parser.add_argument("--telegram-latency-ms", type=float, default=0.0, help="Simulated Bot API call time")
+    parser.add_argument("--sheets-latency-ms", type=float, default=0.0, help="Simulated Sheets API call time")
+    parser.add_argument("--latency-tolerance", type=float, default=0.5,
+                        help="Allowed relative p95/p99 latency growth against the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = asyncio.run(replay(
+        args.scenario, args.players, args.courts, args.concurrency, args.db_latency_ms / 1000,
+        args.sheets_latency_ms / 1000, args.intake, args.telegram_latency_ms / 1000
+    ))
+    print(json.dumps(result, indent=2))
+
+    path = baseline_path(result)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(result, file, indent=2)
+        print(f"Baseline saved to {path}")
+        return 0
+    if not os.path.exists(path):
+        print("No baseline found, use --save-baseline to create one.")
+        return 0
+    with open(path) as file:
+        regressions = compare_with_baseline(result, json.load(file), args.latency_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,46 @@
+"""Startup time benchmark for the bot and CLI entry points.
+
+Every mode runs in a fresh interpreter several times and the median wall time is reported.
+
+Usage:
+    python -m bench.startup [--runs 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    "import": ["-c", "import main"],
+    "bot": ["-c", "import main; main.build_application('123456:STARTUP')"],
+    "cli": ["main.py", "--help"],
+}
+
+
+def measure(arguments: list, runs: int) -> list:
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *arguments], cwd=ROOT, check=True, capture_output=True)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Measure interpreter startup time of the bot entry points")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} | {'median_ms':>9} | {'min_ms':>7} | {'max_ms':>7}")
+    for mode, arguments in MODES.items():
+        durations = measure(arguments, args.runs)
+        print(f"{mode:>8} | {statistics.median(durations) * 1000:9.1f} | "
+              f"{min(durations) * 1000:7.1f} | {max(durations) * 1000:7.1f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,148 @@
+"""Scaling benchmark for the spreadsheet synchronization.
+
+Seeds N groups x M match dates x K players into an in-memory MongoDB, runs sync_spreadsheet against the recording
+in-memory roster storage and reports wall time, Mongo round trips, Sheets reads and writes and uploaded bytes.
+Every size is synced three times: "cold" without shadow copies, "warm" without changes and "incremental"
+after one new registration per group.
+
+Usage:
+    python -m bench.sync [--groups 1 10] [--dates 2 4] [--players 8 48] [--json]
+"""
+import argparse
+import itertools
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import main
+from bench.fakes import install_backend, install_database
+
+READ_METHODS = ("has_worksheet", "read_grid")
+WRITE_METHODS = ("write_range", "batch_update")
+METADATA_METHODS = ("get_last_update_time",)
+
+
+def seed(db, backend, group_count: int, date_count: int, player_count: int) -> list:
+    """Creates groups with their period worksheets and registrations. Returns raw group documents."""
+    now = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    week_range = date_count
+    groups = []
+    for group_idx in range(group_count):
+        game_day = group_idx % 7
+        group = {
+            "group_id": str(-1000 - group_idx),
+            "name": f"Group {group_idx}",
+            "spreadsheet": f"spreadsheet-{group_idx}",
+            "storage": "memory",
+            "court_limit": max(1, player_count // 4),
+            "week_range": week_range,
+            "admin_id": 1,
+            "deleted_at": None,
+            "created_at": now,
+            "registration_open_till": now + timedelta(weeks=week_range),
+            "game_day": game_day,
+        }
+        db.groups.insert_one(group)
+        start_period = now
+        main.create_period_worksheet(group, main.generate_worksheet_name_from_group(group), start_period, week_range * 7)
+        game_dates = main.generate_worksheet_dates(week_range * 7, game_day, start_period, main.SHEET_LAYOUT_COMPACT)
+        game_dates = [date for date in game_dates if date > now][:date_count]
+        for date_idx, match_date in enumerate(game_dates):
+            for player_idx in range(player_count):
+                user_id = group_idx * 100_000 + player_idx
+                if date_idx == 0:
+                    db.members.insert_one({
+                        "user_id": user_id,
+                        "registration_name": f"Name{player_idx}",
+                        "registration_surname": f"Group{group_idx}",
+                    })
+                db.matches.insert_one({
+                    "user_id": user_id,
+                    "group_id": group["group_id"],
+                    "match_date": match_date,
+                    "registered_at": now + timedelta(seconds=player_idx),
+                })
+        groups.append({**group, "game_dates": game_dates})
+    backend.reset_stats()
+    return groups
+
+
+def add_registration_per_group(db, groups: list):
+    for group in groups:
+        user_id = -int(group["group_id"]) * 1000
+        db.members.insert_one({"user_id": user_id, "registration_name": "Late", "registration_surname": "Player"})
+        db.matches.insert_one({
+            "user_id": user_id,
+            "group_id": group["group_id"],
+            "match_date": group["game_dates"][0],
+            "registered_at": datetime.now(timezone.utc),
+        })
+
+
+def measure_sync(db_counter, backend) -> dict:
+    db_counter.calls.clear()
+    backend.reset_stats()
+    started = time.perf_counter()
+    main.sync_spreadsheet()
+    duration = time.perf_counter() - started
+    return {
+        "wall_time_ms": round(duration * 1000, 2),
+        "mongo_round_trips": db_counter.total(),
+        "sheets_metadata": sum(backend.calls[method] for method in METADATA_METHODS),
+        "sheets_reads": sum(backend.calls[method] for method in READ_METHODS),
+        "sheets_writes": sum(backend.calls[method] for method in WRITE_METHODS),
+        "uploaded_bytes": backend.uploaded_bytes,
+    }
+
+
+def run_size(group_count: int, date_count: int, player_count: int, sheets_latency: float) -> list:
+    db, db_counter = install_database()
+    backend = install_backend(sheets_latency)
+    groups = seed(db, backend, group_count, date_count, player_count)
+
+    rows = []
+    for phase in ("cold", "warm", "incremental"):
+        if phase == "incremental":
+            add_registration_per_group(db, groups)
+        rows.append({
+            "groups": group_count,
+            "dates": date_count,
+            "players": player_count,
+            "phase": phase,
+            **measure_sync(db_counter, backend),
+        })
+    return rows
+
+
+def print_table(rows: list):
+    columns = list(rows[0].keys())
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print(" | ".join(column.rjust(widths[column]) for column in columns))
+    print("-|-".join("-" * widths[column] for column in columns))
+    for row in rows:
+        print(" | ".join(str(row[column]).rjust(widths[column]) for column in columns))
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Measure sync_spreadsheet cost versus data size")
+    parser.add_argument("--groups", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--dates", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--players", type=int, nargs="+", default=[8, 48])
+    parser.add_argument("--sheets-latency-ms", type=float, default=0.0, help="Simulated Sheets API call time")
+    parser.add_argument("--json", action="store_true", help="Print rows as JSON instead of a table")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rows = []
+    for group_count, date_count, player_count in itertools.product(args.groups, args.dates, args.players):
+        rows += run_size(group_count, date_count, player_count, args.sheets_latency_ms / 1000)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    run()
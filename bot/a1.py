@@ -0,0 +1,40 @@
+"""A1 notation helpers.
+
+Kept separate from gspread.utils, which would import the whole gspread and google-auth stack.
+"""
+import re
+
+A1_CELL = re.compile(r"^([A-Za-z]*)(\d*)$")
+
+
+def column_letter(col: int) -> str:
+    """Converts a 1-based column index to letters, e.g. 1 -> A, 28 -> AB."""
+    letters = ""
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def rowcol_to_a1(row: int, col: int) -> str:
+    """Converts 1-based row and column indexes to a cell label, e.g. (2, 28) -> AB2."""
+    return f"{column_letter(col)}{row}"
+
+
+def column_index(letters: str) -> int:
+    """Converts column letters to a 1-based index, e.g. AB -> 28."""
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - 64
+    return index
+
+
+def a1_range_start(range_name: str) -> tuple:
+    """Returns 0-based (row, column) of the top left cell of a range like "C1:D20" or "B2"."""
+    match = A1_CELL.match(range_name.split("!")[-1].split(":")[0])
+    if not match:
+        raise ValueError(f"Invalid A1 range: {range_name}")
+    letters, digits = match.groups()
+    row = int(digits) - 1 if digits else 0
+    col = column_index(letters) - 1 if letters else 0
+    return row, col
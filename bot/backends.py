@@ -0,0 +1,342 @@
+"""Roster storage backends.
+
+Worksheet creation and sync logic only talk to RosterBackend, so the storage can be picked per group:
+Google Sheets (default), local CSV or XLSX files, or memory for offline runs and benchmarks.
+A worksheet is addressed by a location (spreadsheet URL, file directory, ...) and a worksheet name.
+"""
+import csv
+import os
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.a1 import a1_range_start
+
+STORAGE_GOOGLE = "google"
+STORAGE_CSV = "csv"
+STORAGE_XLSX = "xlsx"
+STORAGE_MEMORY = "memory"
+FILE_STORAGES = (STORAGE_CSV, STORAGE_XLSX)
+
+
+class RosterBackendError(Exception):
+    pass
+
+
+class RosterBackend(ABC):
+    name: str
+
+    @abstractmethod
+    def is_writable(self, location: str) -> bool:
+        pass
+
+    @abstractmethod
+    def create_worksheet(self, location: str, name: str, rows: int, cols: int) -> str:
+        """Creates an empty worksheet and returns the link to it."""
+
+    @abstractmethod
+    def duplicate_worksheet(self, location: str, template_name: str, name: str) -> str:
+        """Creates a worksheet as a copy of the template worksheet and returns the link to it."""
+
+    @abstractmethod
+    def has_worksheet(self, location: str, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def ensure_size(self, location: str, name: str, row_count: int, col_count: int) -> Tuple[int, int]:
+        """Grows the worksheet to at least row_count rows and col_count columns, returns its row and column count."""
+
+    @abstractmethod
+    def read_grid(self, location: str, name: str) -> List[List[str]]:
+        pass
+
+    @abstractmethod
+    def write_range(self, location: str, name: str, range_name: str, values: List[List[Any]]):
+        pass
+
+    @abstractmethod
+    def batch_update(self, location: str, name: str, ranges: List[dict]):
+        """Writes several ranges at once. Items are in the {"range": "A1:B2", "values": [[...]]} format."""
+
+    @abstractmethod
+    def get_last_update_time(self, location: str) -> str:
+        """Returns a cheap marker that changes whenever anything in the location is modified."""
+
+
+def _google():
+    # gspread and google-auth are heavy, they are loaded once a Google group needs them
+    from bot import spreadsheet
+    return spreadsheet
+
+
+class GoogleSheetsBackend(RosterBackend):
+    name = STORAGE_GOOGLE
+
+    def is_writable(self, location: str) -> bool:
+        return _google().is_spreadsheet_writable(location)
+
+    def create_worksheet(self, location: str, name: str, rows: int, cols: int) -> str:
+        return _google().create_worksheet(location, name, rows, cols).url
+
+    def duplicate_worksheet(self, location: str, template_name: str, name: str) -> str:
+        return _google().duplicate_worksheet(location, template_name, name).url
+
+    def has_worksheet(self, location: str, name: str) -> bool:
+        return _google().has_worksheet_with_name(location, name)
+
+    def ensure_size(self, location: str, name: str, row_count: int, col_count: int) -> Tuple[int, int]:
+        return _google().ensure_worksheet_size(location, name, row_count, col_count)
+
+    def read_grid(self, location: str, name: str) -> List[List[str]]:
+        return _google().fetch_all_data_from_worksheet(location, name)
+
+    def write_range(self, location: str, name: str, range_name: str, values: List[List[Any]]):
+        _google().write_worksheet_range(location, name, range_name, values)
+
+    def batch_update(self, location: str, name: str, ranges: List[dict]):
+        _google().update_worksheet_ranges(location, name, ranges)
+
+    def get_last_update_time(self, location: str) -> str:
+        return _google().get_last_update_time(location)
+
+
+class GridBackend(RosterBackend, ABC):
+    """Base for backends that keep worksheets as plain 2D lists and apply A1 ranges themselves."""
+
+    @abstractmethod
+    def _load(self, location: str, name: str) -> Optional[List[List[str]]]:
+        """Returns the worksheet grid or None if it does not exist."""
+
+    @abstractmethod
+    def _save(self, location: str, name: str, grid: List[List[str]]):
+        pass
+
+    def is_writable(self, location: str) -> bool:
+        return True
+
+    def create_worksheet(self, location: str, name: str, rows: int, cols: int) -> str:
+        if self._load(location, name) is not None:
+            raise RosterBackendError(f"Worksheet '{name}' already exists.")
+        self._save(location, name, [["" for _ in range(cols)] for _ in range(rows)])
+        return self.get_link(location, name)
+
+    def duplicate_worksheet(self, location: str, template_name: str, name: str) -> str:
+        template = self._load(location, template_name)
+        if template is None:
+            raise RosterBackendError(f"Worksheet '{template_name}' not found.")
+        self._save(location, name, [row[:] for row in template])
+        return self.get_link(location, name)
+
+    def has_worksheet(self, location: str, name: str) -> bool:
+        return self._load(location, name) is not None
+
+    def ensure_size(self, location: str, name: str, row_count: int, col_count: int) -> Tuple[int, int]:
+        grid = self._get_existing(location, name)
+        width = max([col_count] + [len(row) for row in grid])
+        for row in grid:
+            row.extend([""] * (width - len(row)))
+        grid.extend([""] * width for _ in range(row_count - len(grid)))
+        self._save(location, name, grid)
+        return len(grid), width
+
+    def read_grid(self, location: str, name: str) -> List[List[str]]:
+        return trim_grid(self._get_existing(location, name))
+
+    def write_range(self, location: str, name: str, range_name: str, values: List[List[Any]]):
+        self.batch_update(location, name, [{"range": range_name, "values": values}])
+
+    def batch_update(self, location: str, name: str, ranges: List[dict]):
+        grid = self._get_existing(location, name)
+        for item in ranges:
+            apply_range(grid, item["range"], item["values"])
+        self._save(location, name, grid)
+
+    def get_link(self, location: str, name: str) -> str:
+        return f"{self.name}://{location}/{name}"
+
+    def _get_existing(self, location: str, name: str) -> List[List[str]]:
+        grid = self._load(location, name)
+        if grid is None:
+            raise RosterBackendError(f"Worksheet '{name}' not found.")
+        return grid
+
+
+class InMemoryBackend(GridBackend):
+    """Keeps worksheets in memory. Can slow down and fail calls to imitate a remote API.
+
+    Args:
+        latency (float): Seconds every call sleeps before doing its work.
+        error_rate (float): Probability of a call raising RosterBackendError.
+        seed (int): Seed for error injection to make runs reproducible.
+    """
+    name = STORAGE_MEMORY
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.worksheets: Dict[Tuple[str, str], List[List[str]]] = {}
+        self.updated_at: Dict[str, int] = {}
+        self._random = random.Random(seed)
+
+    def _load(self, location: str, name: str) -> Optional[List[List[str]]]:
+        self._simulate_call()
+        grid = self.worksheets.get((location, name))
+        return None if grid is None else [row[:] for row in grid]
+
+    def _save(self, location: str, name: str, grid: List[List[str]]):
+        self._simulate_call()
+        self.worksheets[(location, name)] = [[str(cell) for cell in row] for row in grid]
+        self.updated_at[location] = self.updated_at.get(location, 0) + 1
+
+    def get_last_update_time(self, location: str) -> str:
+        self._simulate_call()
+        return str(self.updated_at.get(location, 0))
+
+    def _simulate_call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise RosterBackendError("Injected backend error.")
+
+
+class CsvFileBackend(GridBackend):
+    """Stores every worksheet as <base_dir>/<location>/<worksheet name>.csv"""
+    name = STORAGE_CSV
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+
+    def _path(self, location: str, name: str = "") -> str:
+        path = os.path.join(self.base_dir, safe_file_name(location))
+        return os.path.join(path, safe_file_name(name) + ".csv") if name else path
+
+    def _load(self, location: str, name: str) -> Optional[List[List[str]]]:
+        path = self._path(location, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, newline="", encoding="utf-8") as file:
+            return [row for row in csv.reader(file)]
+
+    def _save(self, location: str, name: str, grid: List[List[str]]):
+        os.makedirs(self._path(location), exist_ok=True)
+        with open(self._path(location, name), "w", newline="", encoding="utf-8") as file:
+            csv.writer(file).writerows(grid)
+
+    def get_last_update_time(self, location: str) -> str:
+        path = self._path(location)
+        if not os.path.isdir(path):
+            return "0"
+        with os.scandir(path) as entries:
+            return str(max((entry.stat().st_mtime_ns for entry in entries), default=0))
+
+    def get_link(self, location: str, name: str) -> str:
+        return os.path.abspath(self._path(location, name))
+
+
+class XlsxFileBackend(GridBackend):
+    """Stores every location as <base_dir>/<location>.xlsx workbook with a sheet per worksheet.
+
+    Requires the optional openpyxl package.
+    """
+    name = STORAGE_XLSX
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+
+    def _path(self, location: str) -> str:
+        return os.path.join(self.base_dir, safe_file_name(location) + ".xlsx")
+
+    def _open_workbook(self, location: str):
+        try:
+            import openpyxl
+        except ImportError as ex:
+            raise RosterBackendError("XLSX storage requires the openpyxl package.") from ex
+        path = self._path(location)
+        if os.path.exists(path):
+            return openpyxl.load_workbook(path)
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        return workbook
+
+    def _load(self, location: str, name: str) -> Optional[List[List[str]]]:
+        if not os.path.exists(self._path(location)):
+            return None
+        workbook = self._open_workbook(location)
+        if name not in workbook.sheetnames:
+            return None
+        return [
+            ["" if cell is None else str(cell) for cell in row]
+            for row in workbook[name].iter_rows(values_only=True)
+        ]
+
+    def _save(self, location: str, name: str, grid: List[List[str]]):
+        workbook = self._open_workbook(location)
+        if name in workbook.sheetnames:
+            workbook.remove(workbook[name])
+        sheet = workbook.create_sheet(name)
+        for row in grid:
+            sheet.append(row)
+        os.makedirs(self.base_dir, exist_ok=True)
+        workbook.save(self._path(location))
+
+    def get_last_update_time(self, location: str) -> str:
+        path = self._path(location)
+        return str(os.stat(path).st_mtime_ns) if os.path.exists(path) else "0"
+
+    def get_link(self, location: str, name: str) -> str:
+        return os.path.abspath(self._path(location))
+
+
+def apply_range(grid: List[List[str]], range_name: str, values: List[List[Any]]):
+    """Writes values into the grid at the given A1 range, growing the grid when needed."""
+    start_row, start_col = a1_range_start(range_name)
+    for row_offset, row_values in enumerate(values):
+        row_idx = start_row + row_offset
+        while len(grid) <= row_idx:
+            grid.append([])
+        row = grid[row_idx]
+        for col_offset, value in enumerate(row_values):
+            col_idx = start_col + col_offset
+            if len(row) <= col_idx:
+                row.extend([""] * (col_idx + 1 - len(row)))
+            row[col_idx] = "" if value is None else str(value)
+
+
+def trim_grid(grid: List[List[str]]) -> List[List[str]]:
+    """Drops trailing empty rows and cells the same way Google Sheets does when reading values."""
+    rows = [row[:] for row in grid]
+    while rows and not any(rows[-1]):
+        rows.pop()
+    width = max((max((idx + 1 for idx, cell in enumerate(row) if cell), default=0) for row in rows), default=0)
+    return [row[:width] + [""] * (width - len(row)) for row in rows]
+
+
+def safe_file_name(name: str) -> str:
+    return re.sub(r"[^\w.\- ]", "_", str(name))
+
+
+_backends: Dict[str, RosterBackend] = {}
+
+
+def register_backend(backend: RosterBackend):
+    """Registers a backend instance under its name, replacing the existing one."""
+    _backends[backend.name] = backend
+
+
+def get_backend(group: dict) -> RosterBackend:
+    """Returns the storage backend configured for the group. Google Sheets is used by default."""
+    storage = group.get("storage") or STORAGE_GOOGLE
+    if storage not in _backends:
+        if storage == STORAGE_GOOGLE:
+            register_backend(GoogleSheetsBackend())
+        elif storage == STORAGE_CSV:
+            register_backend(CsvFileBackend(os.getenv("ROSTER_FILES_DIR", "rosters")))
+        elif storage == STORAGE_XLSX:
+            register_backend(XlsxFileBackend(os.getenv("ROSTER_FILES_DIR", "rosters")))
+        elif storage == STORAGE_MEMORY:
+            register_backend(InMemoryBackend())
+        else:
+            raise RosterBackendError(f"Unknown storage '{storage}'.")
+    return _backends[storage]
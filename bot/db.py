@@ -0,0 +1,160 @@
+"""Lazily connected MongoDB access.
+
+The client is created on first use, so importing the bot or running CLI commands that don't need the database
+does not pay for it.
+
+Pool sizes, timeouts and compression come from MONGO_* environment variables (see .env.example) and are left to
+the driver or the connection string when unset. Collections are requested for an operation type, which decides
+where reads go and how writes are acknowledged: listings and sync reads may be served by secondaries with bounded
+staleness, registration writes wait for a majority of the replica set.
+"""
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+
+from bot.metrics import MongoCommandListener, MongoPoolListener
+
+DATABASE_NAME = "padel_bot"
+
+OPERATION_DEFAULT = "default"
+OPERATION_LISTING = "listing"
+OPERATION_SYNC = "sync"
+OPERATION_REGISTRATION = "registration"
+
+# Environment variable -> (MongoClient option, value parser)
+CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_CONNECTING": ("maxConnecting", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_COMPRESSORS": ("compressors", str),
+}
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+DEFAULT_READ_PREFERENCES = {
+    OPERATION_LISTING: "secondaryPreferred",
+    OPERATION_SYNC: "secondaryPreferred",
+}
+DEFAULT_WRITE_CONCERNS = {
+    OPERATION_REGISTRATION: "majority",
+}
+
+_client: Optional[MongoClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client_options() -> dict:
+    """Collects MongoClient keyword options from the environment, skipping unset variables."""
+    options = {}
+    for variable, (option, parse) in CLIENT_OPTIONS.items():
+        value = os.getenv(variable)
+        if value:
+            options[option] = parse(value)
+    return options
+
+
+def get_client() -> MongoClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(
+                    os.getenv("MONGO_URI"),
+                    event_listeners=[MongoCommandListener(), MongoPoolListener()],
+                    **get_client_options()
+                )
+    return _client
+
+
+def get_read_preference(operation: str):
+    """Returns the read preference for the operation type or None to inherit the client one.
+
+    Set with MONGO_<OPERATION>_READ_PREFERENCE, e.g. MONGO_LISTING_READ_PREFERENCE=nearest. Non-primary modes are
+    bounded by MONGO_MAX_STALENESS_SECONDS (90 at least, as required by the server).
+    """
+    mode = os.getenv(f"MONGO_{operation.upper()}_READ_PREFERENCE", DEFAULT_READ_PREFERENCES.get(operation))
+    if not mode:
+        return None
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference '{mode}' for {operation} operations")
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "90")))
+
+
+def get_write_concern(operation: str) -> Optional[WriteConcern]:
+    """Returns the write concern for the operation type or None to inherit the client one.
+
+    Set with MONGO_<OPERATION>_WRITE_CONCERN, either a node count or a tag like "majority". The wait is bounded by
+    MONGO_WRITE_CONCERN_TIMEOUT_MS.
+    """
+    w = os.getenv(f"MONGO_{operation.upper()}_WRITE_CONCERN", DEFAULT_WRITE_CONCERNS.get(operation))
+    if not w:
+        return None
+    return WriteConcern(
+        w=int(w) if w.isdigit() else w,
+        wtimeout=int(os.getenv("MONGO_WRITE_CONCERN_TIMEOUT_MS", "5000"))
+    )
+
+
+def get_collection_options(operation: str) -> dict:
+    options = {}
+    read_preference = get_read_preference(operation)
+    if read_preference is not None:
+        options["read_preference"] = read_preference
+    write_concern = get_write_concern(operation)
+    if write_concern is not None:
+        options["write_concern"] = write_concern
+    return options
+
+
+class LazyCollection:
+    """Stands in for a collection and resolves it on the first operation."""
+
+    def __init__(self, name: str, operation: str = OPERATION_DEFAULT):
+        self.name = name
+        self.operation = operation
+        self._collection: Optional[Collection] = None
+
+    def resolve(self) -> Collection:
+        if self._collection is None:
+            database = get_client()[DATABASE_NAME]
+            self._collection = database.get_collection(self.name, **get_collection_options(self.operation))
+        return self._collection
+
+    def __getattr__(self, attribute):
+        return getattr(self.resolve(), attribute)
+
+
+class LazyDatabase:
+    def __init__(self):
+        self._collections: Dict[Tuple[str, str], LazyCollection] = {}
+
+    def get_collection(self, name: str, operation: str = OPERATION_DEFAULT) -> LazyCollection:
+        key = (name, operation)
+        if key not in self._collections:
+            self._collections[key] = LazyCollection(name, operation)
+        return self._collections[key]
+
+    def __getitem__(self, name: str) -> LazyCollection:
+        return self.get_collection(name)
+
+    def __getattr__(self, name: str) -> LazyCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
@@ -0,0 +1,47 @@
+"""At-most-once update processing.
+
+Each update_id is claimed by inserting it as the _id of a processed_updates document, so a redelivered update or
+one fetched by a second instance fails the insert and is skipped. Claims expire through a TTL index once Telegram
+can no longer redeliver the update. An in-process LRU of recent claims answers repeated deliveries to the same
+instance without a database round trip.
+"""
+import os
+from datetime import datetime, timezone
+
+from cachetools import LRUCache
+from pymongo.errors import DuplicateKeyError
+
+from bot.metrics import DUPLICATE_UPDATES
+
+PROCESSED_UPDATE_TTL_SECONDS = int(os.getenv("PROCESSED_UPDATE_TTL_SECONDS", "86400"))
+PROCESSED_UPDATE_CACHE_SIZE = int(os.getenv("PROCESSED_UPDATE_CACHE_SIZE", "10000"))
+
+_claimed_updates = LRUCache(maxsize=PROCESSED_UPDATE_CACHE_SIZE)
+
+
+def ensure_indexes(processed_updates_collection):
+    processed_updates_collection.create_index("claimed_at", expireAfterSeconds=PROCESSED_UPDATE_TTL_SECONDS)
+
+
+def claim_update(processed_updates_collection, update_id: int) -> bool:
+    """Claims the update for processing.
+
+    Returns:
+        bool: False if the update was already claimed by this or another instance.
+    """
+    if update_id in _claimed_updates:
+        DUPLICATE_UPDATES.inc("memory")
+        return False
+    try:
+        processed_updates_collection.insert_one({"_id": update_id, "claimed_at": datetime.now(timezone.utc)})
+    except DuplicateKeyError:
+        _claimed_updates[update_id] = True
+        DUPLICATE_UPDATES.inc("mongo")
+        return False
+    _claimed_updates[update_id] = True
+    return True
+
+
+def forget_claims():
+    """Clears the in-process claims, e.g. to simulate a restart."""
+    _claimed_updates.clear()
@@ -0,0 +1,126 @@
+"""Match history export of a group.
+
+Registrations are read through one aggregation cursor that joins the member of every match, and written row by row
+into a temporary CSV or XLSX file. Memory use does not depend on the size of the history.
+"""
+import csv
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Optional, Tuple
+
+import pymongo
+
+EXPORT_CSV = "csv"
+EXPORT_XLSX = "xlsx"
+EXPORT_FORMATS = (EXPORT_CSV, EXPORT_XLSX)
+EXPORT_CURSOR_BATCH_SIZE = 1000
+EXPORT_HEADER = ["Match date", "Position", "Status", "Name", "Surname", "Username", "User ID", "Registered at"]
+
+
+class ExportError(Exception):
+    pass
+
+
+def ensure_indexes(members_collection):
+    # Used by the member join, matches are read through the waitlist (group_id, match_date, position) index
+    members_collection.create_index("user_id")
+
+
+def iter_export_rows(matches_collection, group_id: str, slot_count: int, date_from: Optional[datetime] = None,
+                     date_to: Optional[datetime] = None) -> Iterator[list]:
+    """Yields a row for every registration of the group, ordered by match date and position.
+
+    Args:
+        slot_count: Number of players the courts fit, the registrations behind them are on the waiting list.
+        date_from: Export only matches on or after this date.
+        date_to: Export only matches on or before this date.
+    """
+    match_query = {"group_id": group_id}
+    if date_from or date_to:
+        match_query["match_date"] = {}
+        if date_from:
+            match_query["match_date"]["$gte"] = date_from
+        if date_to:
+            match_query["match_date"]["$lt"] = date_to + timedelta(days=1)
+
+    cursor = matches_collection.aggregate([
+        {"$match": match_query},
+        {"$sort": {"match_date": pymongo.ASCENDING, "position": pymongo.ASCENDING}},
+        {"$lookup": {"from": "members", "localField": "user_id", "foreignField": "user_id", "as": "member"}},
+        {"$project": {
+            "match_date": 1, "position": 1, "user_id": 1, "registered_at": 1,
+            "member": {"$arrayElemAt": ["$member", 0]},
+        }},
+    ], allowDiskUse=True, batchSize=EXPORT_CURSOR_BATCH_SIZE)
+
+    match_date, rank = None, 0
+    with cursor:
+        for match in cursor:
+            member = match.get("member") or {}
+            # Positions leave gaps after cancellations, the place in the list is the rank within the match
+            if match["match_date"] != match_date:
+                match_date, rank = match["match_date"], 0
+            place = None
+            if match.get("position") is not None:
+                rank += 1
+                place = rank
+            registered_at = match.get("registered_at")
+            yield [
+                match["match_date"].strftime("%d.%m.%Y"),
+                place,
+                "" if place is None else "waiting list" if place > slot_count else "player",
+                member.get("registration_name", ""),
+                member.get("registration_surname", ""),
+                member.get("messenger_username") or "",
+                match["user_id"],
+                registered_at.strftime("%d.%m.%Y %H:%M:%S") if registered_at else "",
+            ]
+
+
+def write_csv(rows: Iterable[list], path: str) -> int:
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_HEADER)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(rows: Iterable[list], path: str) -> int:
+    try:
+        import openpyxl
+    except ImportError as ex:
+        raise ExportError("XLSX export requires the openpyxl package.") from ex
+    # Write-only workbooks stream rows to disk instead of keeping the cells in memory
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Matches")
+    worksheet.append(EXPORT_HEADER)
+    count = 0
+    for row in rows:
+        worksheet.append(row)
+        count += 1
+    workbook.save(path)
+    return count
+
+
+EXPORT_WRITERS = {EXPORT_CSV: write_csv, EXPORT_XLSX: write_xlsx}
+
+
+def export_matches(matches_collection, group: dict, slot_count: int, export_format: str,
+                   date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> Tuple[str, int]:
+    """Writes the match history of the group into a temporary file. The caller removes the file.
+
+    Returns:
+        tuple: Path of the file and the number of exported registrations.
+    """
+    file_descriptor, path = tempfile.mkstemp(prefix=f"export_{group['group_id']}_", suffix=f".{export_format}")
+    os.close(file_descriptor)
+    try:
+        rows = iter_export_rows(matches_collection, group["group_id"], slot_count, date_from, date_to)
+        return path, EXPORT_WRITERS[export_format](rows, path)
+    except Exception:
+        os.remove(path)
+        raise
@@ -0,0 +1,154 @@
+"""Attendance statistics of a group, kept up to date with $inc on every registration change.
+
+Every group has one document in group_stats:
+
+    {"_id": group_id, "registrations": 10, "cancellations": 2, "replacements": 1,
+     "players": {"<user_id>": {"registrations": 3, "cancellations": 1, "replaced": 0}, ...},
+     "match_days": {"YYYY-MM-DD": {"registered": 8, "cancellations": 1}, ...}}
+
+Cancellations delete the registration, so they are also logged in match_cancellations. Together with the stored
+registrations this is the history rebuild_stats recomputes the documents from.
+"""
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+REASON_CANCELED = "canceled"
+REASON_REPLACED = "replaced"
+
+
+def ensure_indexes(cancellations_collection):
+    cancellations_collection.create_index([("group_id", pymongo.ASCENDING), ("match_date", pymongo.ASCENDING)])
+
+
+def day_key(match_date: datetime) -> str:
+    return match_date.strftime("%Y-%m-%d")
+
+
+def record_registrations(stats_collection, group_id: str, registrations: Iterable[Tuple[int, datetime]]):
+    """Counts stored registrations given as (user_id, match_date) pairs, with one update for the whole batch."""
+    increments = Counter()
+    for user_id, match_date in registrations:
+        increments["registrations"] += 1
+        increments[f"players.{user_id}.registrations"] += 1
+        increments[f"match_days.{day_key(match_date)}.registered"] += 1
+    if increments:
+        stats_collection.update_one({"_id": group_id}, {"$inc": dict(increments)}, upsert=True)
+
+
+def record_cancellation(stats_collection, cancellations_collection, match: dict, canceled_at: datetime):
+    log_removed_registration(cancellations_collection, match, REASON_CANCELED, canceled_at)
+    stats_collection.update_one({"_id": match["group_id"]}, {"$inc": {
+        "cancellations": 1,
+        f"players.{match['user_id']}.cancellations": 1,
+        f"match_days.{day_key(match['match_date'])}.registered": -1,
+        f"match_days.{day_key(match['match_date'])}.cancellations": 1,
+    }}, upsert=True)
+
+
+def record_replacement(stats_collection, cancellations_collection, match: dict, replacement_user_id: int,
+                       replaced_at: datetime):
+    """Counts a registration handed over to another player. The slot stays taken, so the match day is unchanged."""
+    log_removed_registration(cancellations_collection, match, REASON_REPLACED, replaced_at)
+    stats_collection.update_one({"_id": match["group_id"]}, {"$inc": {
+        "registrations": 1,
+        "replacements": 1,
+        f"players.{match['user_id']}.replaced": 1,
+        f"players.{replacement_user_id}.registrations": 1,
+    }}, upsert=True)
+
+
+def log_removed_registration(cancellations_collection, match: dict, reason: str, removed_at: datetime):
+    cancellations_collection.insert_one({
+        "group_id": match["group_id"],
+        "match_date": match["match_date"],
+        "user_id": match["user_id"],
+        "registered_at": match.get("registered_at"),
+        "reason": reason,
+        "removed_at": removed_at,
+    })
+
+
+def get_stats(stats_collection, group_id: str) -> Optional[dict]:
+    return stats_collection.find_one({"_id": group_id})
+
+
+def count_upcoming_registrations(matches_collection, group_id: str, now: datetime) -> Dict[int, int]:
+    """Returns the number of registrations of every player for matches that are not played yet."""
+    upcoming = matches_collection.aggregate([
+        {"$match": {"group_id": group_id, "match_date": {"$gte": now}}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+    ])
+    return {player["_id"]: player["count"] for player in upcoming}
+
+
+def build_stats(matches_collection, cancellations_collection, group_id: str) -> dict:
+    """Recomputes the statistics of the group from the stored registrations and the cancellation log."""
+    stats = {"_id": group_id, "registrations": 0, "cancellations": 0, "replacements": 0, "players": {},
+             "match_days": {}}
+
+    def player(user_id) -> dict:
+        return stats["players"].setdefault(str(user_id), Counter())
+
+    def match_day(match_date) -> dict:
+        return stats["match_days"].setdefault(day_key(match_date), Counter())
+
+    for match in matches_collection.find({"group_id": group_id}, {"user_id": 1, "match_date": 1}):
+        stats["registrations"] += 1
+        player(match["user_id"])["registrations"] += 1
+        match_day(match["match_date"])["registered"] += 1
+
+    for removed in cancellations_collection.find({"group_id": group_id}, {"user_id": 1, "match_date": 1, "reason": 1}):
+        # Every removed registration was counted when it was made
+        stats["registrations"] += 1
+        player(removed["user_id"])["registrations"] += 1
+        if removed["reason"] == REASON_REPLACED:
+            stats["replacements"] += 1
+            player(removed["user_id"])["replaced"] += 1
+        else:
+            stats["cancellations"] += 1
+            player(removed["user_id"])["cancellations"] += 1
+            match_day(removed["match_date"])["cancellations"] += 1
+
+    stats["players"] = {user_id: dict(counters) for user_id, counters in stats["players"].items()}
+    stats["match_days"] = {day: dict(counters) for day, counters in stats["match_days"].items()}
+    return stats
+
+
+def rebuild_stats(stats_collection, matches_collection, cancellations_collection,
+                  group_ids: List[str] = None) -> Tuple[int, List[str]]:
+    """Replaces the statistics documents with ones recomputed from history.
+
+    Args:
+        group_ids: Rebuild only these groups, every group with registrations by default.
+
+    Returns:
+        tuple: Number of rebuilt groups and the IDs of the groups whose stored statistics differed.
+    """
+    if not group_ids:
+        group_ids = sorted(set(matches_collection.distinct("group_id")) | set(cancellations_collection.distinct("group_id")))
+    differing = []
+    for group_id in group_ids:
+        stats = build_stats(matches_collection, cancellations_collection, group_id)
+        if not same_counters(stats_collection.find_one({"_id": group_id}) or {}, stats):
+            logger.warning("Stored statistics of group %s differ from the history", group_id)
+            differing.append(group_id)
+        stats_collection.replace_one({"_id": group_id}, stats, upsert=True)
+    return len(group_ids), differing
+
+
+def same_counters(stored: dict, rebuilt: dict) -> bool:
+    """Compares statistics ignoring counters that are zero on one side and missing on the other."""
+    return drop_zeros(stored) == drop_zeros(rebuilt)
+
+
+def drop_zeros(value):
+    if isinstance(value, dict):
+        result = {key: drop_zeros(item) for key, item in value.items() if key != "_id"}
+        return {key: item for key, item in result.items() if item not in (0, {})}
+    return value
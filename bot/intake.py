@@ -0,0 +1,180 @@
+"""Burst-absorbing registration intake.
+
+Right after registration opens, hundreds of players send /register_game within seconds. In intake mode the handler
+validates the request against cached group data, puts it on an in-process queue and acknowledges it. A single worker
+drains the queue in arrival order and hands micro-batches to a writer running in a thread, so the event loop keeps
+accepting commands while a batch is stored. Every player then gets the confirmed position.
+"""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+from cachetools import TTLCache
+
+from bot.membership import active_member_query
+from bot.metrics import REGISTRATION_BATCH_SIZE, REGISTRATION_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+GROUP_CACHE_TTL_SECONDS = float(os.getenv("GROUP_CACHE_TTL_SECONDS", "10"))
+
+_groups = TTLCache(maxsize=1024, ttl=GROUP_CACHE_TTL_SECONDS)
+_active_members = TTLCache(maxsize=1024, ttl=GROUP_CACHE_TTL_SECONDS)
+
+
+def find_group_cached(groups_collection, query: dict) -> Optional[dict]:
+    """Finds the group, reusing a lookup made less than GROUP_CACHE_TTL_SECONDS ago."""
+    key = repr(query)
+    group = _groups.get(key)
+    if group is None:
+        group = groups_collection.find_one(query)
+        if group is not None:
+            _groups[key] = group
+    return group
+
+
+def is_active_member_cached(members_collection, group_id: str, user_id: int) -> bool:
+    """Checks the membership against the cached member list of the group.
+
+    Users missing from the list are looked up individually, since they may have joined after the list was loaded.
+    """
+    members = _active_members.get(group_id)
+    if members is None:
+        members = {
+            member["user_id"] for member in members_collection.find(active_member_query(group_id), {"user_id": 1})
+        }
+        _active_members[group_id] = members
+    if user_id in members:
+        return True
+    if members_collection.find_one({"user_id": user_id, **active_member_query(group_id)}, {"_id": 1}):
+        members.add(user_id)
+        return True
+    return False
+
+
+def forget_group(group_id: str):
+    """Drops cached data of a changed group."""
+    _groups.clear()
+    _active_members.pop(group_id, None)
+
+
+class RegistrationRequest:
+    __slots__ = ("user_id", "group", "match_date", "acknowledgement", "position", "failed")
+
+    def __init__(self, user_id: int, group: dict, match_date):
+        self.user_id = user_id
+        self.group = group
+        self.match_date = match_date
+        self.acknowledgement = None
+        # Place in the list set by the writer, stays None if the player turned out to be registered already
+        self.position: Optional[int] = None
+        # Set by the writer if the row of this request could not be stored while the rest of the batch was
+        self.failed = False
+
+    @property
+    def key(self) -> Tuple:
+        return self.group["group_id"], self.match_date, self.user_id
+
+
+class RegistrationIntake:
+    """Queues registrations and stores them in batches.
+
+    Args:
+        write_batch: Stores a batch of requests, sets their positions and marks requests it could not store as
+            failed. Runs in a worker thread.
+        confirm: Tells the player the outcome of a stored request.
+        fail: Tells the player that the request could not be stored.
+        batch_size: Maximum number of requests stored at once.
+        batch_wait: Seconds to wait for more requests before storing an incomplete batch.
+    """
+
+    def __init__(self, write_batch: Callable[[List[RegistrationRequest]], None],
+                 confirm: Callable[[RegistrationRequest], Awaitable], fail: Callable[[RegistrationRequest], Awaitable],
+                 batch_size: int = 100, batch_wait: float = 0.05, enabled: bool = False):
+        self.write_batch = write_batch
+        self.confirm = confirm
+        self.fail = fail
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.enabled = enabled
+        self._pending: Set[Tuple] = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def submit(self, request: RegistrationRequest, acknowledge: Callable[[], Awaitable]) -> bool:
+        """Queues the request in arrival order and starts sending the acknowledgement.
+
+        The acknowledgement message is kept as a task in request.acknowledgement, the confirmation edits it once sent.
+
+        Returns:
+            bool: False if the same registration is already queued.
+        """
+        if request.key in self._pending:
+            return False
+        self._pending.add(request.key)
+        request.acknowledgement = asyncio.ensure_future(acknowledge())
+
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run(), name="registration-intake")
+        self._queue.put_nowait(request)
+        REGISTRATION_QUEUE_DEPTH.inc()
+        return True
+
+    async def wait_for_user(self, user_id: int):
+        """Waits for queued registrations of the user to be stored, so the handler reads its own writes."""
+        if any(key[2] == user_id for key in self._pending):
+            await self.drain()
+
+    async def drain(self):
+        """Waits until every queued request is stored and confirmed."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def stop(self):
+        await self.drain()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+
+            REGISTRATION_QUEUE_DEPTH.dec(amount=len(batch))
+            REGISTRATION_BATCH_SIZE.observe(len(batch))
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[RegistrationRequest]):
+        try:
+            await asyncio.to_thread(self.write_batch, batch)
+        except Exception:
+            logger.exception("Failed to store %s queued registration(s)", len(batch))
+            replies = [self.fail(request) for request in batch]
+        else:
+            replies = [self.fail(request) if request.failed else self.confirm(request) for request in batch]
+        finally:
+            for request in batch:
+                self._pending.discard(request.key)
+
+        for request, result in zip(batch, await asyncio.gather(*replies, return_exceptions=True)):
+            if isinstance(result, Exception):
+                logger.warning("Could not confirm the registration of user %s: %s", request.user_id, result)
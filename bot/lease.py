@@ -0,0 +1,129 @@
+"""Leases stored in MongoDB, so only one bot replica runs a job at a time.
+
+A lease is a document {_id: name, owner, token, expires_at}. It is granted when it is free, expired or already held
+by the same owner, in a single find_one_and_update. If another owner holds it, the upsert hits the _id and fails
+with DuplicateKeyError. The holder renews it well before expires_at, so a crashed holder is replaced within the
+TTL. The token grows with every grant: writes that must not come from a stale holder (e.g. one resuming after a
+long pause) carry it as a fencing token and are rejected once a newer one was stored.
+
+Expiry relies on the replica clocks, which must be in sync to well within the TTL.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+EXPIRED = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def generate_owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Lease:
+    """A named lease held by this process.
+
+    Args:
+        name: Lease name, one per job or shard.
+        owner: Unique ID of the process.
+        ttl: Seconds the lease stays valid after a grant.
+        clock: Returns the current time, replaced in simulations.
+    """
+
+    def __init__(self, collection, name: str, owner: str, ttl: float,
+                 clock: Callable[[], datetime] = lambda: datetime.now(timezone.utc)):
+        self.collection = collection
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.clock = clock
+        self.token: Optional[int] = None
+        self._expires_at = EXPIRED
+        self._lock = threading.Lock()
+
+    @property
+    def held(self) -> bool:
+        """Whether the lease is held according to the last grant, without a query."""
+        return self.token is not None and self.clock() < self._expires_at
+
+    def acquire(self) -> bool:
+        """Takes the lease if it is free or expired, or renews it if this process holds it.
+
+        Returns:
+            bool: True if the lease is held until the new expiry.
+        """
+        with self._lock:
+            now = self.clock()
+            try:
+                lease = self.collection.find_one_and_update(
+                    {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                    {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.ttl)},
+                     "$inc": {"token": 1}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                if self.token is not None:
+                    logger.warning("Lost lease %s to another owner", self.name)
+                self.token = None
+                return False
+            if self.token is None:
+                logger.info("Acquired lease %s with token %s", self.name, lease["token"])
+            self.token = lease["token"]
+            self._expires_at = now + timedelta(seconds=self.ttl)
+            return True
+
+    def acquire_within(self, timeout: float, interval: float = 1.0) -> bool:
+        """Retries acquire() until the lease is granted or timeout seconds passed.
+
+        Returns:
+            bool: True if the lease is held until the new expiry.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.acquire():
+            if time.monotonic() + interval > deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def release(self):
+        """Gives the lease up, so another owner can take it right away."""
+        with self._lock:
+            if self.token is None:
+                return
+            self.collection.update_one(
+                {"_id": self.name, "owner": self.owner, "token": self.token}, {"$set": {"expires_at": EXPIRED}}
+            )
+            self.token = None
+            self._expires_at = EXPIRED
+
+    def check(self) -> int:
+        """Returns the fencing token, raising LeaseLost if the lease may have been taken over."""
+        token = self.token
+        if token is None or not self.held:
+            raise LeaseLost(f"Lease {self.name} is not held")
+        return token
+
+
+def fenced(query: dict, token: Optional[int]) -> dict:
+    """Extends the filter of an upsert with the fencing token check.
+
+    The document must be unique on the query fields: a stale writer then fails with DuplicateKeyError instead of
+    inserting a second document.
+    """
+    if token is None:
+        return query
+    return {**query, "$or": [{"fencing_token": {"$exists": False}}, {"fencing_token": {"$lte": token}}]}
@@ -0,0 +1,130 @@
+"""Non-blocking logging pipeline.
+
+Handlers only put records on an in-process queue. A background listener thread does the JSON serialization and
+I/O, so logging never blocks the event loop. Messages with only immutable arguments are also formatted there, others
+are formatted in the calling thread so the log shows the values at the time of the call. Records carry the update_id, user, chat and
+command of the update being handled, bound by bind_update_context.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import copy
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+CONTEXT_FIELDS = ("update_id", "user_id", "chat_id", "command")
+# Arguments of these types can't change before the listener formats the message
+IMMUTABLE_ARG_TYPES = (str, int, float, bool, bytes, type(None))
+
+_update_context: ContextVar[Optional[dict]] = ContextVar("log_update_context", default=None)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def bind_update_context(update_id=None, user_id=None, chat_id=None, command=None):
+    _update_context.set({"update_id": update_id, "user_id": user_id, "chat_id": chat_id, "command": command})
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records with immutable arguments as they are, leaving the message formatting to the listener thread.
+
+    Mutable arguments (dicts, lists, PTB objects) are merged into the message right away, and tracebacks are rendered
+    to text, so the queued record holds no references to frames or objects that may still change.
+    """
+
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if isinstance(args, dict):
+            args = args.values()
+        if record.exc_info is None and all(isinstance(arg, IMMUTABLE_ARG_TYPES) for arg in args or ()):
+            return record
+        record = copy.copy(record)
+        if record.args and not all(isinstance(arg, IMMUTABLE_ARG_TYPES) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class UpdateContextFilter(logging.Filter):
+    """Attaches the current update context to the record in the calling thread."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _update_context.get()
+        if context:
+            for field in CONTEXT_FIELDS:
+                setattr(record, field, context[field])
+        return True
+
+
+class InfoSamplingFilter(logging.Filter):
+    """Keeps only a share of INFO and lower records. Warnings and errors always pass."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.INFO or self.rate >= 1.0 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = "INFO", log_format: str = "json", info_sample_rate: float = 1.0):
+    """Routes all logging through the queue and starts the background listener."""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler()
+    if log_format == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(InfoSamplingFilter(info_sample_rate))
+    queue_handler.addFilter(UpdateContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flushes queued records and stops the listener."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,119 @@
+"""Group memberships embedded in member documents.
+
+Every member document keeps its memberships in a "groups" array of {group_id, status, blocked_till, joined_at}
+items, indexed as a multikey index. Handlers get the memberships together with the member, or the groups of the
+active memberships through a single aggregation, instead of querying a separate member_groups collection.
+"""
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import pymongo
+from pymongo import UpdateOne
+
+MEMBERSHIP_ACTIVE = "active"
+MIGRATION_BATCH_SIZE = 1000
+
+
+def ensure_indexes(members_collection):
+    members_collection.create_index([("groups.group_id", pymongo.ASCENDING), ("groups.status", pymongo.ASCENDING)])
+
+
+def new_membership(group_id: str, status: str = MEMBERSHIP_ACTIVE, joined_at: datetime = None) -> dict:
+    return {
+        "group_id": group_id,
+        "status": status,
+        "blocked_till": None,
+        "joined_at": joined_at or datetime.now(timezone.utc),
+    }
+
+
+def find_membership(member: Optional[dict], group_id: str) -> Optional[dict]:
+    for membership in (member or {}).get("groups", []):
+        if membership["group_id"] == group_id:
+            return membership
+    return None
+
+
+def active_member_query(group_id: str) -> dict:
+    """Query of members with an active membership in the group."""
+    return {"groups": {"$elemMatch": {"group_id": group_id, "status": MEMBERSHIP_ACTIVE}}}
+
+
+def add_membership(members_collection, user_id: int, group_id: str) -> bool:
+    """Adds an active membership to the member.
+
+    Returns:
+        bool: False if the member already has a membership in the group.
+    """
+    result = members_collection.update_one(
+        {"user_id": user_id, "groups.group_id": {"$ne": group_id}},
+        {"$push": {"groups": new_membership(group_id)}}
+    )
+    return result.modified_count > 0
+
+
+def find_active_groups(members_collection, user_id: int, group_query: dict = None) -> List[dict]:
+    """Returns the groups the user is an active member of, in one round trip.
+
+    Args:
+        group_query: Filters the group documents, e.g. {"group_id": "-100", "deleted_at": None}.
+    """
+    membership_query = {"groups.status": MEMBERSHIP_ACTIVE}
+    if group_query and isinstance(group_query.get("group_id"), str):
+        membership_query["groups.group_id"] = group_query["group_id"]
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$unwind": "$groups"},
+        {"$match": membership_query},
+        {"$lookup": {"from": "groups", "localField": "groups.group_id", "foreignField": "group_id", "as": "group"}},
+        {"$unwind": "$group"},
+    ]
+    if group_query:
+        pipeline.append({"$match": prefix_fields(group_query, "group.")})
+    pipeline.append({"$replaceRoot": {"newRoot": "$group"}})
+    return list(members_collection.aggregate(pipeline))
+
+
+def prefix_fields(query: dict, prefix: str) -> dict:
+    """Moves the query on the fields of an embedded document, keeping $and/$or/$nor operators."""
+    prefixed = {}
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            prefixed[key] = [prefix_fields(item, prefix) for item in value]
+        else:
+            prefixed[prefix + key] = value
+    return prefixed
+
+
+def migrate_member_groups(member_groups_collection, members_collection) -> int:
+    """Copies memberships from the member_groups collection into the member documents.
+
+    Memberships already embedded are left as they are, so the migration can be run again.
+
+    Returns:
+        int: Number of memberships added.
+    """
+    added = 0
+    operations = []
+
+    def flush():
+        nonlocal added
+        if operations:
+            added += members_collection.bulk_write(operations, ordered=False).modified_count
+            operations.clear()
+
+    for member_group in member_groups_collection.find().sort("_id", pymongo.ASCENDING):
+        group_id = str(member_group["group_id"])
+        membership = new_membership(
+            group_id, member_group.get("status", MEMBERSHIP_ACTIVE),
+            member_group.get("joined_at") or member_group["_id"].generation_time
+        )
+        membership["blocked_till"] = member_group.get("blocked_till")
+        operations.append(UpdateOne(
+            {"user_id": member_group["user_id"], "groups.group_id": {"$ne": group_id}},
+            {"$push": {"groups": membership}}
+        ))
+        if len(operations) >= MIGRATION_BATCH_SIZE:
+            flush()
+    flush()
+    return added
@@ -0,0 +1,346 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Recording a value is a dict lookup and a couple of additions under a lock, so it is cheap enough for every update.
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from pymongo import monitoring
+from telegram.ext import Application, BaseHandler, CommandHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+from bot import tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["Metric"] = []
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            lines += self._render_samples()
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def _format_labels(self, label_values: Tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, label_values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0.0)
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, function: Callable[[], float], *label_values):
+        """Reads the value from the function on every scrape."""
+        with self._lock:
+            self._functions[label_values] = function
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def dec(self, *label_values, amount: float = 1.0):
+        self.inc(*label_values, amount=-amount)
+
+    def get(self, *label_values) -> float:
+        function = self._functions.get(label_values)
+        return function() if function else self._values.get(label_values, 0.0)
+
+    def _render_samples(self) -> List[str]:
+        values = {**self._values, **{labels: function() for labels, function in self._functions.items()}}
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (non-cumulative) + overflow, sum, count]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        bucket_idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bucket_idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def get_count(self, *label_values) -> int:
+        state = self._values.get(label_values)
+        return state[2] if state else 0
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        for labels, (bucket_counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = self._format_labels(labels, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(labels)} {count}")
+        return lines
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Handler callback duration.", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised while handling updates.", ["exception"])
+MONGO_COMMAND_LATENCY = Histogram("bot_mongo_command_duration_seconds", "MongoDB command duration.", ["command"])
+MONGO_COMMAND_FAILURES = Counter("bot_mongo_command_failures_total", "Failed MongoDB commands.", ["command"])
+MONGO_POOL_WAIT = Histogram(
+    "bot_mongo_pool_wait_duration_seconds", "Time spent waiting for a MongoDB connection from the pool.", ["address"]
+)
+MONGO_POOL_WAITERS = Gauge("bot_mongo_pool_waiters", "Operations waiting for a MongoDB connection.", ["address"])
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "bot_mongo_pool_checkout_failures_total", "Failed MongoDB connection checkouts.", ["address", "reason"]
+)
+MONGO_POOL_CONNECTIONS = Gauge("bot_mongo_pool_connections", "Open MongoDB connections.", ["address"])
+MONGO_POOL_IN_USE = Gauge("bot_mongo_pool_connections_in_use", "Checked out MongoDB connections.", ["address"])
+SHEETS_CALL_LATENCY = Histogram("bot_sheets_call_duration_seconds", "Google Sheets operation duration.", ["operation"])
+SHEETS_CALL_FAILURES = Counter("bot_sheets_call_failures_total", "Failed Google Sheets operations.", ["operation"])
+DUPLICATE_UPDATES = Counter(
+    "bot_duplicate_updates_total", "Redelivered updates skipped, by where the earlier claim was found.", ["source"]
+)
+REGISTRATION_QUEUE_DEPTH = Gauge("bot_registration_queue_depth", "Registrations waiting in the intake queue.")
+REGISTRATION_BATCH_SIZE = Histogram(
+    "bot_registration_batch_size", "Registrations stored per intake batch.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500)
+)
+LIVE_CONVERSATIONS = Gauge("bot_live_conversations", "Conversations waiting for the next user step.", ["conversation"])
+USER_DATA_ENTRIES = Gauge("bot_user_data_entries", "Users with state kept in memory.")
+USER_DATA_EVICTIONS = Counter("bot_user_data_evictions_total", "User states dropped to stay within the limit.")
+TELEGRAM_REQUEST_LATENCY = Histogram(
+    "bot_telegram_request_duration_seconds", "Outbound Telegram Bot API request duration.", ["method"]
+)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Feeds pymongo command monitoring events into the MongoDB metrics."""
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        MONGO_COMMAND_LATENCY.observe(event.duration_micros / 1_000_000, event.command_name)
+        if tracing.enabled:
+            tracing.record_segment("mongo", event.duration_micros / 1_000_000)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        MONGO_COMMAND_LATENCY.observe(event.duration_micros / 1_000_000, event.command_name)
+        MONGO_COMMAND_FAILURES.inc(event.command_name)
+        if tracing.enabled:
+            tracing.record_segment("mongo", event.duration_micros / 1_000_000)
+
+
+def format_address(address) -> str:
+    return "%s:%s" % address
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Feeds pymongo connection pool events into the pool metrics, which show whether the pool is sized for the load."""
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.inc(format_address(event.address))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.dec(format_address(event.address))
+
+    def connection_check_out_started(self, event):
+        MONGO_POOL_WAITERS.inc(format_address(event.address))
+
+    def connection_check_out_failed(self, event):
+        address = format_address(event.address)
+        MONGO_POOL_WAITERS.dec(address)
+        MONGO_POOL_CHECKOUT_FAILURES.inc(address, event.reason)
+        if event.duration is not None:
+            MONGO_POOL_WAIT.observe(event.duration, address)
+
+    def connection_checked_out(self, event):
+        address = format_address(event.address)
+        MONGO_POOL_WAITERS.dec(address)
+        MONGO_POOL_IN_USE.inc(address)
+        if event.duration is not None:
+            MONGO_POOL_WAIT.observe(event.duration, address)
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_IN_USE.dec(format_address(event.address))
+
+
+def track_sheets_call(func: Callable) -> Callable:
+    """Decorator recording duration and failures of a Google Sheets operation under the function name."""
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            SHEETS_CALL_FAILURES.inc(operation)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            SHEETS_CALL_LATENCY.observe(duration, operation)
+            if tracing.enabled:
+                tracing.record_segment("sheets", duration)
+
+    return wrapper
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """Bot API transport recording the duration of every outbound request by API method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            TELEGRAM_REQUEST_LATENCY.observe(duration, url.rsplit("/", 1)[-1])
+            if tracing.enabled:
+                tracing.record_segment("telegram", duration)
+
+
+def get_handler_name(handler: BaseHandler) -> str:
+    if isinstance(handler, CommandHandler):
+        return "/" + "|".join(sorted(handler.commands))
+    return getattr(handler.callback, "__name__", type(handler).__name__)
+
+
+def wrap_handler_callback(handler: BaseHandler, name: str):
+    callback = handler.callback
+
+    @functools.wraps(callback)
+    async def timed_callback(update, context):
+        trace = tracing.start_trace(update, name) if tracing.enabled else None
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+            if trace is not None:
+                tracing.finish_trace(trace)
+
+    handler.callback = timed_callback
+
+
+def instrument_handlers(handlers: Sequence[BaseHandler]):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        else:
+            wrap_handler_callback(handler, get_handler_name(handler))
+
+
+def instrument_application(app: Application):
+    """Wraps callbacks of all registered handlers to record their latency. Call after adding handlers."""
+    for handlers in app.handlers.values():
+        instrument_handlers(handlers)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves /metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Metrics are served on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,58 @@
+"""Taken places of upcoming matches, cached for the registration date picker.
+
+A match counter holds the number of reserved positions and of removed registrations, their difference is the
+number of registrations of the match. The counters of a group's upcoming game dates are loaded with one query and cached, registrations and cancellations made
+on this instance update the cached numbers. Changes made on another instance are seen after at most
+OCCUPANCY_CACHE_TTL_SECONDS.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+from cachetools import TTLCache
+
+OCCUPANCY_CACHE_TTL_SECONDS = float(os.getenv("OCCUPANCY_CACHE_TTL_SECONDS", "30"))
+
+_occupancy = TTLCache(maxsize=1024, ttl=OCCUPANCY_CACHE_TTL_SECONDS)
+
+
+def match_key(match_date: datetime) -> datetime:
+    # Dates come back from MongoDB without a timezone
+    return match_date.replace(tzinfo=timezone.utc)
+
+
+def upcoming_game_dates(group: dict, now: datetime) -> List[datetime]:
+    """Returns the game dates of the group open for registration, after today and up to registration_open_till."""
+    open_till = match_key(group["registration_open_till"])
+    match_date = datetime(now.year, now.month, now.day, tzinfo=timezone.utc) + timedelta(days=1)
+    match_date += timedelta(days=(group["game_day"] - match_date.weekday()) % 7)
+    dates = []
+    while match_date <= open_till:
+        dates.append(match_date)
+        match_date += timedelta(weeks=1)
+    return dates
+
+
+def get_occupancy(counters_collection, group_id: str, match_dates: List[datetime]) -> Dict[datetime, int]:
+    """Returns the number of registrations of every match date, querying only when the cache misses a date."""
+    taken = _occupancy.get(group_id)
+    if taken is None or any(match_date not in taken for match_date in match_dates):
+        taken = {match_date: 0 for match_date in match_dates}
+        for counter in counters_collection.find(
+                {"group_id": group_id, "match_date": {"$in": match_dates}}, {"match_date": 1, "last_position": 1, "removed": 1}):
+            taken[match_key(counter["match_date"])] = counter["last_position"] - counter.get("removed", 0)
+        _occupancy[group_id] = taken
+    return {match_date: taken[match_date] for match_date in match_dates}
+
+
+def record_taken(group_id: str, match_date: datetime, registrations: int):
+    """Stores the number of registrations known after a registration, its rank."""
+    taken = _occupancy.get(group_id)
+    if taken is not None and match_key(match_date) in taken:
+        taken[match_key(match_date)] = registrations
+
+
+def record_freed(group_id: str, match_date: datetime):
+    taken = _occupancy.get(group_id)
+    if taken is not None and taken.get(match_key(match_date)):
+        taken[match_key(match_date)] -= 1
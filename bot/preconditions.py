@@ -0,0 +1,53 @@
+"""Preconditions of a match registration.
+
+The group and its active members come from the short-lived caches of bot.intake, the date checks run on the group
+document, so a warm registration makes a single query: whether the player is registered already. The checks run
+in a fixed order and the result names the first one that failed.
+"""
+from datetime import datetime, timezone
+from typing import Optional
+
+from bot.intake import find_group_cached, is_active_member_cached
+
+CHECK_PASSED = None
+GROUP_NOT_FOUND = "group_not_found"
+NOT_A_MEMBER = "not_a_member"
+REGISTRATION_CLOSED = "registration_closed"
+NOT_A_GAME_DAY = "not_a_game_day"
+ALREADY_REGISTERED = "already_registered"
+
+
+class RegistrationCheck:
+    __slots__ = ("failure", "group")
+
+    def __init__(self, failure: Optional[str], group: Optional[dict] = None):
+        # One of the failure constants, CHECK_PASSED if the player can register
+        self.failure = failure
+        self.group = group
+
+    @property
+    def passed(self) -> bool:
+        return self.failure is CHECK_PASSED
+
+
+def check_registration(groups_collection, members_collection, matches_collection, group_query: dict, user_id: int,
+                       match_date: datetime, check_existing: bool = True) -> RegistrationCheck:
+    """Checks whether the user can register for the match date.
+
+    Args:
+        group_query: Finds the group, deleted groups are excluded.
+        check_existing: Look for an existing registration, skipped when the registration writer handles duplicates.
+    """
+    group = find_group_cached(groups_collection, {**group_query, "deleted_at": None})
+    if not group:
+        return RegistrationCheck(GROUP_NOT_FOUND)
+    if not is_active_member_cached(members_collection, group["group_id"], user_id):
+        return RegistrationCheck(NOT_A_MEMBER, group)
+    if match_date > group["registration_open_till"].replace(tzinfo=timezone.utc):
+        return RegistrationCheck(REGISTRATION_CLOSED, group)
+    if match_date.weekday() != group["game_day"]:
+        return RegistrationCheck(NOT_A_GAME_DAY, group)
+    if check_existing and matches_collection.find_one(
+            {"user_id": user_id, "group_id": group["group_id"], "match_date": match_date}, {"_id": 1}):
+        return RegistrationCheck(ALREADY_REGISTERED, group)
+    return RegistrationCheck(CHECK_PASSED, group)
@@ -0,0 +1,61 @@
+import hashlib
+from typing import List
+
+from bot.a1 import rowcol_to_a1
+
+
+def get_column(sheet_data: list, col_idx: int) -> List[str]:
+    """Returns the column values without trailing empty cells.
+
+    Google omits trailing empty cells when reading, so padded and read-back grids hash the same way.
+    """
+    column = [row[col_idx] if col_idx < len(row) else "" for row in sheet_data]
+    while column and column[-1] == "":
+        column.pop()
+    return column
+
+
+def column_count(sheet_data: list) -> int:
+    return max((len(row) for row in sheet_data), default=0)
+
+
+def hash_columns(sheet_data: list) -> List[str]:
+    """Calculates a content hash for every column of the worksheet data."""
+    return [
+        hashlib.sha1("\x1f".join(get_column(sheet_data, col_idx)).encode("utf-8")).hexdigest()
+        for col_idx in range(column_count(sheet_data))
+    ]
+
+
+def find_changed_columns(previous_hashes: List[str], sheet_data: list) -> List[int]:
+    """Returns indexes of the columns whose content differs from the previous hashes."""
+    return [
+        col_idx for col_idx, column_hash in enumerate(hash_columns(sheet_data))
+        if col_idx >= len(previous_hashes) or previous_hashes[col_idx] != column_hash
+    ]
+
+
+def build_column_ranges(sheet_data: list, columns: List[int]) -> List[dict]:
+    """Builds batch update ranges for the given columns, merging adjacent columns into one range.
+
+    Returns:
+        list: Items in the {"range": "C1:D20", "values": [[...], ...]} format.
+    """
+    ranges = []
+    row_count = len(sheet_data)
+    for col_idx in sorted(columns):
+        if ranges and ranges[-1]["last_col"] == col_idx - 1:
+            ranges[-1]["last_col"] = col_idx
+        else:
+            ranges.append({"first_col": col_idx, "last_col": col_idx})
+
+    return [
+        {
+            "range": f"{rowcol_to_a1(1, item['first_col'] + 1)}:{rowcol_to_a1(row_count, item['last_col'] + 1)}",
+            "values": [
+                [row[col_idx] if col_idx < len(row) else "" for col_idx in range(item["first_col"], item["last_col"] + 1)]
+                for row in sheet_data
+            ],
+        }
+        for item in ranges
+    ]
@@ -1,5 +1,6 @@
 import logging
-from typing import Union, List, Any
+import threading
+from typing import Union, List, Any, Optional, Tuple
 
 import gspread
 from google.oauth2 import service_account
@@ -7,7 +8,13 @@ import os
 
 from gspread import WorksheetNotFound, ValueRange
 
+from bot.metrics import track_sheets_call
 
+_client: Optional[gspread.Client] = None
+_client_lock = threading.Lock()
+
+
+@track_sheets_call
 def is_spreadsheet_writable(spreadsheet_url: str) -> bool:
     try:
         client = get_spreadsheet_client()
@@ -22,18 +29,43 @@ def is_spreadsheet_writable(spreadsheet_url: str) -> bool:
 
 
 def get_spreadsheet_client() -> gspread.Client:
-    credentials = service_account.Credentials.from_service_account_file(os.path.dirname(__file__) + "/../credentials.json")
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds_with_scope = credentials.with_scopes(scope)
-    return gspread.authorize(creds_with_scope)
-
-
+    """Returns the authorized client, created once per process so the access token and connections are reused."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                credentials = service_account.Credentials.from_service_account_file(
+                    os.path.dirname(__file__) + "/../credentials.json"
+                )
+                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+                creds_with_scope = credentials.with_scopes(scope)
+                _client = gspread.authorize(creds_with_scope)
+    return _client
+
+
+@track_sheets_call
 def create_worksheet(spreadsheet_url: str, name: str, rows: int, cols: int) -> gspread.worksheet:
     client = get_spreadsheet_client()
     spreadsheet = client.open_by_url(spreadsheet_url)
     return spreadsheet.add_worksheet(name, rows, cols)
 
 
+@track_sheets_call
+def duplicate_worksheet(spreadsheet_url: str, template_name: str, name: str) -> gspread.Worksheet:
+    """Copies the template worksheet on the Google side, keeping its values and formatting.
+
+    Args:
+        spreadsheet_url (str): Spreadsheet link.
+        template_name (str): The worksheet to copy.
+        name (str): Title of the new worksheet.
+    """
+    client = get_spreadsheet_client()
+    spreadsheet = client.open_by_url(spreadsheet_url)
+    template = spreadsheet.worksheet(template_name)
+    return template.duplicate(new_sheet_name=name)
+
+
+@track_sheets_call
 def has_worksheet_with_name(spreadsheet_url: str, worksheet_name: str) -> bool:
     client = get_spreadsheet_client()
     spreadsheet = client.open_by_url(spreadsheet_url)
@@ -44,26 +76,59 @@ def has_worksheet_with_name(spreadsheet_url: str, worksheet_name: str) -> bool:
         return False
 
 
-def update_group_worksheet(spreadsheet_url: str, worksheet_name: str, updated_data: list):
-    """Writes entire worksheet data in a single batch update to Google Sheets.
+@track_sheets_call
+def fetch_all_data_from_worksheet(spreadsheet_url: str, worksheet_name: str) -> Union[ValueRange, List[List[Any]]]:
+    client = get_spreadsheet_client()
+    spreadsheet = client.open_by_url(spreadsheet_url)
+    worksheet = spreadsheet.worksheet(worksheet_name)
+
+    return worksheet.get_all_values()
+
+
+@track_sheets_call
+def update_worksheet_ranges(spreadsheet_url: str, worksheet_name: str, ranges: List[dict]):
+    """Writes only the given ranges of the worksheet in a single batch update.
 
     Args:
         spreadsheet_url (str): Spreadsheet link.
         worksheet_name (str): The target worksheet to update.
-        updated_data (list): The full worksheet structure with updated values.
+        ranges (list): Items in the {"range": "A1:B2", "values": [[...]]} format.
     """
     client = get_spreadsheet_client()
     spreadsheet = client.open_by_url(spreadsheet_url)
-
     worksheet = spreadsheet.worksheet(worksheet_name)
+    worksheet.batch_update(ranges)
+
 
-    update_range = f"A1:{chr(64 + len(updated_data[0]))}{len(updated_data)}"  # E.g., "A1:G20"
-    worksheet.update(update_range, updated_data)
+@track_sheets_call
+def get_last_update_time(spreadsheet_url: str) -> str:
+    """Returns the spreadsheet modification time from Drive metadata, which does not use Sheets read quota."""
+    client = get_spreadsheet_client()
+    # Opening the spreadsheet object would fetch the sheet metadata, so Drive is queried directly
+    metadata = client.http_client.get_file_drive_metadata(gspread.utils.extract_id_from_url(spreadsheet_url))
+    return metadata["modifiedTime"]
 
 
-def fetch_all_data_from_worksheet(spreadsheet_url: str, worksheet_name: str) -> Union[ValueRange, List[List[Any]]]:
+@track_sheets_call
+def write_worksheet_range(spreadsheet_url: str, worksheet_name: str, range_name: str, values: List[List[Any]]):
     client = get_spreadsheet_client()
     spreadsheet = client.open_by_url(spreadsheet_url)
     worksheet = spreadsheet.worksheet(worksheet_name)
+    worksheet.update(range_name=range_name, values=values)
 
-    return worksheet.get_all_values()
+
+@track_sheets_call
+def ensure_worksheet_size(spreadsheet_url: str, worksheet_name: str, row_count: int, col_count: int) -> Tuple[int, int]:
+    """Adds rows and columns to the worksheet if it has less than row_count rows or col_count columns.
+
+    Returns:
+        tuple: Row and column count of the worksheet.
+    """
+    client = get_spreadsheet_client()
+    spreadsheet = client.open_by_url(spreadsheet_url)
+    worksheet = spreadsheet.worksheet(worksheet_name)
+    if worksheet.row_count < row_count:
+        worksheet.add_rows(row_count - worksheet.row_count)
+    if worksheet.col_count < col_count:
+        worksheet.add_cols(col_count - worksheet.col_count)
+    return worksheet.row_count, worksheet.col_count
@@ -0,0 +1,104 @@
+"""Statistics of a spreadsheet synchronization run."""
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List
+
+from bot.a1 import rowcol_to_a1
+from bot.backends import RosterBackend
+
+PHASES = ("load", "read", "diff", "write", "snapshot")
+
+
+class SyncReport:
+    def __init__(self, dry_run: bool = False):
+        self.dry_run = dry_run
+        self.phase_durations: Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.api_calls = Counter()
+        self.groups_synced: List[str] = []
+        self.groups_unchanged: List[str] = []
+        self.groups_skipped: List[str] = []
+        self.groups_failed: Dict[str, str] = {}
+        self.cells_changed = 0
+        # Set when the run stopped early because of a shutdown, the remaining groups wait for the next run
+        self.interrupted = False
+        # Groups left for the next run by an interrupted run
+        self.groups_not_attempted: List[str] = []
+        self.diffs: Dict[str, List[dict]] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_durations[name] += time.perf_counter() - started
+
+    def track(self, backend: RosterBackend) -> "TrackedBackend":
+        return TrackedBackend(backend, self.api_calls)
+
+    def add_diff(self, group_id: str, previous: list, current: list, columns: List[int]) -> int:
+        """Records the cells of the changed columns that differ from the previous worksheet data.
+
+        Returns:
+            int: Number of changed cells.
+        """
+        changes = []
+        for col_idx in columns:
+            for row_idx in range(max(len(previous), len(current))):
+                old = get_cell(previous, row_idx, col_idx)
+                new = get_cell(current, row_idx, col_idx)
+                if old != new:
+                    changes.append({"cell": rowcol_to_a1(row_idx + 1, col_idx + 1), "old": old, "new": new})
+        if changes:
+            self.diffs[group_id] = changes
+        return len(changes)
+
+    @property
+    def exit_code(self) -> int:
+        """0 when every group synced, 1 when at least one group failed or the run stopped before the last one."""
+        return 1 if self.groups_failed or self.interrupted else 0
+
+    def to_dict(self, include_diffs: bool = False) -> dict:
+        result = {
+            "dry_run": self.dry_run,
+            "groups_synced": self.groups_synced,
+            "groups_unchanged": self.groups_unchanged,
+            "groups_skipped": self.groups_skipped,
+            "groups_failed": self.groups_failed,
+            "cells_changed": self.cells_changed,
+            "interrupted": self.interrupted,
+            "groups_not_attempted": self.groups_not_attempted,
+            "api_calls": dict(sorted(self.api_calls.items())),
+            "duration_s": {phase: round(duration, 4) for phase, duration in self.phase_durations.items()},
+        }
+        result["duration_s"]["total"] = round(time.perf_counter() - self._started, 4)
+        if include_diffs:
+            result["diffs"] = self.diffs
+        return result
+
+
+class TrackedBackend:
+    """Counts the roster storage calls made through the backend."""
+
+    def __init__(self, backend: RosterBackend, calls: Counter):
+        self._backend = backend
+        self._calls = calls
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+        if not callable(attribute):
+            return attribute
+
+        def tracked(*args, **kwargs):
+            self._calls[name] += 1
+            return attribute(*args, **kwargs)
+
+        return tracked
+
+
+def get_cell(sheet_data: list, row_idx: int, col_idx: int) -> str:
+    if row_idx < len(sheet_data) and col_idx < len(sheet_data[row_idx]):
+        return sheet_data[row_idx][col_idx]
+    return ""
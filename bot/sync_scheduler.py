@@ -0,0 +1,99 @@
+"""Periodic spreadsheet sync inside the bot process.
+
+The sync runs as a JobQueue job in a worker thread, reusing the MongoDB and Google clients of the bot instead of paying
+process startup and authentication on every cron run. A run that is due while the previous one is still going is
+skipped. The outcome of the last run is kept in MongoDB, so /sync_status shows it for scheduled and CLI runs alike.
+"""
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from bot.sync_report import SyncReport
+
+logger = logging.getLogger(__name__)
+
+SYNC_STATUS_ID = "spreadsheet"
+TRIGGER_SCHEDULED = "scheduled"
+TRIGGER_CLI = "cli"
+STATUS_OK = "ok"
+STATUS_PARTIAL = "partial"
+STATUS_FAILED = "failed"
+STATUS_INTERRUPTED = "interrupted"
+
+
+class SyncRunner:
+    """Runs the sync at most once at a time and records the outcome.
+
+    Args:
+        sync: Runs the sync, accepting a should_stop callable that is checked between groups.
+    """
+
+    def __init__(self, sync: Callable[..., SyncReport]):
+        self.sync = sync
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, status_collection, trigger: str, should_stop: Callable[[], bool] = lambda: False,
+            **sync_options) -> Optional[SyncReport]:
+        """Runs the sync unless the previous run is still in progress.
+
+        Args:
+            status_collection: Collection keeping the last-run status.
+            trigger (str): What started the run, TRIGGER_SCHEDULED or TRIGGER_CLI.
+            should_stop (Callable): Returns True once the process shuts down, the run stops after the current group.
+            sync_options: Passed on to the sync.
+
+        Returns:
+            SyncReport: Statistics of the run, None if it was skipped.
+        """
+        if not self._lock.acquire(blocking=False):
+            logger.warning("Skipping the %s spreadsheet sync, the previous run is still in progress", trigger)
+            status_collection.update_one(
+                {"_id": SYNC_STATUS_ID},
+                {"$inc": {"skipped_runs": 1}, "$set": {"last_skipped_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            return None
+        try:
+            started_at = datetime.now(timezone.utc)
+            status_collection.update_one(
+                {"_id": SYNC_STATUS_ID},
+                {"$set": {"running": True, "started_at": started_at, "trigger": trigger}},
+                upsert=True
+            )
+            try:
+                report = self.sync(should_stop=should_stop, **sync_options)
+            except Exception as error:
+                logger.exception("The %s spreadsheet sync failed", trigger)
+                record_finished_run(status_collection, STATUS_FAILED, error=f"{type(error).__name__}: {error}")
+                return None
+            if report.interrupted:
+                status = STATUS_INTERRUPTED
+            else:
+                status = STATUS_PARTIAL if report.exit_code else STATUS_OK
+            record_finished_run(status_collection, status, report)
+            return report
+        finally:
+            self._lock.release()
+
+
+def record_finished_run(status_collection, status: str, report: SyncReport = None, error: str = None):
+    status_collection.update_one(
+        {"_id": SYNC_STATUS_ID},
+        {"$set": {
+            "running": False,
+            "finished_at": datetime.now(timezone.utc),
+            "status": status,
+            "report": report.to_dict() if report else None,
+            "error": error,
+        }},
+        upsert=True
+    )
+
+
+def get_sync_status(status_collection) -> Optional[dict]:
+    return status_collection.find_one({"_id": SYNC_STATUS_ID})
@@ -0,0 +1,120 @@
+"""Per-update tracing and on-demand sampling profiler.
+
+While tracing is on, every handled update collects the time spent in MongoDB, Google Sheets and Telegram calls.
+Updates slower than the threshold are logged with the full breakdown. When tracing is off, the hooks return
+right after checking a module flag.
+"""
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+SEGMENTS = ("mongo", "sheets", "telegram")
+
+enabled = False
+slow_update_threshold = 1.0
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    __slots__ = ("update_id", "handler", "started", "durations", "counts")
+
+    def __init__(self, update_id: Optional[int], handler: str):
+        self.update_id = update_id
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.durations = dict.fromkeys(SEGMENTS, 0.0)
+        self.counts = dict.fromkeys(SEGMENTS, 0)
+
+
+def configure(tracing_enabled: bool, threshold: float):
+    global enabled, slow_update_threshold
+    enabled = tracing_enabled
+    slow_update_threshold = threshold
+
+
+def start_trace(update, handler: str) -> Optional[Trace]:
+    if not enabled:
+        return None
+    trace = Trace(getattr(update, "update_id", None), handler)
+    _current_trace.set(trace)
+    return trace
+
+
+def record_segment(segment: str, duration: float):
+    """Adds a MongoDB, Sheets or Telegram call duration to the trace of the update being handled."""
+    if not enabled:
+        return
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.durations[segment] += duration
+        trace.counts[segment] += 1
+
+
+def finish_trace(trace: Optional[Trace]):
+    if trace is None:
+        return
+    _current_trace.set(None)
+    total = time.perf_counter() - trace.started
+    if total < slow_update_threshold:
+        return
+    breakdown = " ".join(
+        f"{segment}={trace.durations[segment] * 1000:.1f}ms/{trace.counts[segment]}" for segment in SEGMENTS
+    )
+    other = total - sum(trace.durations.values())
+    logger.warning(
+        "Slow update %s handler=%s total=%.1fms %s other=%.1fms",
+        trace.update_id, trace.handler, total * 1000, breakdown, other * 1000
+    )
+
+
+class SamplingProfiler:
+    """Samples stacks of all threads at a fixed interval and writes them in the folded (flame graph) format."""
+
+    def __init__(self, output_dir: str, interval: float = 0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float) -> Optional[str]:
+        """Starts profiling in the background. Returns the output file path or None if already running."""
+        if self.running:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        self._thread = threading.Thread(target=self._run, args=(duration, path), name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return path
+
+    def _run(self, duration: float, path: str):
+        stacks = collections.Counter()
+        own_thread_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        with open(path, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        logger.info("Profile with %s samples is written to %s", sum(stacks.values()), path)
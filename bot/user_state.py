@@ -0,0 +1,120 @@
+"""Bounded per-user state of the bot.
+
+PTB keeps context.user_data of every user who ever sent an update, and the multi-step flows (/add_group, /join) leave
+their answers there when a user walks away. Flows clear their keys when they end, time out or are canceled, and
+UserStateLimiter keeps at most max_users entries: after every update it drops entries left empty, and when the
+limit is exceeded it evicts the least recently active users.
+"""
+import functools
+import logging
+from collections import OrderedDict
+from typing import Callable, Iterable, Set, Tuple
+
+from telegram import Update
+from telegram.ext import Application, ConversationHandler, ContextTypes, TypeHandler
+
+from bot.metrics import LIVE_CONVERSATIONS, USER_DATA_ENTRIES, USER_DATA_EVICTIONS
+
+logger = logging.getLogger(__name__)
+
+
+def clear_flow_data(application: Application, user_id: int, keys: Iterable[str]):
+    """Removes the answers of a flow, and the whole entry of the user once nothing else is kept."""
+    user_data = application.user_data.get(user_id)
+    if user_data is None:
+        return
+    for key in keys:
+        user_data.pop(key, None)
+    if not user_data:
+        application.drop_user_data(user_id)
+
+
+class UserStateLimiter:
+    """Caps the number of users with state kept in memory.
+
+    Entries are evicted in least recently active order. A flow in progress has seen an update within the
+    conversation timeout, so it is only evicted when more than max_users users were active since then.
+
+    Args:
+        max_users: Maximum number of user_data entries, 0 disables the limit.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._recent: OrderedDict = OrderedDict()
+
+    def attach(self, app: Application, first_group: int, last_group: int):
+        """Registers the handlers running before and after all other handlers of an update."""
+        app.add_handler(TypeHandler(Update, self.touch), group=first_group)
+        app.add_handler(TypeHandler(Update, self.release_empty), group=last_group)
+        USER_DATA_ENTRIES.set_function(lambda: len(app.user_data))
+
+    async def touch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None or not self.max_users:
+            return
+        self._recent[update.effective_user.id] = None
+        self._recent.move_to_end(update.effective_user.id)
+        while len(self._recent) > self.max_users:
+            user_id, _ = self._recent.popitem(last=False)
+            if user_id in context.application.user_data:
+                context.application.drop_user_data(user_id)
+                USER_DATA_EVICTIONS.inc()
+                logger.debug("Evicted state of user %s", user_id)
+
+    async def release_empty(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None:
+            return
+        user_id = update.effective_user.id
+        if user_id in context.application.user_data and not context.application.user_data[user_id]:
+            context.application.drop_user_data(user_id)
+            self._recent.pop(user_id, None)
+
+
+class ConversationCounter:
+    """Counts the live conversations of a ConversationHandler from the states its callbacks return.
+
+    A conversation is live from a callback returning a state until a callback returns ConversationHandler.END or the
+    conversation times out. Conversations are keyed by chat and user, like the handler keys them by default.
+    """
+
+    def __init__(self, name: str):
+        self._live: Set[Tuple[int, int]] = set()
+        LIVE_CONVERSATIONS.set_function(lambda: len(self._live), name)
+
+    @staticmethod
+    def _key(update: Update) -> Tuple[int, int]:
+        return update.effective_chat.id, update.effective_user.id
+
+    def track(self, callback: Callable) -> Callable:
+        """Wraps an entry point, state or fallback callback."""
+        @functools.wraps(callback)
+        async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            state = await callback(update, context)
+            if state == ConversationHandler.END:
+                self._live.discard(self._key(update))
+            elif state is not None:
+                self._live.add(self._key(update))
+            return state
+
+        return tracked
+
+    def track_timeout(self, callback: Callable) -> Callable:
+        """Wraps a ConversationHandler.TIMEOUT callback, the conversation ends whatever it returns."""
+        @functools.wraps(callback)
+        async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            self._live.discard(self._key(update))
+            return await callback(update, context)
+
+        return tracked
+
+
+def watch_conversations(handlers: Iterable[ConversationHandler]):
+    """Exports the number of live conversations of every named handler by wrapping its callbacks."""
+    for handler in handlers:
+        counter = ConversationCounter(handler.name)
+        for state, state_handlers in handler.states.items():
+            wrap = counter.track_timeout if state == ConversationHandler.TIMEOUT else counter.track
+            for state_handler in state_handlers:
+                state_handler.callback = wrap(state_handler.callback)
+        for step_handler in [*handler.entry_points, *handler.fallbacks]:
+            step_handler.callback = counter.track(step_handler.callback)
@@ -0,0 +1,63 @@
+"""Directory of current Telegram usernames.
+
+Every incoming update carries the sender's current username, so the directory is refreshed as users rename
+themselves. An in-process LRU remembers the last username written per user, which turns repeated updates from the
+same user into dictionary lookups and leaves only the first update after a start or a rename to hit the database.
+Usernames are stored lowercase in an indexed key, since Telegram usernames are case-insensitive.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+import pymongo
+from cachetools import LRUCache
+from telegram import User
+
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "10000"))
+
+_recorded_usernames = LRUCache(maxsize=USERNAME_CACHE_SIZE)
+
+
+def normalize_username(username: str) -> str:
+    return username.lstrip("@").lower()
+
+
+def ensure_indexes(usernames_collection):
+    usernames_collection.create_index([("username_key", pymongo.ASCENDING), ("updated_at", pymongo.DESCENDING)])
+
+
+def record_user(usernames_collection, user: Optional[User]) -> bool:
+    """Stores the current username of the user unless it is the one recorded last.
+
+    Returns:
+        bool: Whether the directory was written.
+    """
+    if user is None or user.is_bot:
+        return False
+    username = user.username
+    if _recorded_usernames.get(user.id, False) == username:
+        return False
+
+    usernames_collection.update_one(
+        {"_id": user.id},
+        {"$set": {
+            "username": username,
+            "username_key": normalize_username(username) if username else None,
+            "updated_at": datetime.now(timezone.utc),
+        }},
+        upsert=True
+    )
+    _recorded_usernames[user.id] = username
+    return True
+
+
+def find_user_id(usernames_collection, username: str) -> Optional[int]:
+    """Returns the id of the user currently known under the username.
+
+    A username released by one user and taken by another is matched to whoever was seen with it last.
+    """
+    entry = usernames_collection.find_one(
+        {"username_key": normalize_username(username)},
+        sort=[("updated_at", pymongo.DESCENDING)]
+    )
+    return entry["_id"] if entry else None
@@ -0,0 +1,137 @@
+"""Ordered registration positions of match players.
+
+Every registration takes the next position from a per-match counter. Positions only grow and are never reused, so
+concurrent registrations and cancellations can't hand out the same position twice. A cancellation leaves a gap: the
+counter keeps the number of removed positions in "removed" and the positions themselves, sorted, in
+"removed_positions". The place of a player in the list is their rank, the position minus the removed positions before
+it, found by a binary search in the counter. The first slot-count ranks are the players, the rest is the waiting list
+in order. Lookups go through the (group_id, match_date, position) index.
+"""
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pymongo
+from pymongo import ReturnDocument
+
+
+def ensure_indexes(matches_collection, counters_collection):
+    matches_collection.create_index(
+        [("group_id", pymongo.ASCENDING), ("match_date", pymongo.ASCENDING), ("position", pymongo.ASCENDING)]
+    )
+    # One registration per player and match, concurrent registrations of the same player fail with DuplicateKeyError
+    matches_collection.create_index(
+        [("group_id", pymongo.ASCENDING), ("match_date", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)],
+        unique=True
+    )
+    counters_collection.create_index(
+        [("group_id", pymongo.ASCENDING), ("match_date", pymongo.ASCENDING)], unique=True
+    )
+
+
+def reserve_position(counters_collection, group_id: str, match_date, count: int = 1) -> Tuple[int, int]:
+    """Atomically takes the next registration position of the match, or a block of count positions.
+
+    Returns:
+        tuple: The first reserved position and its rank, as long as every reserved position gets stored.
+    """
+    counter = counters_collection.find_one_and_update(
+        {"group_id": group_id, "match_date": match_date},
+        {"$inc": {"last_position": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    first_position = counter["last_position"] - count + 1
+    return first_position, first_position - counter.get("removed", 0)
+
+
+def release_positions(counters_collection, group_id: str, match_date, positions: List[int]):
+    """Records reserved or stored positions that no longer hold a registration, in one update of the counter."""
+    counters_collection.update_one(
+        {"group_id": group_id, "match_date": match_date},
+        {"$inc": {"removed": len(positions)}, "$push": {"removed_positions": {"$each": positions, "$sort": 1}}}
+    )
+
+
+# Returned by remove_registration when a concurrent cancellation deleted the registration first
+ALREADY_REMOVED = {}
+
+
+def remove_registration(matches_collection, counters_collection, match: dict, slot_count: int) -> Optional[dict]:
+    """Deletes the registration, the players behind it move one rank up.
+
+    Args:
+        match: The registration to delete.
+        slot_count: Number of players the courts fit.
+
+    Returns:
+        dict: The registration promoted from the waiting list to the last slot, or None. ALREADY_REMOVED if the
+        registration was gone already, nothing was changed then.
+    """
+    if not matches_collection.delete_one({"_id": match["_id"]}).deleted_count:
+        return ALREADY_REMOVED
+    position = match.get("position")
+    if position is None:
+        # Registered before positions were introduced, see backfill_positions
+        return None
+
+    match_query = {"group_id": match["group_id"], "match_date": match["match_date"]}
+    release_positions(counters_collection, match["group_id"], match["match_date"], [position])
+    if slot_count < 1:
+        return None
+    last_slot = next(iter(
+        matches_collection.find(match_query).sort("position", pymongo.ASCENDING).skip(slot_count - 1).limit(1)
+    ), None)
+    # The registration now holding the last slot was on the waiting list if it registered after the canceled player
+    if last_slot is None or last_slot.get("position", 0) < position:
+        return None
+    return last_slot
+
+
+def find_counters(counters_collection, matches: Iterable[dict]) -> Dict[Tuple, dict]:
+    """Loads the counters of the registrations' matches with one query, keyed by (group_id, match_date)."""
+    matches = list(matches)
+    if not matches:
+        return {}
+    counters = counters_collection.find({
+        "group_id": {"$in": list({match["group_id"] for match in matches})},
+        "match_date": {"$in": list({match["match_date"] for match in matches})},
+    })
+    return {(counter["group_id"], counter["match_date"]): counter for counter in counters}
+
+
+def get_rank(counter: dict, position: int) -> int:
+    """Returns the 1-based place of the position in the list of its match, in O(log n) of the cancellations."""
+    return position - bisect_left(counter.get("removed_positions", []), position)
+
+
+def get_waiting_number(rank: int, slot_count: int) -> Optional[int]:
+    """Returns the 1-based waiting list number for the rank or None when the player has a slot."""
+    return rank - slot_count if rank > slot_count else None
+
+
+def backfill_positions(matches_collection, counters_collection) -> int:
+    """Numbers registrations without a position in the order of registration and resets the match counters.
+
+    Returns:
+        int: Number of matches (group and date pairs) renumbered.
+    """
+    match_dates = matches_collection.distinct("match_date", {"position": None})
+    renumbered = 0
+    for match_date in match_dates:
+        for group_id in matches_collection.distinct("group_id", {"match_date": match_date, "position": None}):
+            match_query = {"group_id": group_id, "match_date": match_date}
+            registrations = matches_collection.find(match_query).sort(
+                [("position", pymongo.ASCENDING), ("registered_at", pymongo.ASCENDING)]
+            )
+            requests = [
+                pymongo.UpdateOne({"_id": registration["_id"]}, {"$set": {"position": position}})
+                for position, registration in enumerate(registrations, start=1)
+            ]
+            if requests:
+                matches_collection.bulk_write(requests, ordered=False)
+            counters_collection.update_one(
+                match_query, {"$set": {"last_position": len(requests), "removed": 0, "removed_positions": []}},
+                upsert=True
+            )
+            renumbered += 1
+    return renumbered
@@ -1,51 +1,142 @@
 import logging
 import os
 
-import gspread
 import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from datetime import datetime, timedelta, timezone
 from telegram import Update, ChatMember, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.constants import ChatAction
-from telegram.error import BadRequest
+from telegram.error import BadRequest, TelegramError
+from telegram.request import BaseRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters, ChatMemberHandler,
-    CallbackQueryHandler
+    Application, ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters, ChatMemberHandler,
+    CallbackQueryHandler, TypeHandler, ApplicationHandlerStop
 )
 from dotenv import load_dotenv
-from pymongo import MongoClient
 import re
-from phonenumbers import parse, is_valid_number, NumberParseException
-from email_validator import validate_email, EmailNotValidError
-from bot.spreadsheet import is_spreadsheet_writable, has_worksheet_with_name, create_worksheet, update_group_worksheet, \
-    fetch_all_data_from_worksheet
-import json
+from typing import Awaitable, Callable
+from bot.a1 import rowcol_to_a1
+from bot.db import OPERATION_LISTING, OPERATION_REGISTRATION, OPERATION_SYNC, LazyDatabase, get_client
+from bot.backends import get_backend, RosterBackend, STORAGE_GOOGLE, FILE_STORAGES
+from bot.shadow import hash_columns, find_changed_columns, build_column_ranges
+from bot.sync_report import SyncReport
+from bot.export import EXPORT_CSV, EXPORT_FORMATS, ExportError, export_matches, \
+    ensure_indexes as ensure_export_indexes
+from bot.lease import Lease, LeaseLost, fenced, generate_owner_id
+from bot.sync_scheduler import SyncRunner, TRIGGER_CLI, TRIGGER_SCHEDULED, get_sync_status
+from bot.intake import RegistrationIntake, RegistrationRequest, find_group_cached, forget_group, \
+    is_active_member_cached
+from bot.occupancy import get_occupancy, record_freed, record_taken, upcoming_game_dates
+from bot.preconditions import check_registration, GROUP_NOT_FOUND, NOT_A_MEMBER, REGISTRATION_CLOSED, \
+    NOT_A_GAME_DAY, ALREADY_REGISTERED
+from bot.dedup import claim_update, ensure_indexes as ensure_processed_update_indexes
+from bot.usernames import find_user_id, record_user, ensure_indexes as ensure_username_indexes
+from bot.membership import add_membership, find_active_groups, find_membership, new_membership, \
+    active_member_query, migrate_member_groups, ensure_indexes as ensure_membership_indexes
+from bot.group_stats import count_upcoming_registrations, get_stats, record_cancellation, record_registrations, \
+    record_replacement, rebuild_stats, ensure_indexes as ensure_stats_indexes
+from bot.user_state import UserStateLimiter, clear_flow_data, watch_conversations
+from bot.waitlist import ALREADY_REMOVED, ensure_indexes, reserve_position, release_positions, remove_registration, \
+    find_counters, get_rank, get_waiting_number, backfill_positions
+from bot import tracing
+from bot.logging_setup import setup_logging, bind_update_context
+from bot.metrics import InstrumentedHTTPXRequest, HANDLER_ERRORS, instrument_application, \
+    start_metrics_server
 import argparse
+import asyncio
+import json
+import signal
+import sys
+import threading
 
 
 # Load environment variables
 LAST_WEEK_DAY_NUMBER = 6
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-MONGO_URI = os.getenv("MONGO_URI")
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Telegram user IDs allowed to use diagnostic commands
+OPERATOR_IDS = {int(operator_id) for operator_id in os.getenv("OPERATOR_IDS", "").split(",") if operator_id.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 600
+# Queue /register_game requests and store them in batches, for registration-open spikes
+REGISTRATION_INTAKE = os.getenv("REGISTRATION_INTAKE", "0") == "1"
+INTAKE_BATCH_SIZE = int(os.getenv("INTAKE_BATCH_SIZE", "100"))
+INTAKE_BATCH_WAIT_MS = int(os.getenv("INTAKE_BATCH_WAIT_MS", "50"))
+# Number of updates handled at the same time, 1 keeps the strictly sequential processing
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+# Spreadsheet sync inside the bot process, every SYNC_INTERVAL_SECONDS (0 disables it) plus a random jitter
+SYNC_INTERVAL_SECONDS = int(os.getenv("SYNC_INTERVAL_SECONDS", "0"))
+SYNC_JITTER_SECONDS = int(os.getenv("SYNC_JITTER_SECONDS", "30"))
+SYNC_FIRST_RUN_DELAY_SECONDS = 60
+SYNC_JOB_NAME = "sync_spreadsheet"
+# Replicas elect the one running the scheduled sync through a lease, taken over this long after the holder died
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "15"))
+REPLICA_ID = os.getenv("REPLICA_ID") or generate_owner_id()
+SYNC_LEASE_NAME = "spreadsheet_sync"
+# /group_stats shows this many most active players and latest match days
+STATS_TOP_PLAYERS = 5
+STATS_MATCH_DAYS = 8
+# MongoDB error code of a unique index violation, as reported per row by bulk writes
+DUPLICATE_KEY_ERROR = 11000
+# Exports are built in worker threads, at most this many at a time
+MAX_CONCURRENT_EXPORTS = 2
+# /add_group and /join end when the user doesn't answer for this long
+CONVERSATION_TIMEOUT_SECONDS = int(os.getenv("CONVERSATION_TIMEOUT_SECONDS", "900"))
+# Users whose state is kept in memory, the least recently active are evicted first (0 keeps everyone)
+USER_STATE_CACHE_SIZE = int(os.getenv("USER_STATE_CACHE_SIZE", "10000"))
 
 # Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+setup_logging(
+    os.getenv("LOG_LEVEL", "INFO"),
+    os.getenv("LOG_FORMAT", "json"),
+    float(os.getenv("LOG_INFO_SAMPLE_RATE", "1.0"))
 )
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
+# Every conversation step schedules a timeout job
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client["padel_bot"]
+# MongoDB collections, the connection is made on the first query
+db = LazyDatabase()
 admins_collection = db["admins"]
 groups_collection = db["groups"]
-members_collection = db["members"]
-member_group_collection = db["member_groups"]
-matches_collection = db['matches']
+members_collection = db.get_collection("members", OPERATION_REGISTRATION)
+# Memberships are embedded in members, the collection is only read by migrate_memberships
+member_group_collection = db.get_collection("member_groups", OPERATION_REGISTRATION)
+matches_collection = db.get_collection("matches", OPERATION_REGISTRATION)
+worksheet_snapshots_collection = db['worksheet_snapshots']
+match_counters_collection = db.get_collection("match_counters", OPERATION_REGISTRATION)
+usernames_collection = db["usernames"]
+processed_updates_collection = db["processed_updates"]
+sync_status_collection = db["sync_status"]
+group_stats_collection = db["group_stats"]
+leases_collection = db["leases"]
+match_cancellations_collection = db["match_cancellations"]
+# Read-only views for admin listings, which may be served by secondaries. A player's own registrations are read
+# from the primary, so they show up right after the player made them
+groups_listing_collection = db.get_collection("groups", OPERATION_LISTING)
+members_listing_collection = db.get_collection("members", OPERATION_LISTING)
+matches_listing_collection = db.get_collection("matches", OPERATION_LISTING)
+groups_sync_collection = db.get_collection("groups", OPERATION_SYNC)
+members_sync_collection = db.get_collection("members", OPERATION_SYNC)
+matches_sync_collection = db.get_collection("matches", OPERATION_SYNC)
 
 # Global variables
+export_slots = asyncio.Semaphore(MAX_CONCURRENT_EXPORTS)
+sync_lease = Lease(leases_collection, SYNC_LEASE_NAME, REPLICA_ID, LEASE_TTL_SECONDS)
+
+
+def group_sync_lease(group_id: str, owner: str) -> Lease:
+    """Returns the lease of one group's sync shard. It is held only while the group's worksheet is synced."""
+    return Lease(leases_collection, f"{SYNC_LEASE_NAME}:{group_id}", owner, LEASE_TTL_SECONDS)
+profiler = tracing.SamplingProfiler(PROFILE_DIR)
+tracing.configure(
+    os.getenv("TRACE_UPDATES", "") == "1",
+    float(os.getenv("SLOW_UPDATE_THRESHOLD_MS", "1000")) / 1000
+)
 
 # Mapping of the week day
 weekDaysMapping = ("Monday", "Tuesday",
@@ -53,6 +144,10 @@ weekDaysMapping = ("Monday", "Tuesday",
                    "Friday", "Saturday",
                    "Sunday")
 CHAT_TYPE_PRIVATE = "private"
+# Worksheet layouts: a column for every day in the period or for game days only
+SHEET_LAYOUT_FULL = "full"
+SHEET_LAYOUT_COMPACT = "compact"
+SHEET_LAYOUTS = (SHEET_LAYOUT_FULL, SHEET_LAYOUT_COMPACT)
 
 
 # Helper function to check if a user is an admin
@@ -191,12 +286,12 @@ async def receive_group_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         chat_member = await context.bot.get_chat_member(context.user_data['group_id'], user_id)
     except BadRequest:
-        # TODO: Make a flash context for errors - user data should disappear on errors.
-        context.user_data.clear()
+        clear_flow_data(context.application, user_id, ADD_GROUP_KEYS)
         await update.message.reply_text("Cannot get chat from Telegram.")
         return ConversationHandler.END
 
     if chat_member.status not in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]:
+        clear_flow_data(context.application, user_id, ADD_GROUP_KEYS)
         await update.message.reply_text("You must be an admin of this group to add it.")
         return ConversationHandler.END
 
@@ -230,18 +325,28 @@ async def receive_weekday(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def receive_week_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['week_range'] = update.message.text
-    await update.message.reply_text("Awesome! Now, please share the Google Spreadsheet link.")
+    await update.message.reply_text(
+        "Awesome! Now, please share the Google Spreadsheet link.\n"
+        + "If you don't want to use Google Sheets, type 'csv' or 'xlsx' to keep the schedule in files."
+    )
     return SPREADSHEET_LINK
 
 
 async def receive_spreadsheet_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    spreadsheet_url = update.message.text
+    spreadsheet_url = update.message.text.strip()
+    if spreadsheet_url.lower() in FILE_STORAGES:
+        # File storages keep worksheets under the group ID
+        context.user_data['storage'] = spreadsheet_url.lower()
+        context.user_data['spreadsheet'] = str(context.user_data['group_id'])
+        await update.message.reply_text("Finally, how many courts are available?")
+        return COURT_LIMIT
     await update.message.reply_text("Give me a second, I will check if I can access the given spreadsheet...")
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    if not is_spreadsheet_writable(spreadsheet_url):
+    if not get_backend({"storage": STORAGE_GOOGLE}).is_writable(spreadsheet_url):
         await send_not_available_spreadsheet_message(update.message)
         return SPREADSHEET_LINK
-    context.user_data['spreadsheet'] = update.message.text
+    context.user_data['storage'] = STORAGE_GOOGLE
+    context.user_data['spreadsheet'] = spreadsheet_url
     await update.message.reply_text("Finally, how many courts are available?")
     return COURT_LIMIT
 
@@ -262,19 +367,23 @@ async def receive_court_limit(update: Update, context: ContextTypes.DEFAULT_TYPE
     open_till = now_date + timedelta(weeks=week_range)  # + timedelta(days=days_to_add)
 
     registration_open_till = datetime(day=open_till.day, month=open_till.month, year=open_till.year, tzinfo=timezone.utc)
-    groups_collection.insert_one({
+    group = {
         "group_id": group_id,
         "name": group_name,
         "spreadsheet": spreadsheet,
+        "storage": context.user_data['storage'],
         "court_limit": court_limit,
         "week_range": week_range,
         "admin_id": int(user_id),
         "deleted_at": None,
         "created_at": now,
         "registration_open_till": registration_open_till,
-        "game_day": weekday_number
-    })
+        "game_day": weekday_number,
+        "sheet_layout": SHEET_LAYOUT_FULL
+    }
+    groups_collection.insert_one(group)
     admins_collection.update_one({"admin_id": user_id}, {"$push": {"groups": group_id}})
+    clear_flow_data(context.application, user_id, ADD_GROUP_KEYS)
     await update.message.reply_text(
         f"🎉 Group *{group_name}* has been added successfully!\n"
         + f" Match registration is open till *{open_till.strftime('%d.%m.%Y')}*.",
@@ -288,37 +397,39 @@ async def receive_court_limit(update: Update, context: ContextTypes.DEFAULT_TYPE
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
     sheet_name = generate_worksheet_name('Americano', now, registration_open_till)
-    if has_worksheet_with_name(spreadsheet, sheet_name):
+    if get_backend(group).has_worksheet(spreadsheet, sheet_name):
         await update.message.reply_text(
             f"Worksheet with name '{sheet_name}' already exists."
         )
-        return
-    player_count = calculate_player_count_for_courts(court_limit)
+        return ConversationHandler.END
     days_in_period = (registration_open_till.date() - now_date).days
-    worksheet = create_worksheet(
-        spreadsheet,
-        sheet_name,
-        calculate_spreadsheet_row_count(player_count),
-        days_in_period
-    )
-    fill_spreadsheet_blank(days_in_period, weekday_number, now, player_count, worksheet)
+    worksheet_link = create_period_worksheet(group, sheet_name, now, days_in_period)
     await update.message.reply_text(
         "Done!\nYou can check out the spreadsheet if your schedule looks correct: "
-        + f"{worksheet.url}"
+        + f"{worksheet_link}"
     )
 
     return ConversationHandler.END
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_flow_data(context.application, update.effective_user.id, ADD_GROUP_KEYS)
     await update.message.reply_text("Group addition canceled.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
+async def add_group_timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_flow_data(context.application, update.effective_user.id, ADD_GROUP_KEYS)
+    await context.bot.send_message(
+        update.effective_chat.id, "⏳ Group addition timed out. Use /add_group to start again.",
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+
 # Command: /list_groups
 async def list_admin_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    groups = groups_collection.find({"admin_id": user_id, "deleted_at": None})
+    groups = groups_listing_collection.find({"admin_id": user_id, "deleted_at": None})
     response = "Your groups:\n"
     for group in groups:
         response += f"- {group['name']} (ID: {group['group_id']})\n"
@@ -338,6 +449,7 @@ async def delete_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         {"$set": {"deleted_at": datetime.now(timezone.utc)}}
     )
     if result.modified_count > 0:
+        forget_group(str(group_id))
         await update.message.reply_text(f"Group {group_id} has been soft deleted.")
     else:
         await update.message.reply_text("Group not found or you don't have permission to delete it.")
@@ -351,12 +463,12 @@ async def update_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     group_id, new_spreadsheet_link = context.args
-    if not is_spreadsheet_writable(new_spreadsheet_link):
+    if not get_backend({"storage": STORAGE_GOOGLE}).is_writable(new_spreadsheet_link):
         await send_not_available_spreadsheet_message(update.message)
         return
     result = groups_collection.update_one(
         {"group_id": str(group_id), "admin_id": user_id},
-        {"$set": {"spreadsheet": new_spreadsheet_link}}
+        {"$set": {"spreadsheet": new_spreadsheet_link, "storage": STORAGE_GOOGLE}}
     )
     if result.modified_count > 0:
         await update.message.reply_text(f"Spreadsheet link for group {group_id} has been updated.")
@@ -364,6 +476,217 @@ async def update_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Group not found or you don't have permission to update it.")
 
 
+# Command: /set_sheet_layout <group_id> <full|compact>
+async def set_sheet_layout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if len(context.args) != 2 or context.args[1] not in SHEET_LAYOUTS:
+        await update.message.reply_text(
+            "Usage: /set_sheet_layout <group_id> <full|compact>\n"
+            + "full - a column for every day of the registration period.\n"
+            + "compact - columns for match days only."
+        )
+        return
+
+    group_id, layout = context.args
+    result = groups_collection.update_one(
+        {"group_id": str(group_id), "admin_id": user_id, "deleted_at": None},
+        {"$set": {"sheet_layout": layout}}
+    )
+    if result.matched_count > 0:
+        await update.message.reply_text(
+            f"Worksheet layout for group {group_id} is set to '{layout}'. "
+            + "It will be used starting from the next registration period."
+        )
+    else:
+        await update.message.reply_text("Group not found or you don't have permission to update it.")
+
+
+# Command: /set_template <group_id> [worksheet name]
+async def set_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if len(context.args) < 1:
+        await update.message.reply_text(
+            "Usage: /set_template <group_id> <worksheet name>\n"
+            + "New registration periods will be created as copies of the given worksheet, "
+            + "only the weekday and date headers (rows 1-2) are filled in by the bot.\n"
+            + "Use /set_template <group_id> without a name to stop using the template."
+        )
+        return
+
+    group_id = str(context.args[0])
+    template_name = " ".join(context.args[1:]).strip() or None
+    group = groups_collection.find_one({"group_id": group_id, "admin_id": user_id, "deleted_at": None})
+    if not group:
+        await update.message.reply_text("Group not found or you don't have permission to update it.")
+        return
+    if template_name and not get_backend(group).has_worksheet(group["spreadsheet"], template_name):
+        await update.message.reply_text(f"Worksheet '{template_name}' not found in the group spreadsheet.")
+        return
+
+    groups_collection.update_one({"_id": group["_id"]}, {"$set": {"template_worksheet": template_name}})
+    if template_name:
+        await update.message.reply_text(f"Worksheet '{template_name}' will be used as a template for group {group_id}.")
+    else:
+        await update.message.reply_text(f"Group {group_id} will use generated worksheets.")
+
+
+# Command: /sync_status (admins and operators)
+async def sync_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    admin = admins_collection.find_one({"admin_id": user_id})
+    if not admin and not is_operator(update):
+        await update.message.reply_text("Only registered admins can see the spreadsheet sync status.")
+        return
+
+    jobs = context.job_queue.get_jobs_by_name(SYNC_JOB_NAME) if context.job_queue else ()
+    schedule = (
+        f"Scheduled every {SYNC_INTERVAL_SECONDS}s, next run at {jobs[0].next_t:%d.%m.%Y %H:%M:%S %Z}."
+        if jobs and jobs[0].next_t else "Scheduled sync is off."
+    )
+    status = get_sync_status(sync_status_collection)
+    if not status:
+        await update.message.reply_text(f"The spreadsheet has not been synced yet.\n{schedule}")
+        return
+
+    if status.get("running"):
+        response = f"A {status['trigger']} sync is running since {status['started_at']:%d.%m.%Y %H:%M:%S}.\n"
+    else:
+        response = (
+            f"Last {status['trigger']} sync: {status['status']}, "
+            + f"finished at {status['finished_at']:%d.%m.%Y %H:%M:%S} UTC"
+            + f" after {(status['finished_at'] - status['started_at']).total_seconds():.1f}s.\n"
+        )
+    report = status.get("report")
+    if report:
+        response += (
+            f"Synced: {len(report['groups_synced'])}, unchanged: {len(report['groups_unchanged'])}, "
+            + f"failed: {len(report['groups_failed'])}, cells changed: {report['cells_changed']}"
+            + ".\n"
+        )
+        # Admins only see the errors of their own groups
+        visible_groups = None if is_operator(update) else set(admin.get("groups", []))
+        for group_id, error in report["groups_failed"].items():
+            if visible_groups is None or group_id in visible_groups:
+                response += f"Group {group_id} failed: {error}\n"
+    if status.get("error"):
+        response += f"Error: {status['error']}\n"
+    if status.get("skipped_runs"):
+        response += f"Runs skipped while the previous one was running: {status['skipped_runs']}.\n"
+    await update.message.reply_text(response + schedule)
+
+
+# Command: /group_stats <group_id>
+async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if len(context.args) != 1:
+        await update.message.reply_text("Usage: /group_stats <group_id>")
+        return
+    group = groups_listing_collection.find_one({"group_id": str(context.args[0]), "admin_id": user_id, "deleted_at": None})
+    if not group:
+        await update.message.reply_text("Group not found or you don't have permission to see its statistics.")
+        return
+    stats = get_stats(group_stats_collection, group["group_id"])
+    if not stats or not stats.get("registrations"):
+        await update.message.reply_text(f"There are no registrations in group {group['name']} yet.")
+        return
+
+    registrations = stats["registrations"]
+    message = (
+        f"Statistics of group {group['name']}:\n"
+        + f"Registrations: {registrations}\n"
+        + f"Cancellations: {stats.get('cancellations', 0)} ({stats.get('cancellations', 0) / registrations:.0%})\n"
+        + f"Replacements: {stats.get('replacements', 0)} ({stats.get('replacements', 0) / registrations:.0%})\n"
+    )
+
+    # Registrations for matches yet to be played are kept in the counters too, they are not matches played
+    upcoming = count_upcoming_registrations(matches_listing_collection, group["group_id"], datetime.now(timezone.utc))
+
+    def played(player_id: str, counters: dict) -> int:
+        return (counters.get("registrations", 0) - counters.get("cancellations", 0) - counters.get("replaced", 0)
+                - upcoming.get(int(player_id), 0))
+
+    top_players = sorted(
+        ((int(player_id), played(player_id, counters)) for player_id, counters in stats.get("players", {}).items()),
+        key=lambda item: item[1], reverse=True
+    )
+    top_players = [(player_id, matches) for player_id, matches in top_players[:STATS_TOP_PLAYERS] if matches > 0]
+    if top_players:
+        names = {
+            member["user_id"]: f"{member['registration_name']} {member['registration_surname']}"
+            for member in members_listing_collection.find({"user_id": {"$in": [user_id for user_id, _ in top_players]}})
+        }
+        message += "\nMost active players:\n"
+        for place, (player_id, matches) in enumerate(top_players, start=1):
+            message += f"{place}. {names.get(player_id, player_id)} - {matches} match(es) played\n"
+
+    slot_count = calculate_player_count_for_courts(group["court_limit"])
+    match_days = sorted(stats.get("match_days", {}).items())[-STATS_MATCH_DAYS:]
+    if match_days and slot_count:
+        message += "\nFill rate by match day:\n"
+        for day, counters in match_days:
+            registered = counters.get("registered", 0)
+            message += (
+                f"- {datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m.%Y')}: "
+                + f"{min(registered, slot_count)}/{slot_count} ({min(registered, slot_count) / slot_count:.0%})"
+                + (f", {registered - slot_count} waiting" if registered > slot_count else "") + "\n"
+            )
+    await update.message.reply_text(message)
+
+
+# Command: /export <group_id> [from] [to] [csv|xlsx]
+async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    args = list(context.args)
+    export_format = EXPORT_CSV
+    if args and args[-1].lower() in EXPORT_FORMATS:
+        export_format = args.pop().lower()
+    if not 1 <= len(args) <= 3:
+        await update.message.reply_text(
+            "Usage: /export <group_id> [from DD.MM.YYYY] [to DD.MM.YYYY] [csv|xlsx]\n"
+            + "For example, /export -1263178999 01.01.2024 31.12.2024 xlsx"
+        )
+        return
+    try:
+        dates = [datetime.strptime(arg, "%d.%m.%Y").replace(tzinfo=timezone.utc) for arg in args[1:]]
+    except ValueError:
+        await update.message.reply_text("Invalid date format. Use DD.MM.YYYY. For example, 23.11.2023")
+        return
+    date_from, date_to = (dates + [None, None])[:2]
+
+    group = groups_collection.find_one({"group_id": str(args[0]), "admin_id": user_id, "deleted_at": None})
+    if not group:
+        await update.message.reply_text("Group not found or you don't have permission to export it.")
+        return
+
+    await update.message.reply_text("Preparing the export, the file will be sent to you in a private message.")
+    context.application.create_task(
+        send_export(context.bot, user_id, group, export_format, date_from, date_to), update=update
+    )
+
+
+async def send_export(bot, chat_id: int, group: dict, export_format: str, date_from: datetime, date_to: datetime):
+    async with export_slots:
+        try:
+            path, row_count = await asyncio.to_thread(
+                export_matches, matches_sync_collection, group, calculate_player_count_for_courts(group["court_limit"]),
+                export_format, date_from, date_to
+            )
+        except ExportError as error:
+            await bot.send_message(chat_id, str(error))
+            return
+    try:
+        if not row_count:
+            await bot.send_message(chat_id, f"No registrations found for group {group['name']} in this period.")
+            return
+        with open(path, "rb") as file:
+            await bot.send_document(
+                chat_id, document=file, filename=f"matches_{group['group_id']}.{export_format}",
+                caption=f"{row_count} registration(s) of group {group['name']}."
+            )
+    finally:
+        os.remove(path)
+
+
 # Command: /invite (Admin triggers this in the group)
 async def invite_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     group_id = update.effective_chat.id
@@ -389,7 +712,7 @@ async def check_admin_rights(update: Update, context: ContextTypes.DEFAULT_TYPE)
             user_id = update.chat_member.new_chat_member.user.id
             if not admins_collection.find_one({"admin_id": user_id}):
                 await context.bot.leave_chat(update.chat_member.chat.id)
-                logger.info(f"Bot left chat {update.chat_member.chat.id} because the adder was not a registered admin.")
+                logger.info("Bot left chat %s because the adder was not a registered admin.", update.chat_member.chat.id)
 
 
 # Open registration for the next period for the given group
@@ -422,7 +745,7 @@ async def open_match_registration(update: Update, context: ContextTypes.DEFAULT_
         return
     end_period = start_period + timedelta(weeks=group['week_range'])
     sheet_name = generate_worksheet_name('Americano', start_period, end_period)
-    if has_worksheet_with_name(group['spreadsheet'], sheet_name):
+    if get_backend(group).has_worksheet(group['spreadsheet'], sheet_name):
         await update.message.reply_text(f"Worksheet with name {sheet_name} already exists.")
         return
     await update.message.reply_text(
@@ -430,32 +753,28 @@ async def open_match_registration(update: Update, context: ContextTypes.DEFAULT_
         + " It will take a while. Please, wait...")
     # Create a new sheet
     days_in_next_period = (end_period - start_period).days
-    player_count = calculate_player_count_for_courts(group['court_limit'])
-    worksheet = create_worksheet(
-        group["spreadsheet"],
-        sheet_name,
-        calculate_spreadsheet_row_count(player_count),
-        days_in_next_period
-    )
-    fill_spreadsheet_blank(days_in_next_period, group['game_day'], start_period, player_count, worksheet)
+    worksheet_link = create_period_worksheet(group, sheet_name, start_period, days_in_next_period)
 
     groups_collection.update_one(
         {"group_id": group["group_id"], "admin_id": group["admin_id"]},
         {"$set": {"registration_open_till": end_period}}
     )
+    forget_group(group["group_id"])
     # Update registration_open_till in the group if everything succeeds
     await context.bot.send_message(
         chat_id=group_id,
         text=f"📢 Match registration is now open till {end_period.strftime('%d.%m.%Y')}\n Use /join_game to register for a game."
     )
     # Send the link to a new worksheet in the file
-    await update.message.reply_text(f"Worksheet URL: {worksheet.url}")
+    await update.message.reply_text(f"Worksheet URL: {worksheet_link}")
 
 # ================== MEMBER FUNCTIONS ============================
 
 
 # Conversation states for /join
 NAME, SURNAME, PHONE, EMAIL = range(4)
+# user_data keys of the /join answers
+JOIN_KEYS = ("group_id", "name", "surname", "phone", "email")
 
 
 # Start /join <group_id>
@@ -468,10 +787,8 @@ async def start_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.delete_message()
         message = update.callback_query.message
     user_id = update.effective_user.id
-    try:
-        group_id = context.user_data["group_id"] if context.user_data else context.args[0]
-    except IndexError:
-        group_id = None
+    # An explicit /join argument wins over the group remembered from a /start link
+    group_id = context.args[0] if context.args else context.user_data.pop("group_id", None)
     if group_id is None:
         await message.reply_text("Usage: /join group_id")
         return ConversationHandler.END
@@ -479,7 +796,6 @@ async def start_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if group_id.find("join_") == 0:
         group_id = group_id.split("_")[1]
     group_id = str(group_id)
-    context.user_data['group_id'] = group_id
 
     if not is_private_chat(update):
         join_link = await generate_join_link(update, context)
@@ -498,8 +814,6 @@ async def start_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if member is not None:
         admin = admins_collection.find_one({"groups": str(group_id)})
         if not admin:
-            # In case there was an error, we need to restart
-            context.user_data = {}
             await message.reply_text(
                 f"I cannot find the group you want to register in. Here is the group ID: *{group_id}*\n"
                 + "Please, contact the group administrator.",
@@ -507,18 +821,13 @@ async def start_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
 
-        member_group_record = member_group_collection.find_one({"user_id": user_id, "group_id": group_id})
-        if member_group_record is not None:
+        if find_membership(member, group_id) is not None or not add_membership(members_collection, user_id, group_id):
             await message.reply_text("You are already registered in this group.")
             return ConversationHandler.END
-        member_group_collection.insert_one({
-            "user_id": user_id,
-            "group_id": group_id,
-            "status": "active"
-        })
         await message.reply_text("You are successfully registered!")
         return ConversationHandler.END
 
+    context.user_data['group_id'] = group_id
     await message.reply_text(
         "Welcome! Let's get you registered.\nPlease enter your *Name* (at least 3 letters):",
         parse_mode='Markdown'
@@ -552,6 +861,7 @@ async def get_surname(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Validate Phone Number
 async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from phonenumbers import parse, is_valid_number, NumberParseException
     phone = update.message.text.strip()
     try:
         phone_obj = parse(phone)
@@ -567,6 +877,7 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Validate Optional Email
 async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from email_validator import validate_email, EmailNotValidError
     email = update.message.text.strip()
     if email.lower() != 'skip':
         try:
@@ -591,26 +902,23 @@ async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "messenger_last_name": user.last_name,
         "messenger_username": user.username,
         "created_at": datetime.now(timezone.utc),
+        "groups": [],
     }
-    members_collection.insert_one(member_data)
-    # Erase user data in case something went wrong to restart the whole process
-    context.user_data.clear()
+    # Erase the answers in case something went wrong to restart the whole process
+    clear_flow_data(context.application, user.id, JOIN_KEYS)
     admin = admins_collection.find_one({"groups": str(group_id)})
+    group = admin and groups_collection.find_one({"group_id": str(group_id), "admin_id": admin["admin_id"]})
+    if group:
+        # The membership is stored with the member, in the same write
+        member_data["groups"].append(new_membership(group_id))
+    members_collection.insert_one(member_data)
     if not admin:
         await update.message.reply_text("I cannot find the group you want to register in.")
         return ConversationHandler.END
-
-    group = groups_collection.find_one({"group_id": str(group_id), "admin_id": admin["admin_id"]})
     if not group:
         await update.message.reply_text("Admin deleted the group. Registration is not possible.")
         return ConversationHandler.END
 
-    member_group_collection.insert_one({
-        "user_id": user.id,
-        "group_id": group_id,
-        "status": "active"
-    })
-
     await update.message.reply_text("🎉 You have been registered successfully!")
 
     # Notify Admin
@@ -626,10 +934,16 @@ async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Cancel Handler
 async def cancel_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_flow_data(context.application, update.effective_user.id, JOIN_KEYS)
     await update.message.reply_text("Registration canceled.")
     return ConversationHandler.END
 
 
+async def join_timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_flow_data(context.application, update.effective_user.id, JOIN_KEYS)
+    await context.bot.send_message(update.effective_chat.id, "⏳ Registration timed out. Use /join to start again.")
+
+
 # Participation Command
 async def register_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -637,13 +951,17 @@ async def register_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info("[join_match] effective chat type: %s", update.effective_chat.type)
     if is_private_chat(update):
-        if len(args) < 2:
+        if not args:
             await update.message.reply_text(
-                "Usage in direct bot conversation: /register_game <group_id> <DD.MM.YYYY>\n"
-                + " For example, /register_game -1263178999 23.11.2023"
+                "Usage in direct bot conversation: /register_game <group_id> [DD.MM.YYYY]\n"
+                + " For example, /register_game -1263178999 23.11.2023\n"
+                + " Without a date, you can pick one of the open match dates."
             )
             return
         group_query = {"$or": [{"group_id": str(args[0])}, {"name": str(args[0])}]}
+        if len(args) < 2:
+            await show_date_picker(update.message, user_id, group_query)
+            return
         try:
             match_date = datetime.strptime(args[1], "%d.%m.%Y").replace(tzinfo=timezone.utc)
         except ValueError:
@@ -651,69 +969,260 @@ async def register_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     else:
         group_query = {"group_id": str(update.effective_chat.id)}
-
+        if not args:
+            await show_date_picker(update.message, user_id, group_query)
+            return
         try:
             match_date = datetime.strptime(args[0], "%d.%m.%Y").replace(tzinfo=timezone.utc)
-        except (ValueError, IndexError):
+        except ValueError:
             await update.message.reply_text("Please specify a valid match date (DD.MM.YYYY). For example, 23.11.2023")
             return
 
-    logger.info("[join_match] query %s", json.dumps(group_query))
+    logger.info("[join_match] query %s", group_query)
+    await complete_registration(update.message.reply_text, user_id, group_query, match_date)
+
+
+async def complete_registration(reply: Callable[..., Awaitable], user_id: int, group_query: dict, match_date: datetime):
+    """Registers the user for the match date after checking the preconditions.
+
+    Args:
+        reply: Sends a message to the user and returns it, e.g. Message.reply_text.
+    """
     if match_date < datetime.now(timezone.utc):
-        await update.message.reply_text(f"You cannot register for matches in past.")
-        return
-    group = groups_collection.find_one({**group_query, "deleted_at": None})
-    if not group:
-        await update.message.reply_text(f"Group not found.")
+        await reply(f"You cannot register for matches in past.")
         return
-    member_groups = member_group_collection.find_one({
-        "user_id": user_id,
-        "group_id": group['group_id'],
-        "status": "active"
-    })
-    if member_groups is None:
-        await update.message.reply_text("You cannot join matches in this group. Please, contact the administrator.")
+    # Queued registrations are checked for duplicates by the batch writer
+    check = check_registration(
+        groups_collection, members_collection, matches_collection, group_query, user_id, match_date,
+        check_existing=not registration_intake.enabled
+    )
+    if not check.passed:
+        await reply(REGISTRATION_CHECK_MESSAGES[check.failure])
         return
-    if not group:
-        await update.message.reply_text("This group has been deleted or does not exist.")
+    group = check.group
+
+    if registration_intake.enabled:
+        request = RegistrationRequest(user_id, group, match_date)
+        accepted = registration_intake.submit(
+            request,
+            lambda: reply(
+                f"Your registration for {match_date.strftime('%d.%m.%Y')} is received. Confirming your place..."
+            )
+        )
+        if not accepted:
+            await reply("Your registration for the selected match date is already being processed.")
+            return
+        await request.acknowledgement
         return
 
-    if match_date > group['registration_open_till'].replace(tzinfo=timezone.utc):
-        await update.message.reply_text("Registration period has ended.")
+    position, rank = reserve_position(match_counters_collection, group['group_id'], match_date)
+    try:
+        matches_collection.insert_one({
+            "user_id": user_id,
+            "group_id": group['group_id'],
+            "match_date": match_date,
+            "position": position,
+            "registered_at": datetime.now(timezone.utc),
+        })
+    except DuplicateKeyError:
+        # A concurrent registration of the same player, e.g. a double tap in the date picker, was stored first
+        release_positions(match_counters_collection, group['group_id'], match_date, [position])
+        await reply(REGISTRATION_CHECK_MESSAGES[ALREADY_REGISTERED])
         return
+    # The newest registration's rank is the number of registrations of the match
+    record_taken(group['group_id'], match_date, rank)
+    count_registrations(group['group_id'], [(user_id, match_date)])
+    await reply(format_registration_result(match_date, rank, group['court_limit']), parse_mode='Markdown')
 
-    if match_date.weekday() != group['game_day']:
-        await update.message.reply_text("Matches are not scheduled for the selected date.")
-        return
 
-    existing = db.matches.find_one({"user_id": user_id, "group_id": group['group_id'], "match_date": match_date})
-    if existing:
-        await update.message.reply_text("You're already registered for the selected match date.")
+async def show_date_picker(message: Message, user_id: int, group_query: dict):
+    """Replies with a button for every open match date of the group, labeled with its free places."""
+    group = find_group_cached(groups_collection, {**group_query, "deleted_at": None})
+    if not group:
+        await message.reply_text(REGISTRATION_CHECK_MESSAGES[GROUP_NOT_FOUND])
         return
+    if not is_active_member_cached(members_collection, group["group_id"], user_id):
+        await message.reply_text(REGISTRATION_CHECK_MESSAGES[NOT_A_MEMBER])
+        return
+    match_dates = upcoming_game_dates(group, datetime.now(timezone.utc))
+    if not match_dates:
+        await message.reply_text(REGISTRATION_CHECK_MESSAGES[REGISTRATION_CLOSED])
+        return
+    taken = get_occupancy(match_counters_collection, group["group_id"], match_dates)
+    slot_count = calculate_player_count_for_courts(group["court_limit"])
+    buttons = []
+    for match_date in match_dates:
+        free = slot_count - taken[match_date]
+        places = f"{free} free" if free > 0 else f"waiting list #{1 - free}"
+        buttons.append([InlineKeyboardButton(
+            f"{match_date.strftime('%a %d.%m.%Y')} · {places}",
+            # The picker belongs to the player who asked for it, so a tap in a group chat registers nobody else
+            callback_data=f"{DATE_PICKER_PREFIX}:{group['group_id']}:{match_date.strftime('%d.%m.%Y')}:{user_id}"
+        )])
+    await message.reply_text(
+        f"Pick a match date in *{group['name']}*:", reply_markup=InlineKeyboardMarkup(buttons), parse_mode="Markdown"
+    )
 
-    registered_count = db.matches.count_documents({"group_id": group['group_id'], "match_date": match_date})
-    # TODO: Replace naive implementation of the registration number
-    db.matches.insert_one({
-        "user_id": user_id,
-        "group_id": group['group_id'],
-        "match_date": match_date,
-        "registered_at": datetime.now(timezone.utc),
-    })
-    max_slots = group['court_limit'] * 4
-    current_player_order_number = registered_count + 1
 
-    if registered_count >= max_slots:
-        await update.message.reply_text(
-            f"You are added to the waiting list for the match on *{match_date.strftime('%d.%m.%Y')}* with number {current_player_order_number}",
-            parse_mode='Markdown'
-        )
+async def register_from_picker(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, group_id, date_str, owner_id = query.data.split(":")
+    if int(owner_id) != update.effective_user.id:
+        await query.answer("This list is for another player. Use /register_game to get yours.", show_alert=True)
         return
+    await query.answer()
+    match_date = datetime.strptime(date_str, "%d.%m.%Y").replace(tzinfo=timezone.utc)
+    # The result replaces the picker
+    await complete_registration(query.edit_message_text, update.effective_user.id, {"group_id": group_id}, match_date)
 
-    await update.message.reply_text(
-        f"You are successfully registered for the match on {match_date.strftime('%d.%m.%Y')} as number {current_player_order_number} in the list!"
+
+DATE_PICKER_PREFIX = "register"
+
+
+REGISTRATION_CHECK_MESSAGES = {
+    GROUP_NOT_FOUND: "Group not found.",
+    NOT_A_MEMBER: "You cannot join matches in this group. Please, contact the administrator.",
+    REGISTRATION_CLOSED: "Registration period has ended.",
+    NOT_A_GAME_DAY: "Matches are not scheduled for the selected date.",
+    ALREADY_REGISTERED: "You're already registered for the selected match date.",
+}
+
+
+def format_registration_result(match_date: datetime, rank: int, court_limit: int) -> str:
+    waiting_number = get_waiting_number(rank, calculate_player_count_for_courts(court_limit))
+    if waiting_number:
+        return f"You are added to the waiting list for the match on *{match_date.strftime('%d.%m.%Y')}* with number {waiting_number}"
+    return f"You are successfully registered for the match on {match_date.strftime('%d.%m.%Y')} as number {rank} in the list!"
+
+
+def write_registration_batch(requests: list):
+    """Stores queued registrations with positions in queue order.
+
+    Players found registered already get no position, requests whose rows could not be stored are marked failed.
+    """
+    requests_by_match = {}
+    for request in requests:
+        requests_by_match.setdefault((request.group['group_id'], request.match_date), []).append(request)
+
+    now = datetime.now(timezone.utc)
+    operations = []
+    operation_requests = []
+    reservations = []
+    try:
+        for (group_id, match_date), match_requests in requests_by_match.items():
+            registered_user_ids = {
+                match["user_id"] for match in matches_collection.find(
+                    {"group_id": group_id, "match_date": match_date,
+                     "user_id": {"$in": [r.user_id for r in match_requests]}},
+                    {"user_id": 1}
+                )
+            }
+            accepted = [request for request in match_requests if request.user_id not in registered_user_ids]
+            if not accepted:
+                continue
+            first_position, first_rank = reserve_position(
+                match_counters_collection, group_id, match_date, len(accepted)
+            )
+            reservations.append((group_id, match_date, first_position, first_rank, accepted))
+            for offset, request in enumerate(accepted):
+                operation_requests.append(request)
+                operations.append(pymongo.InsertOne({
+                    "user_id": request.user_id,
+                    "group_id": group_id,
+                    "match_date": match_date,
+                    "position": first_position + offset,
+                    "registered_at": now,
+                }))
+    except Exception:
+        # Nothing is stored yet, the positions reserved for earlier matches of the batch are given back
+        for group_id, match_date, first_position, _, accepted in reservations:
+            reserved = list(range(first_position, first_position + len(accepted)))
+            release_positions(match_counters_collection, group_id, match_date, reserved)
+        raise
+
+    unstored = set()
+    if operations:
+        try:
+            matches_collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as error:
+            # Unordered writes store every other row, only the reported rows are missing
+            for write_error in error.details["writeErrors"]:
+                request = operation_requests[write_error["index"]]
+                unstored.add(request)
+                if write_error["code"] != DUPLICATE_KEY_ERROR:
+                    # A row registered by a concurrent /register_game between the lookup and the write is not a failure
+                    logger.error("Failed to store the registration of user %s: %s", request.user_id,
+                                 write_error.get("errmsg"))
+                    request.failed = True
+        except PyMongoError:
+            # The write may have been applied in part, the stored rows are found by their reserved positions
+            logger.exception("Failed to store %s registration(s), checking which were stored", len(operations))
+            for group_id, match_date, first_position, _, accepted in reservations:
+                reserved = range(first_position, first_position + len(accepted))
+                stored_positions = {
+                    match["position"] for match in matches_collection.find(
+                        {"group_id": group_id, "match_date": match_date, "position": {"$in": list(reserved)}},
+                        {"position": 1}
+                    )
+                }
+                for position, request in zip(reserved, accepted):
+                    if position not in stored_positions:
+                        unstored.add(request)
+                        request.failed = True
+    for group_id, match_date, first_position, first_rank, accepted in reservations:
+        stored = [request for request in accepted if request not in unstored]
+        # Stored rows keep their order, the tickets of missing rows are given back
+        for rank, request in enumerate(stored, start=first_rank):
+            request.position = rank
+        released = [first_position + offset for offset, request in enumerate(accepted) if request in unstored]
+        if released:
+            release_positions(match_counters_collection, group_id, match_date, released)
+
+    stored_by_group = {}
+    for request in requests:
+        if request.position is not None:
+            stored_by_group.setdefault(request.group['group_id'], []).append((request.user_id, request.match_date))
+    for group_id, registrations in stored_by_group.items():
+        count_registrations(group_id, registrations)
+
+
+def count_registrations(group_id: str, registrations: list):
+    """Updates the group statistics. The registrations are stored already, so a failure here is only logged."""
+    try:
+        record_registrations(group_stats_collection, group_id, registrations)
+    except Exception:
+        logger.exception("Failed to count %s registration(s) of group %s", len(registrations), group_id)
+
+
+async def confirm_queued_registration(request: RegistrationRequest):
+    if request.position is not None:
+        # Confirmations start in batch order, so the cache ends with the last position of every match
+        record_taken(request.group['group_id'], request.match_date, request.position)
+    acknowledgement = await request.acknowledgement
+    if request.position is None:
+        await acknowledgement.edit_text("You're already registered for the selected match date.")
+        return
+    await acknowledgement.edit_text(
+        format_registration_result(request.match_date, request.position, request.group['court_limit']),
+        parse_mode='Markdown'
     )
 
 
+async def reject_queued_registration(request: RegistrationRequest):
+    acknowledgement = await request.acknowledgement
+    await acknowledgement.edit_text("Registration failed. Please, try again.")
+
+
+registration_intake = RegistrationIntake(
+    write_registration_batch,
+    confirm_queued_registration,
+    reject_queued_registration,
+    INTAKE_BATCH_SIZE,
+    INTAKE_BATCH_WAIT_MS / 1000,
+    REGISTRATION_INTAKE
+)
+
+
 # Cancel Participation
 async def cancel_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_private_chat(update):
@@ -729,6 +1238,7 @@ async def cancel_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("Invalid date format. Use DD.MM.YYYY. For example, 21.11.2022")
         return
+    await registration_intake.wait_for_user(user_id)
     match = matches_collection.find_one({"user_id": user_id, "group_id": group_id, "match_date": match_date})
     if not match:
         await update.message.reply_text("You're not registered for any match.")
@@ -736,14 +1246,39 @@ async def cancel_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     time_diff = match['match_date'].replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)
     if time_diff.days >= 2:
-        matches_collection.delete_one({"_id": match['_id']})
+        group = groups_collection.find_one({"group_id": group_id})
+        slot_count = calculate_player_count_for_courts(group['court_limit']) if group else 0
+        promoted = remove_registration(matches_collection, match_counters_collection, match, slot_count)
+        if promoted is ALREADY_REMOVED:
+            # Canceled by a concurrent /cancel_game of the same player, which counts and reports it
+            await update.message.reply_text("You're not registered for any match.")
+            return
+        if match.get("position") is not None:
+            # Only numbered registrations are counted in the occupancy, see remove_registration
+            record_freed(group_id, match['match_date'])
+        record_cancellation(group_stats_collection, match_cancellations_collection, match, datetime.now(timezone.utc))
         await update.message.reply_text("Your participation has been canceled.")
+        if promoted:
+            context.application.create_task(
+                notify_promoted_player(context.bot, promoted['user_id'], match['match_date']), update=update
+            )
     else:
         await update.message.reply_text(
             "It's less than 48 hours till the game. Please provide a replacement using /replace_player"
         )
 
 
+async def notify_promoted_player(bot, user_id: int, match_date: datetime):
+    try:
+        await bot.send_message(
+            user_id,
+            f"A place opened up for the match on {match_date.strftime('%d.%m.%Y')}. "
+            + "You are moved from the waiting list to the players!"
+        )
+    except TelegramError as error:
+        logger.warning("Could not notify promoted player %s: %s", user_id, error)
+
+
 # Replace Player Command
 async def replace_player(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # TODO: Replace with conversation
@@ -762,6 +1297,7 @@ async def replace_player(update: Update, context: ContextTypes.DEFAULT_TYPE):
     group = groups_collection.find_one(group_search_criteria)
     if not group:
         await update.message.reply_text(f"Group '{group_id_or_name}' not found. Contact administrator.")
+        return
 
     if not re.match(r'@\w+', username):
         await update.message.reply_text("Invalid username format. Use @username")
@@ -773,27 +1309,36 @@ async def replace_player(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid date format. Use DD.MM.YYYY. For example, 21.11.2022")
         return
 
-    member = members_collection.find_one({"messenger_username": username.strip('@')})
-    if not member:
+    replacement_user_id = find_user_id(usernames_collection, username)
+    if replacement_user_id is None:
+        # Not seen since the directory was introduced, fall back to the username given at registration
+        member = members_collection.find_one({"messenger_username": username.strip('@')})
+        replacement_user_id = member["user_id"] if member else None
+    if replacement_user_id is None or not members_collection.find_one(
+            {"user_id": replacement_user_id, **active_member_query(group["group_id"])}, {"_id": 1}):
         await update.message.reply_text("Group member for replacement not found.")
         return
 
-    if matches_collection.find_one({"match_date": match_date, "user_id": member["user_id"], "group_id": group["group_id"]}):
+    if matches_collection.find_one({"match_date": match_date, "user_id": replacement_user_id, "group_id": group["group_id"]}):
         await update.message.reply_text("The specified member is already registered for this match date.")
         return
 
-    existing_match = db.matches.find_one({"match_date": match_date, "user_id": update.effective_user.id, "group_id": group["group_id"]})
+    existing_match = matches_collection.find_one({"match_date": match_date, "user_id": update.effective_user.id, "group_id": group["group_id"]})
     if not existing_match:
         await update.message.reply_text("You are not registered for this match date.")
         return
 
+    replaced_at = datetime.now(timezone.utc)
     matches_collection.update_one(
         {"_id": existing_match['_id']},
-        {"$set": {"user_id": member["user_id"], "registered_at": datetime.now(timezone.utc)}}
+        {"$set": {"user_id": replacement_user_id, "registered_at": replaced_at}}
+    )
+    record_replacement(
+        group_stats_collection, match_cancellations_collection, existing_match, replacement_user_id, replaced_at
     )
     await update.message.reply_text(f"Replacement successful! {username} will now play on {date_str}.")
     await context.bot.send_message(
-        member['user_id'],
+        replacement_user_id,
         f"You have been added to the match on {date_str} by {update.effective_user.username}!\n"
         + " Use /cancel_game if you want to cancel your participation."
     )
@@ -803,28 +1348,36 @@ async def replace_player(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def list_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Check if player participates in more than one group.
         user_id = update.effective_user.id
-        member_groups = member_group_collection.find({"user_id": user_id, "status": "active"})
-        group_ids = []
-        for member_group in member_groups:
-            group_ids.append(member_group["group_id"])
-        groups = groups_collection.find({"group_id": {"$in": group_ids}})
+        await registration_intake.wait_for_user(user_id)
+        groups = find_active_groups(members_collection, user_id)
+        group_ids = [group["group_id"] for group in groups]
         now = datetime.now(timezone.utc)
         matches = matches_collection.find(
             {"group_id": {"$in": group_ids}, "user_id": user_id, "match_date": {"$gte": now}}
         ).sort("match_date", pymongo.ASCENDING)
-        group_names_by_id = {}
+        groups_by_id = {}
         for group in groups:
-            group_names_by_id[group["group_id"]] = group["name"]
+            groups_by_id[group["group_id"]] = group
         matches_by_group = {}
         for match in matches:
-            matches_by_group[group_names_by_id[match["group_id"]]] = {"match_date": match["match_date"]}
+            matches_by_group.setdefault(match["group_id"], []).append(match)
+        counters = find_counters(
+            match_counters_collection, [match for group_matches in matches_by_group.values() for match in group_matches]
+        )
 
         message = "Here is the list of your matches by group:\n"
-        for group_name in matches_by_group:
-            message = message + f"{group_name}\n"
-            for match_formatted in matches_by_group[group_name]:
-                message = message + match_formatted['match_date']
-        else:
+        for group_id in matches_by_group:
+            group = groups_by_id[group_id]
+            message = message + f"{group['name']}\n"
+            slot_count = calculate_player_count_for_courts(group["court_limit"])
+            for match in matches_by_group[group_id]:
+                message = message + f"- {match['match_date'].strftime('%d.%m.%Y')}"
+                if match.get("position"):
+                    rank = get_rank(counters[(match["group_id"], match["match_date"])], match["position"])
+                    waiting_number = get_waiting_number(rank, slot_count)
+                    message = message + (f" (waiting list #{waiting_number})" if waiting_number else f" (#{rank})")
+                message = message + "\n"
+        if not matches_by_group:
             message = message + "\nYou have no registered games"
         await update.message.reply_text(message, parse_mode="Markdown")
 
@@ -837,7 +1390,11 @@ async def issue_1_million_dollars(update: Update, context: ContextTypes.DEFAULT_
 # ========== UTILS =====================
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(msg=f"Exception while handling an update: {update}", exc_info=context.error)
+    HANDLER_ERRORS.inc(type(context.error).__name__)
+    logger.error(
+        "Exception while handling update %s", update.update_id if isinstance(update, Update) else update,
+        exc_info=context.error
+    )
     if update and update.message:
         await update.message.reply_text("An error occurred. Please try again later.")
 
@@ -854,11 +1411,16 @@ async def help_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             + "/list\_admin\_groups - to see your registered groups in this bot.\n"
             + "/delete\_group - to delete one of the registered groups in this bot.\n"
             + "/update\_sheet - to update the spreadsheet link for one of the groups.\n"
+            + "/set\_sheet\_layout - to choose between full and compact (match days only) worksheet layout.\n"
+            + "/set\_template - to create new worksheets as copies of a formatted template worksheet.\n"
             + "/invite - Invite new members to go through registration process.\n"
             + "/open\_match\_registration - Open the match registration window for the next period.\n"
+            + "/sync\_status - to see the result of the last spreadsheet sync.\n"
+            + "/group\_stats - to see attendance statistics of a group.\n"
+            + "/export - to download the match history of a group as a CSV or XLSX file.\n"
             + "*Member commands:*\n"
             + "/join - to join the group as a member.\n"
-            + "/register\_game - to register for a game.\n"
+            + "/register\_game - to register for a game, without a date to pick one of the open dates.\n"
             + "/cancel\_game - to cancel game participation.\n"
             + "/replace\_player - to replace your participation with other players.\n"
             + "/list\_matches - list player future games.\n"
@@ -869,6 +1431,61 @@ async def help_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def is_operator(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id in OPERATOR_IDS
+
+
+# Command: /profile [seconds] (operators only)
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_operator(update):
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else DEFAULT_PROFILE_SECONDS
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds]")
+        return
+    seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+    path = profiler.start(seconds)
+    if path is None:
+        await update.message.reply_text("Profiling is already running.")
+        return
+    await update.message.reply_text(f"Profiling for {seconds}s. The profile will be written to {path}")
+
+
+# Command: /trace <on|off> [slow update threshold in ms] (operators only)
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_operator(update):
+        return
+    if not context.args or context.args[0] not in ("on", "off"):
+        await update.message.reply_text(
+            f"Tracing is {'on' if tracing.enabled else 'off'}, "
+            + f"slow update threshold is {tracing.slow_update_threshold * 1000:.0f}ms.\n"
+            + "Usage: /trace <on|off> [threshold_ms]"
+        )
+        return
+    threshold = tracing.slow_update_threshold
+    if len(context.args) > 1:
+        try:
+            threshold = float(context.args[1]) / 1000
+        except ValueError:
+            await update.message.reply_text("Threshold must be a number of milliseconds.")
+            return
+    tracing.configure(context.args[0] == "on", threshold)
+    await update.message.reply_text(
+        f"Tracing is {context.args[0]}, slow update threshold is {threshold * 1000:.0f}ms."
+    )
+
+
+def install_diagnostic_signal_handlers():
+    """SIGUSR1 starts profiling for the default window, SIGUSR2 toggles update tracing."""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(DEFAULT_PROFILE_SECONDS))
+    signal.signal(
+        signal.SIGUSR2, lambda signum, frame: tracing.configure(not tracing.enabled, tracing.slow_update_threshold)
+    )
+
+
 async def send_not_available_spreadsheet_message(message: Message):
     await message.reply_text(
         "⛔ I cannot write into given spreadsheet.\n Please, check the url, make sure that email"
@@ -894,34 +1511,57 @@ def calculate_player_count_for_courts(court_count: int):
     return court_count * 4
 
 
-def fill_spreadsheet_blank(
+def generate_worksheet_dates(
+    day_count_for_worksheet: int,
+    group_game_day: int,
+    start_date: datetime,
+    layout: str = SHEET_LAYOUT_FULL
+) -> list:
+    """Returns the dates that get a column in the worksheet, in column order.
+
+    Args:
+        day_count_for_worksheet (int): Number of days covered by the registration period.
+        group_game_day (int): The weekday (0=Monday, 6=Sunday) when games occur.
+        start_date (datetime): The starting date of the period.
+        layout (str): SHEET_LAYOUT_FULL for every day or SHEET_LAYOUT_COMPACT for game days only.
+    """
+    dates = [start_date + timedelta(days=offset) for offset in range(day_count_for_worksheet)]
+    if layout == SHEET_LAYOUT_COMPACT:
+        return [date for date in dates if date.weekday() == group_game_day]
+    return dates
+
+
+def generate_spreadsheet_blank(
     day_count_for_worksheet: int,
     group_game_day: int,
     start_date: datetime,
     player_count: int,
-    worksheet: gspread.worksheet.Worksheet
-):
-    """Fills a Google Sheets worksheet with structured placeholders for a new registration period.
+    layout: str = SHEET_LAYOUT_FULL
+) -> list:
+    """Generates worksheet data with structured placeholders for a new registration period.
 
     Args:
         day_count_for_worksheet (int): Number of days to cover in the worksheet.
         group_game_day (int): The weekday (0=Monday, 6=Sunday) when games occur.
         start_date (datetime): The starting date for the worksheet.
         player_count (int): Number of players per game.
-        worksheet (gspread.worksheet.Worksheet): The Google Sheets worksheet object.
+        layout (str): Worksheet layout, see generate_worksheet_dates.
+
+    Returns:
+        list: 2D array with the worksheet content.
     """
     player_start_row = 4
-    next_date = start_date
+    worksheet_dates = generate_worksheet_dates(day_count_for_worksheet, group_game_day, start_date, layout)
 
     # Prepare a 2D list to hold the sheet's structure
-    max_cols = day_count_for_worksheet
+    max_cols = len(worksheet_dates)
     max_rows = player_start_row + (player_count * 2) + 3  # Ensure enough rows for main + waiting list
 
     # Initialize sheet structure with empty values
     sheet_data = [["" for _ in range(max_cols)] for _ in range(max_rows)]
 
     # Populate weekday headers (Row 1) and date headers (Row 2 with full year)
-    for col_idx in range(day_count_for_worksheet):
+    for col_idx, next_date in enumerate(worksheet_dates):
         sheet_data[0][col_idx] = weekDaysMapping[next_date.weekday()]
         sheet_data[1][col_idx] = next_date.strftime("%d.%m.%Y")  # ✅ Added full year to date row
 
@@ -940,13 +1580,60 @@ def fill_spreadsheet_blank(
             for row_offset in range(player_count, player_count * 2):
                 sheet_data[player_start_row + 2 + row_offset][col_idx] = str(row_offset + 1) + "."
 
-        next_date += timedelta(days=1)
+    return sheet_data
+
+
+def fill_worksheet_date_headers(backend: RosterBackend, location: str, worksheet_name: str, worksheet_dates: list,
+                               player_count: int):
+    """Writes weekday (Row 1) and date (Row 2) headers in a single batch update, leaving other cells untouched.
+
+    The worksheet is grown to fit the dates and the player lists first. Header cells of a wider template past the
+    last date are cleared, so their dates are not taken for columns of this period.
+    """
+    _, col_count = backend.ensure_size(
+        location, worksheet_name, calculate_spreadsheet_row_count(player_count), len(worksheet_dates)
+    )
+    padding = [""] * (col_count - len(worksheet_dates))
+    header_rows = [
+        [weekDaysMapping[date.weekday()] for date in worksheet_dates] + padding,
+        [date.strftime("%d.%m.%Y") for date in worksheet_dates] + padding,
+    ]
+    backend.batch_update(
+        location,
+        worksheet_name,
+        [{"range": f"A1:{rowcol_to_a1(2, col_count)}", "values": header_rows}]
+    )
+
 
-    # Convert to batch update format and update the worksheet in one go
-    update_range = f"A1:{chr(64 + max_cols)}{max_rows}"  # Convert column index to letter (A-Z)
-    worksheet.update(range_name=update_range, values=sheet_data)
+def create_period_worksheet(group: dict, sheet_name: str, start_date: datetime, day_count_for_worksheet: int) -> str:
+    """Creates the worksheet for a registration period of the group and returns the link to it.
 
-    logger.info(f"📊 Successfully initialized blank worksheet with {max_rows} rows and {max_cols} columns.")
+    Groups with a template worksheet get a server-side copy of it with patched date headers,
+    so the template formatting is kept. Otherwise, a blank worksheet is generated and uploaded.
+    """
+    backend = get_backend(group)
+    location = group["spreadsheet"]
+    layout = group.get("sheet_layout", SHEET_LAYOUT_FULL)
+    worksheet_dates = generate_worksheet_dates(day_count_for_worksheet, group["game_day"], start_date, layout)
+    player_count = calculate_player_count_for_courts(group["court_limit"])
+    template_name = group.get("template_worksheet")
+    if template_name:
+        worksheet_link = backend.duplicate_worksheet(location, template_name, sheet_name)
+        fill_worksheet_date_headers(backend, location, sheet_name, worksheet_dates, player_count)
+        logger.info("📊 Created worksheet '%s' from template '%s'.", sheet_name, template_name)
+        return worksheet_link
+
+    worksheet_link = backend.create_worksheet(
+        location,
+        sheet_name,
+        calculate_spreadsheet_row_count(player_count),
+        len(worksheet_dates)
+    )
+    sheet_data = generate_spreadsheet_blank(day_count_for_worksheet, group["game_day"], start_date, player_count, layout)
+    max_rows, max_cols = len(sheet_data), len(worksheet_dates)
+    backend.write_range(location, sheet_name, f"A1:{rowcol_to_a1(max_rows, max_cols)}", sheet_data)
+    logger.info("📊 Successfully initialized blank worksheet with %s rows and %s columns.", max_rows, max_cols)
+    return worksheet_link
 
 
 async def generate_join_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -967,6 +1654,15 @@ def generate_worksheet_name_from_group(group):
     return f"Americano {start_period.strftime('%d.%m')}-{end_period.strftime('%d.%m')}"
 
 
+def map_dates_to_columns(sheet_data: list) -> dict:
+    """Maps "DD.MM.YYYY" dates from the date header row (Row 2) to column indexes.
+
+    Works for both layouts since columns are looked up by their header rather than by the day offset.
+    """
+    header_row = sheet_data[1] if len(sheet_data) > 1 else []
+    return {cell.strip(): col_idx for col_idx, cell in enumerate(header_row) if cell.strip()}
+
+
 def generate_spreadsheet_cells(match_date: str, participants: list, player_count: int, existing_data: list) -> list:
     """Generates a complete spreadsheet data structure for batch updates.
 
@@ -980,11 +1676,10 @@ def generate_spreadsheet_cells(match_date: str, participants: list, player_count
         list: 2D array representing the full worksheet content.
     """
     # Step 1: Find corresponding column in the worksheet (Row 2 contains dates)
-    header_row = existing_data[1] if len(existing_data) > 1 else []  # Row 2 contains match dates
-    date_to_column = {cell.strip(): col_idx for col_idx, cell in enumerate(header_row)}
+    date_to_column = map_dates_to_columns(existing_data)
 
     if match_date not in date_to_column:
-        logger.warning(f"⚠ Match date '{match_date}' not found in the sheet. Skipping update.")
+        logger.warning("⚠ Match date '%s' not found in the sheet. Skipping update.", match_date)
         return existing_data  # Return original data unchanged
 
     game_day_column = date_to_column[match_date]
@@ -996,14 +1691,15 @@ def generate_spreadsheet_cells(match_date: str, participants: list, player_count
     main_list_start_row = 4  # "Player List" header is at row 4
     waiting_list_start_row = main_list_start_row + player_count + 2  # After main list + separator
 
-    # Ensure worksheet size is large enough
-    max_rows = max(len(sheet_data), waiting_list_start_row + player_count, len(participants) + waiting_list_start_row)
-    max_cols = max(len(sheet_data[0]), game_day_column + 1)
-
     if len(participants) < player_count * 2:
         for i in range(len(participants), player_count * 2):
             participants.append("")
 
+    # Ensure worksheet size is large enough: the waiting list ends player_count rows after its start, or later if
+    # it is longer than the main list. Rows past it would be written as blanks and could exceed the worksheet grid
+    max_rows = max(len(sheet_data), waiting_list_start_row + len(participants) - player_count)
+    max_cols = max(len(sheet_data[0]), game_day_column + 1)
+
     # Expand sheet_data to fit all updates
     while len(sheet_data) < max_rows:
         sheet_data.append([""] * max_cols)
@@ -1025,19 +1721,51 @@ def generate_spreadsheet_cells(match_date: str, participants: list, player_count
     return sheet_data
 
 
-def sync_spreadsheet():
-    now = datetime.now(timezone.utc)
+def sync_spreadsheet(group_ids: list = None, date_from: datetime = None, date_to: datetime = None,
+                     dry_run: bool = False, should_stop: Callable[[], bool] = lambda: False,
+                     lease: Lease = None, owner: str = REPLICA_ID, shard_wait: float = 0) -> SyncReport:
+    """Writes upcoming registrations to the group worksheets.
 
-    # Get all active groups with valid spreadsheet URLs
-    groups = groups_collection.find({"spreadsheet": {"$ne": None}, "deleted_at": None})
-    groups_by_id = {group["group_id"]: group for group in groups}
-
-    if not groups_by_id:
-        logger.warning("No valid groups found with active spreadsheet links.")
-        return
+    Args:
+        group_ids (list): Sync only these groups, all groups with a spreadsheet by default.
+        date_from (datetime): Sync only matches on or after this date, not earlier than today.
+        date_to (datetime): Sync only matches on or before this date.
+        dry_run (bool): Compute the changed cells without writing the worksheets and snapshots.
+        should_stop (Callable): Checked between groups, the run stops after the current group once it returns True.
+        lease (Lease): Job lease of the scheduled sync, renewed before every group. The run stops once it is lost.
+        owner (str): Owner of the group shard leases. Every group is written while holding its shard lease: the
+            worksheet write is checked against it and the snapshot is fenced with its token.
+        shard_wait (float): Seconds to wait for the shard lease of a group synced by another process.
+    """
+    report = SyncReport(dry_run)
+    now = datetime.now(timezone.utc)
 
-    # Fetch upcoming matches (not in the past)
-    upcoming_matches = matches_collection.find({"match_date": {"$gte": now}}).sort("registered_at", pymongo.ASCENDING)
+    with report.phase("load"):
+        # Get all active groups with valid spreadsheet URLs
+        group_query = {"spreadsheet": {"$ne": None}, "deleted_at": None}
+        if group_ids:
+            group_query["group_id"] = {"$in": group_ids}
+        groups_by_id = {group["group_id"]: group for group in groups_sync_collection.find(group_query)}
+
+        if not groups_by_id:
+            logger.warning("No valid groups found with active spreadsheet links.")
+            return report
+
+        # Fetch upcoming matches (not in the past)
+        match_date_query = {"$gte": max(now, date_from) if date_from else now}
+        if date_to:
+            match_date_query["$lt"] = date_to + timedelta(days=1)
+        match_query = {"match_date": match_date_query}
+        if group_ids:
+            match_query["group_id"] = {"$in": list(groups_by_id)}
+        upcoming_matches = list(matches_sync_collection.find(match_query).sort(
+            [("position", pymongo.ASCENDING), ("registered_at", pymongo.ASCENDING)]
+        ))
+        players_by_id = {
+            player["user_id"]: player for player in members_sync_collection.find(
+                {"user_id": {"$in": list({match["user_id"] for match in upcoming_matches})}}
+            )
+        }
 
     # Map matches by group ID and match date with participant details
     matches_by_group = {}
@@ -1051,31 +1779,207 @@ def sync_spreadsheet():
         if match_date not in matches_by_group[group_id]:
             matches_by_group[group_id][match_date] = []
 
-        # Get player details
-        player = members_collection.find_one({"user_id": match["user_id"]})
+        player = players_by_id.get(match["user_id"])
         if player:
             full_name = f"{player['registration_name']} {player['registration_surname']}"
             matches_by_group[group_id][match_date].append(full_name)
 
-    for group_id, matches in matches_by_group.items():
+    group_ids_to_sync = list(matches_by_group)
+    for idx, group_id in enumerate(group_ids_to_sync):
+        matches = matches_by_group[group_id]
+        if should_stop() or (lease and not lease.acquire()):
+            logger.info("Stopping the spreadsheet synchronization, the remaining groups are synced on the next run.")
+            report.interrupted = True
+            report.groups_not_attempted = group_ids_to_sync[idx:]
+            break
         group = groups_by_id.get(group_id)
         if not group:
-            logger.warning(f"Skipping group {group_id}: Not found.")
-            continue
-
-        worksheet_name = generate_worksheet_name_from_group(group)
-        if not has_worksheet_with_name(group["spreadsheet"], worksheet_name):
-            logger.warning(f"Worksheet '{worksheet_name}' not found. Skipping...")
+            logger.warning("Skipping group %s: Not found.", group_id)
+            report.groups_skipped.append(group_id)
             continue
+        shard_lease = None
+        if not dry_run:
+            shard_lease = group_sync_lease(group_id, owner)
+            if not shard_lease.acquire_within(shard_wait):
+                logger.warning("Skipping group %s: its worksheet is being synced by another process.", group_id)
+                report.groups_failed[group_id] = "The worksheet is being synced by another process"
+                continue
+        try:
+            sync_group_worksheet(group, matches, report, shard_lease)
+        except LeaseLost as error:
+            logger.warning("Stopping the spreadsheet synchronization, another process took the sync of group %s over.",
+                           group_id)
+            report.groups_failed[group_id] = f"{type(error).__name__}: {error}"
+            report.interrupted = True
+            report.groups_not_attempted = group_ids_to_sync[idx + 1:]
+            break
+        except Exception as error:
+            logger.exception("Failed to sync the worksheet of group %s", group_id)
+            report.groups_failed[group_id] = f"{type(error).__name__}: {error}"
+        finally:
+            if shard_lease:
+                shard_lease.release()
+
+    if not report.interrupted:
+        logger.info("Spreadsheet synchronization complete.")
+    return report
+
+
+def sync_group_worksheet(group: dict, matches: dict, report: SyncReport, lease: Lease = None):
+    """Applies the participants of every match date to the current period worksheet of the group.
 
-        existing_data = fetch_all_data_from_worksheet(group["spreadsheet"], worksheet_name)
+    Args:
+        group (dict): Group document.
+        matches (dict): Participant names by "DD.MM.YYYY" match date, in registration order.
+        report (SyncReport): Run statistics to update.
+        lease (Lease): Shard lease of the group, checked right before the worksheet write. The snapshot is fenced
+            with its token, so it is not written if a newer holder wrote it.
+    """
+    backend = report.track(get_backend(group))
+    worksheet_name = generate_worksheet_name_from_group(group)
+    snapshot_query = {"spreadsheet": group["spreadsheet"], "worksheet": worksheet_name}
+
+    with report.phase("read"):
+        snapshot = worksheet_snapshots_collection.find_one(snapshot_query)
+        last_update_time = backend.get_last_update_time(group["spreadsheet"])
+        if snapshot and snapshot["last_update_time"] == last_update_time:
+            # Nobody touched the spreadsheet since our last write, the shadow copy is up-to-date
+            existing_data = snapshot["data"]
+            previous_hashes = snapshot["column_hashes"]
+        else:
+            if not backend.has_worksheet(group["spreadsheet"], worksheet_name):
+                logger.warning("Worksheet '%s' not found. Skipping...", worksheet_name)
+                report.groups_skipped.append(group["group_id"])
+                return
+            logger.info("Worksheet '%s' was changed outside of the bot, reading it.", worksheet_name)
+            existing_data = backend.read_grid(group["spreadsheet"], worksheet_name)
+            previous_hashes = hash_columns(existing_data)
+
+    with report.phase("diff"):
+        cells = existing_data
+        player_count = calculate_player_count_for_courts(group["court_limit"])
         for match_date, participants in matches.items():
-            player_count = calculate_player_count_for_courts(group["court_limit"])
-            cells = generate_spreadsheet_cells(match_date, participants, player_count, existing_data)
-            update_group_worksheet(group["spreadsheet"], worksheet_name, cells)
-            logger.info(f"Updated worksheet '{worksheet_name}' with {len(cells)} cells.")
+            cells = generate_spreadsheet_cells(match_date, participants, player_count, cells)
+        changed_columns = find_changed_columns(previous_hashes, cells)
+        cells_changed = report.add_diff(group["group_id"], existing_data, cells, changed_columns)
+
+    if not report.dry_run:
+        if changed_columns:
+            with report.phase("write"):
+                if lease:
+                    # The spreadsheet can't fence writes, so a holder that stalled since the renewal stops here
+                    lease.check()
+                backend.batch_update(group["spreadsheet"], worksheet_name, build_column_ranges(cells, changed_columns))
+            logger.info("Updated %s column(s) of worksheet '%s'.", len(changed_columns), worksheet_name)
+            with report.phase("read"):
+                # An edit made right after the write would look like ours by the marker alone, so the snapshot is
+                # read back after taking the marker: it holds every change the marker covers
+                last_update_time = backend.get_last_update_time(group["spreadsheet"])
+                cells = backend.read_grid(group["spreadsheet"], worksheet_name)
+
+        with report.phase("snapshot"):
+            fencing_token = lease.check() if lease else None
+            snapshot = {
+                "data": cells,
+                "column_hashes": hash_columns(cells),
+                "last_update_time": last_update_time,
+                "synced_at": datetime.now(timezone.utc),
+            }
+            if fencing_token is not None:
+                snapshot["fencing_token"] = fencing_token
+            try:
+                worksheet_snapshots_collection.update_one(
+                    fenced(snapshot_query, fencing_token), {"$set": snapshot}, upsert=True
+                )
+            except DuplicateKeyError:
+                raise LeaseLost(f"Snapshot of worksheet '{worksheet_name}' was written by a newer lease holder")
+
+    if changed_columns:
+        report.groups_synced.append(group["group_id"])
+        report.cells_changed += cells_changed
+    else:
+        report.groups_unchanged.append(group["group_id"])
+
+
+sync_runner = SyncRunner(sync_spreadsheet)
+
+
+async def run_scheduled_sync(context: ContextTypes.DEFAULT_TYPE):
+    if not sync_lease.held:
+        logger.debug("Skipping the scheduled spreadsheet sync, another replica holds the lease")
+        return
+    application = context.application
+    # Application.stop() clears the running flag before waiting for the job, so the sync finishes the current group
+    await asyncio.to_thread(
+        sync_runner.run, sync_status_collection, TRIGGER_SCHEDULED, lambda: not application.running, lease=sync_lease
+    )
+
+
+async def renew_sync_lease(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(sync_lease.acquire)
+
+
+async def bind_update_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Binds the update fields to all log records emitted while the update is handled."""
+    command = None
+    if update.message and update.message.text and update.message.text.startswith("/"):
+        command = update.message.text.split()[0].split("@")[0]
+    elif update.callback_query:
+        command = "callback:" + str(update.callback_query.data).split(":")[0]
+    bind_update_context(
+        update.update_id,
+        update.effective_user.id if update.effective_user else None,
+        update.effective_chat.id if update.effective_chat else None,
+        command
+    )
 
-    logger.info("Spreadsheet synchronization complete.")
+
+async def skip_processed_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stops handling of updates that were already claimed by this or another instance."""
+    if not claim_update(processed_updates_collection, update.update_id):
+        logger.info("Skipping already processed update %s", update.update_id)
+        raise ApplicationHandlerStop
+
+
+async def record_update_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keeps the username directory current with the sender of every update."""
+    record_user(usernames_collection, update.effective_user)
+
+
+def warm_up_validators():
+    """Imports the registration validators and loads the phone metadata ahead of the first /join."""
+    import email_validator  # noqa: F401
+    from phonenumbers import parse, NumberParseException
+    try:
+        parse("+12025550123")
+    except NumberParseException:
+        pass
+
+
+def ensure_snapshot_indexes():
+    """Creates the index the fenced snapshot writes rely on, before the first sync of the process."""
+    # Unique, so a fenced snapshot upsert of a stale lease holder fails instead of inserting a copy
+    worksheet_snapshots_collection.create_index(
+        [("spreadsheet", pymongo.ASCENDING), ("worksheet", pymongo.ASCENDING)], unique=True
+    )
+
+
+async def on_startup(app: Application):
+    get_client()
+    ensure_indexes(matches_collection, match_counters_collection)
+    ensure_username_indexes(usernames_collection)
+    ensure_processed_update_indexes(processed_updates_collection)
+    ensure_export_indexes(members_collection)
+    ensure_membership_indexes(members_collection)
+    ensure_stats_indexes(match_cancellations_collection)
+    ensure_snapshot_indexes()
+    threading.Thread(target=warm_up_validators, name="validators-warm-up", daemon=True).start()
+
+
+async def on_stop(app: Application):
+    await registration_intake.stop()
+    # Lets another replica take the scheduled sync over right away
+    await asyncio.to_thread(sync_lease.release)
 
 
 async def get_bot_link(context: ContextTypes.DEFAULT_TYPE):
@@ -1085,11 +1989,27 @@ async def get_bot_link(context: ContextTypes.DEFAULT_TYPE):
 
 # Conversation states
 GROUP_ID, GROUP_NAME, WEEKDAY, WEEK_RANGE, SPREADSHEET_LINK, COURT_LIMIT = range(6)
+# user_data keys of the /add_group answers
+ADD_GROUP_KEYS = ("group_id", "group_name", "weekday", "week_range", "storage", "spreadsheet")
 
 
-# Main function
-def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+def build_application(token: str = TOKEN, request: BaseRequest = None,
+                      concurrent_updates: int = CONCURRENT_UPDATES) -> Application:
+    """Builds the bot application with all handlers registered.
+
+    Args:
+        token (str): Telegram bot token.
+        request (BaseRequest): Custom transport for Bot API calls, e.g. a recording fake for benchmarks.
+        concurrent_updates (int): Number of updates handled at the same time.
+    """
+    builder = ApplicationBuilder().token(token).post_init(on_startup).post_stop(on_stop)
+    if concurrent_updates > 1:
+        builder = builder.concurrent_updates(concurrent_updates)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    else:
+        builder = builder.request(InstrumentedHTTPXRequest(connection_pool_size=256))
+    app = builder.build()
 
     add_group_handler = ConversationHandler(
         entry_points=[CommandHandler('add_group', start_add_group)],
@@ -1100,8 +2020,11 @@ def main():
             WEEK_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_week_range)],
             SPREADSHEET_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_spreadsheet_link)],
             COURT_LIMIT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_court_limit)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, add_group_timed_out)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name="add_group",
+        conversation_timeout=CONVERSATION_TIMEOUT_SECONDS or None
     )
 
     app.add_handler(CommandHandler("start", start))
@@ -1111,6 +2034,11 @@ def main():
     app.add_handler(CommandHandler("list_admin_groups", list_admin_groups))
     app.add_handler(CommandHandler("delete_group", delete_group))
     app.add_handler(CommandHandler("update_sheet", update_sheet))
+    app.add_handler(CommandHandler("set_sheet_layout", set_sheet_layout))
+    app.add_handler(CommandHandler("set_template", set_template))
+    app.add_handler(CommandHandler("sync_status", sync_status))
+    app.add_handler(CommandHandler("export", export_history))
+    app.add_handler(CommandHandler("group_stats", group_stats))
     app.add_handler(ChatMemberHandler(check_admin_rights, ChatMemberHandler.MY_CHAT_MEMBER))
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
     app.add_handler(CommandHandler("invite", invite_members))
@@ -1118,17 +2046,21 @@ def main():
 
     # Member handlers:
     join_handler = ConversationHandler(
-        entry_points=[CommandHandler('join', start_join), CallbackQueryHandler(start_join)],
+        entry_points=[CommandHandler('join', start_join), CallbackQueryHandler(start_join, pattern="^start_join$")],
         states={
             NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
             SURNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_surname)],
             PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_phone)],
             EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_email)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, join_timed_out)],
         },
-        fallbacks=[CommandHandler('cancel', cancel_join)]
+        fallbacks=[CommandHandler('cancel', cancel_join)],
+        name="join",
+        conversation_timeout=CONVERSATION_TIMEOUT_SECONDS or None
     )
 
     app.add_handler(CommandHandler('register_game', register_game))
+    app.add_handler(CallbackQueryHandler(register_from_picker, pattern=f"^{DATE_PICKER_PREFIX}:"))
     app.add_handler(CommandHandler('cancel_game', cancel_game))
     app.add_handler(CommandHandler('replace_player', replace_player))
     app.add_handler(CommandHandler('list_matches', list_matches))
@@ -1138,24 +2070,122 @@ def main():
     app.add_error_handler(error_handler)
     app.add_handler(CommandHandler('help', help_message))
 
+    # Operator diagnostics
+    app.add_handler(CommandHandler('profile', profile_command))
+    app.add_handler(CommandHandler('trace', trace_command))
+
     # Easter egg
     app.add_handler(CommandHandler('get_1_million_dollars', issue_1_million_dollars))
 
+    if SYNC_INTERVAL_SECONDS > 0:
+        app.job_queue.run_repeating(
+            renew_sync_lease, LEASE_TTL_SECONDS / 3, first=0, name="renew_sync_lease",
+            job_kwargs={"max_instances": 1, "coalesce": True}
+        )
+        app.job_queue.run_repeating(
+            run_scheduled_sync, SYNC_INTERVAL_SECONDS, first=SYNC_FIRST_RUN_DELAY_SECONDS, name=SYNC_JOB_NAME,
+            # A run still going when the next is due is skipped by the runner, which records it for /sync_status
+            job_kwargs={"jitter": SYNC_JITTER_SECONDS, "max_instances": 2, "coalesce": True}
+        )
+
+    instrument_application(app)
+    # Registered after instrumentation, it is not a handler worth timing
+    app.add_handler(TypeHandler(Update, bind_update_log_context), group=-100)
+    app.add_handler(TypeHandler(Update, skip_processed_update), group=-99)
+    app.add_handler(TypeHandler(Update, record_update_username), group=-98)
+    UserStateLimiter(USER_STATE_CACHE_SIZE).attach(app, first_group=-97, last_group=100)
+    watch_conversations([add_group_handler, join_handler])
+    return app
+
+
+# Main function
+def main():
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT), METRICS_HOST)
+    install_diagnostic_signal_handlers()
+    app = build_application()
     app.run_polling()
 
 
+def parse_cli_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%d.%m.%Y").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{value}', use DD.MM.YYYY")
+
+
+def print_sync_report(report: SyncReport, as_json: bool):
+    if as_json:
+        print(json.dumps(report.to_dict(include_diffs=report.dry_run), indent=2, ensure_ascii=False, default=str))
+        return
+    stats = report.to_dict()
+    if report.dry_run:
+        for group_id, changes in report.diffs.items():
+            print(f"Group {group_id}:")
+            for change in changes:
+                print(f"  {change['cell']}: {change['old']!r} -> {change['new']!r}")
+    print(f"Synced: {len(report.groups_synced)}, unchanged: {len(report.groups_unchanged)}, "
+          f"skipped: {len(report.groups_skipped)}, failed: {len(report.groups_failed)}, "
+          f"cells changed: {report.cells_changed}")
+    for group_id, error in report.groups_failed.items():
+        print(f"  {group_id} failed: {error}")
+    if report.interrupted:
+        print("Interrupted, not attempted: " + (", ".join(report.groups_not_attempted) or "none"))
+    print("API calls: " + (", ".join(f"{method}={count}" for method, count in stats["api_calls"].items()) or "none"))
+    print("Duration: " + ", ".join(f"{phase}={duration}s" for phase, duration in stats["duration_s"].items()))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Padel Bot CLI")
     parser.add_argument(
         "command",
         nargs="?",
-        choices=["sync_spreadsheet"],
-        help="Run the bot normally or sync the spreadsheet"
+        choices=["sync_spreadsheet", "backfill_match_positions", "migrate_memberships", "rebuild_group_stats"],
+        help="Run the bot normally, sync the spreadsheet, number registrations made before positions were kept, "
+             + "copy member_groups into the member documents or recompute group statistics from history"
     )
+    parser.add_argument("--group", action="append", dest="group_ids", metavar="GROUP_ID",
+                        help="sync_spreadsheet, rebuild_group_stats: only this group, can be repeated")
+    parser.add_argument("--from", dest="date_from", type=parse_cli_date, metavar="DD.MM.YYYY",
+                        help="sync_spreadsheet: sync only matches on or after the date")
+    parser.add_argument("--to", dest="date_to", type=parse_cli_date, metavar="DD.MM.YYYY",
+                        help="sync_spreadsheet: sync only matches on or before the date")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="sync_spreadsheet: print the cells that would change without writing them")
+    parser.add_argument("--json", action="store_true", help="sync_spreadsheet: print the run statistics as JSON")
 
     args = parser.parse_args()
 
     if args.command == "sync_spreadsheet":
-        sync_spreadsheet()
+        if args.dry_run:
+            sync_report = sync_spreadsheet(args.group_ids, args.date_from, args.date_to, dry_run=True)
+        else:
+            # The CLI runs next to the bot replicas: it takes the shard lease of every group it writes, and waits
+            # out a scheduled sync of the same group, which holds it for a single worksheet
+            ensure_snapshot_indexes()
+            cli_options = {"owner": "cli:" + generate_owner_id(), "shard_wait": LEASE_TTL_SECONDS}
+            if args.group_ids or args.date_from or args.date_to:
+                # Partial runs do not replace the last full run shown by /sync_status
+                sync_report = sync_spreadsheet(args.group_ids, args.date_from, args.date_to, **cli_options)
+            else:
+                sync_report = sync_runner.run(sync_status_collection, TRIGGER_CLI, **cli_options)
+            if sync_report is None:
+                sys.exit(1)
+        print_sync_report(sync_report, args.json)
+        sys.exit(sync_report.exit_code)
+    elif args.command == "backfill_match_positions":
+        logger.info("Renumbered registrations of %s match(es).",
+                    backfill_positions(matches_collection, match_counters_collection))
+    elif args.command == "rebuild_group_stats":
+        rebuilt, differing = rebuild_stats(
+            group_stats_collection, matches_collection, match_cancellations_collection, args.group_ids
+        )
+        logger.info("Rebuilt statistics of %s group(s), %s differed from the history: %s",
+                    rebuilt, len(differing), ", ".join(differing) or "none")
+        sys.exit(1 if differing else 0)
+    elif args.command == "migrate_memberships":
+        ensure_membership_indexes(members_collection)
+        logger.info("Embedded %s membership(s) into member documents.",
+                    migrate_member_groups(member_group_collection, members_collection))
     else:
         main()
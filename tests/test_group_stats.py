@@ -0,0 +1,80 @@
+"""Group statistics kept incrementally and shown by /group_stats."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from telegram import Update
+
+import main
+from bench.fakes import FakeTelegramRequest, install_backend, install_database
+from bench.handlers import ADMIN_ID, FIRST_PLAYER_ID, GROUP_CHAT_ID, UpdateFactory, next_game_date, seed_group
+from bot.dedup import forget_claims
+from bot.group_stats import build_stats, rebuild_stats, record_registrations, same_counters
+from bot.intake import forget_group
+
+
+@pytest.mark.asyncio
+async def test_most_active_players_count_only_matches_played():
+    db, _ = install_database()
+    install_backend()
+    forget_claims()
+    now = datetime.now(timezone.utc)
+    group = seed_group(db, courts=1, players=2, now=now)
+    registrations = [(FIRST_PLAYER_ID, now - timedelta(days=7)), (FIRST_PLAYER_ID, now + timedelta(days=7)),
+                     (FIRST_PLAYER_ID + 1, now + timedelta(days=7))]
+    for user_id, match_date in registrations:
+        db.matches.insert_one({"user_id": user_id, "group_id": group["group_id"], "match_date": match_date})
+    record_registrations(db.group_stats, group["group_id"], registrations)
+    request = FakeTelegramRequest()
+    app = main.build_application("123456:TEST", request, concurrent_updates=1)
+
+    async with app:
+        raw_update = UpdateFactory().private_command(f"/group_stats {group['group_id']}", ADMIN_ID)
+        await app.process_update(Update.de_json(raw_update, app.bot))
+
+    message = request.sent_texts()[-1]
+    assert "Replacements: 0" in message
+    assert f"1. Name{FIRST_PLAYER_ID} Bench - 1 match(es) played" in message
+    # Registered for an upcoming match only
+    assert f"Name{FIRST_PLAYER_ID + 1}" not in message
+
+
+@pytest.mark.asyncio
+async def test_rebuild_matches_the_counters_kept_by_the_handlers():
+    db, _ = install_database()
+    install_backend()
+    forget_claims()
+    main.registration_intake.enabled = False
+    now = datetime.now(timezone.utc)
+    group = seed_group(db, courts=1, players=5, now=now)
+    match_date = next_game_date(group["game_day"], now)
+    db.groups.update_one({"group_id": group["group_id"]}, {"$set": {"registration_open_till": match_date}})
+    forget_group(group["group_id"])
+    date_arg = match_date.strftime("%d.%m.%Y")
+    factory = UpdateFactory()
+    updates = [factory.command(f"/register_game {date_arg}", user_id, GROUP_CHAT_ID)
+               for user_id in range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + 4)]
+    updates.append(factory.command(f"/cancel_game {date_arg}", FIRST_PLAYER_ID + 1, GROUP_CHAT_ID))
+    updates.append(factory.command(
+        f"/replace_player {group['group_id']} @user{FIRST_PLAYER_ID + 4} {date_arg}", FIRST_PLAYER_ID + 2, GROUP_CHAT_ID
+    ))
+    app = main.build_application("123456:TEST", FakeTelegramRequest(), concurrent_updates=1)
+
+    async with app:
+        for raw_update in updates:
+            await app.process_update(Update.de_json(raw_update, app.bot))
+
+    kept = db.group_stats.find_one({"_id": group["group_id"]})
+    assert (kept["registrations"], kept["cancellations"], kept["replacements"]) == (5, 1, 1)
+    assert kept["players"][str(FIRST_PLAYER_ID + 2)] == {"registrations": 1, "replaced": 1}
+    assert same_counters(kept, build_stats(db.matches, db.match_cancellations, group["group_id"]))
+
+    rebuilt, differing = rebuild_stats(db.group_stats, db.matches, db.match_cancellations)
+
+    assert (rebuilt, differing) == (1, [])
+    assert same_counters(db.group_stats.find_one({"_id": group["group_id"]}), kept)
+
+    # A counter that drifted from the history is reported and corrected
+    db.group_stats.update_one({"_id": group["group_id"]}, {"$inc": {"cancellations": 1}})
+    rebuilt, differing = rebuild_stats(db.group_stats, db.matches, db.match_cancellations, [group["group_id"]])
+    assert (rebuilt, differing) == (1, [group["group_id"]])
+    assert db.group_stats.find_one({"_id": group["group_id"]})["cancellations"] == 1
@@ -0,0 +1,122 @@
+"""Batched registrations answer every player with the outcome of their own row."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+import main
+from bench.fakes import install_backend, install_database
+from bench.handlers import FIRST_PLAYER_ID, next_game_date, seed_group
+from bot.intake import RegistrationIntake, RegistrationRequest, forget_group
+from bot.waitlist import ensure_indexes
+
+
+@pytest.fixture
+def group():
+    raw_db, _ = install_database()
+    install_backend()
+    now = datetime.now(timezone.utc)
+    group = seed_group(raw_db, courts=1, players=3, now=now)
+    forget_group(group["group_id"])
+    ensure_indexes(raw_db.matches, raw_db.match_counters)
+    return group
+
+
+async def store(requests: list) -> dict:
+    """Runs the requests through an intake and returns the outcome told to every player."""
+    outcomes = {}
+
+    async def confirm(request):
+        outcomes[request.user_id] = request.position
+
+    async def fail(request):
+        outcomes[request.user_id] = "failed"
+
+    async def acknowledge():
+        return None
+
+    intake = RegistrationIntake(main.write_registration_batch, confirm, fail, batch_size=len(requests), enabled=True)
+    for request in requests:
+        intake.submit(request, acknowledge)
+    await intake.stop()
+    return outcomes
+
+
+@pytest.mark.asyncio
+async def test_rows_failing_in_a_batch_are_rejected_and_their_places_given_back(group, monkeypatch):
+    match_date = next_game_date(group["game_day"], datetime.now(timezone.utc))
+    bulk_write = main.matches_collection.bulk_write
+
+    def fail_second_row(operations, ordered):
+        bulk_write([operation for idx, operation in enumerate(operations) if idx != 1], ordered=ordered)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 121, "errmsg": "Document failed validation"}]})
+
+    monkeypatch.setattr(main.matches_collection, "bulk_write", fail_second_row)
+    user_ids = range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + 3)
+    requests = [RegistrationRequest(user_id, group, match_date) for user_id in user_ids]
+
+    outcomes = await store(requests)
+
+    assert outcomes == {FIRST_PLAYER_ID: 1, FIRST_PLAYER_ID + 1: "failed", FIRST_PLAYER_ID + 2: 2}
+    counter = main.match_counters_collection.find_one({"group_id": group["group_id"], "match_date": match_date})
+    assert counter["last_position"] - counter["removed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_stored_batch_is_confirmed_when_statistics_fail(group, monkeypatch):
+    match_date = next_game_date(group["game_day"], datetime.now(timezone.utc))
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError("statistics are unavailable")
+
+    monkeypatch.setattr(main, "record_registrations", unavailable)
+    user_ids = range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + 2)
+    requests = [RegistrationRequest(user_id, group, match_date) for user_id in user_ids]
+
+    outcomes = await store(requests)
+
+    assert outcomes == {FIRST_PLAYER_ID: 1, FIRST_PLAYER_ID + 1: 2}
+
+
+@pytest.mark.asyncio
+async def test_positions_reserved_before_a_failed_lookup_are_given_back(group, monkeypatch):
+    first_date = next_game_date(group["game_day"], datetime.now(timezone.utc))
+    second_date = first_date + timedelta(days=7)
+    find = main.matches_collection.find
+    lookups = iter([find, None])
+
+    def fail_second_lookup(*args, **kwargs):
+        lookup = next(lookups)
+        if lookup is None:
+            raise ConnectionFailure("primary stepped down")
+        return lookup(*args, **kwargs)
+
+    monkeypatch.setattr(main.matches_collection, "find", fail_second_lookup)
+    requests = [RegistrationRequest(FIRST_PLAYER_ID, group, first_date),
+                RegistrationRequest(FIRST_PLAYER_ID + 1, group, second_date)]
+
+    outcomes = await store(requests)
+
+    assert outcomes == {FIRST_PLAYER_ID: "failed", FIRST_PLAYER_ID + 1: "failed"}
+    counter = main.match_counters_collection.find_one({"group_id": group["group_id"], "match_date": first_date})
+    assert counter["last_position"] - counter["removed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rows_stored_before_a_failed_write_are_confirmed(group, monkeypatch):
+    match_date = next_game_date(group["game_day"], datetime.now(timezone.utc))
+    bulk_write = main.matches_collection.bulk_write
+
+    def store_first_row_only(operations, ordered):
+        bulk_write(operations[:1], ordered=ordered)
+        raise ConnectionFailure("connection reset")
+
+    monkeypatch.setattr(main.matches_collection, "bulk_write", store_first_row_only)
+    user_ids = range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + 2)
+    requests = [RegistrationRequest(user_id, group, match_date) for user_id in user_ids]
+
+    outcomes = await store(requests)
+
+    assert outcomes == {FIRST_PLAYER_ID: 1, FIRST_PLAYER_ID + 1: "failed"}
+    counter = main.match_counters_collection.find_one({"group_id": group["group_id"], "match_date": match_date})
+    assert counter["last_position"] - counter["removed"] == 1
@@ -0,0 +1,51 @@
+"""Memberships embedded in member documents and their migration from member_groups."""
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+
+from bench.fakes import install_database
+from bot.membership import find_active_groups, migrate_member_groups
+
+JOINED_AT = datetime(2024, 3, 1, tzinfo=timezone.utc)
+BLOCKED_TILL = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def db():
+    db, _ = install_database()
+    for group_id in ("-1", "-2", "-3"):
+        db.groups.insert_one({"group_id": group_id, "name": f"Group {group_id}", "deleted_at": None})
+    db.members.insert_one({"user_id": 1, "registration_name": "Ann", "groups": []})
+    db.members.insert_one({"user_id": 2, "registration_name": "Bob"})
+    db.member_groups.insert_many([
+        {"user_id": 1, "group_id": -1, "status": "active", "joined_at": JOINED_AT},
+        {"user_id": 1, "group_id": "-2", "status": "blocked", "blocked_till": BLOCKED_TILL, "joined_at": JOINED_AT},
+        # Made before joined_at was kept, the time of the document's creation is used
+        {"_id": ObjectId.from_datetime(JOINED_AT), "user_id": 2, "group_id": "-3", "status": "active"},
+    ])
+    return db
+
+
+def test_migration_carries_memberships_over_once(db):
+    assert migrate_member_groups(db.member_groups, db.members) == 3
+    migrated = {member["user_id"]: member["groups"] for member in db.members.find()}
+
+    assert migrate_member_groups(db.member_groups, db.members) == 0
+    assert {member["user_id"]: member["groups"] for member in db.members.find()} == migrated
+
+    ann = {membership["group_id"]: membership for membership in migrated[1]}
+    assert ann["-1"]["status"] == "active" and ann["-1"]["blocked_till"] is None
+    assert ann["-2"]["status"] == "blocked"
+    assert ann["-2"]["blocked_till"].replace(tzinfo=timezone.utc) == BLOCKED_TILL
+    assert migrated[2][0]["joined_at"].replace(tzinfo=timezone.utc) == JOINED_AT
+
+
+def test_active_groups_leave_blocked_and_deleted_groups_out(db):
+    migrate_member_groups(db.member_groups, db.members)
+    db.members.update_one({"user_id": 1}, {"$push": {"groups": {"group_id": "-3", "status": "active"}}})
+    db.groups.update_one({"group_id": "-3"}, {"$set": {"deleted_at": JOINED_AT}})
+
+    assert [group["group_id"] for group in find_active_groups(db.members, 1)] == ["-1", "-3"]
+    assert [group["group_id"] for group in find_active_groups(db.members, 1, {"deleted_at": None})] == ["-1"]
+    assert find_active_groups(db.members, 1, {"group_id": "-2"}) == []
@@ -0,0 +1,68 @@
+"""Registrations stay unique when an update is delivered twice or a player registers twice at once."""
+from datetime import datetime, timezone
+
+import pytest
+from telegram import Update
+
+import main
+from bench.fakes import FakeTelegramRequest, install_backend, install_database
+from bench.handlers import FIRST_PLAYER_ID, GROUP_CHAT_ID, UpdateFactory, next_game_date, seed_group
+from bot.dedup import forget_claims
+from bot.intake import RegistrationRequest, forget_group
+from bot.waitlist import ensure_indexes
+
+
+@pytest.fixture
+def db():
+    raw_db, _ = install_database()
+    install_backend()
+    main.registration_intake.enabled = False
+    forget_claims()
+    now = datetime.now(timezone.utc)
+    group = seed_group(raw_db, courts=1, players=2, now=now)
+    # Registration is open for the next game date
+    raw_db.groups.update_one({"group_id": group["group_id"]},
+                             {"$set": {"registration_open_till": next_game_date(group["game_day"], now)}})
+    forget_group(group["group_id"])
+    ensure_indexes(raw_db.matches, raw_db.match_counters)
+    return raw_db
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("restarted", [False, True], ids=["same-instance", "after-restart"])
+async def test_redelivered_registration_is_handled_once(db, restarted):
+    group = db.groups.find_one()
+    match_date = next_game_date(group["game_day"], datetime.now(timezone.utc))
+    raw_update = UpdateFactory().command(f"/register_game {match_date:%d.%m.%Y}", FIRST_PLAYER_ID, GROUP_CHAT_ID)
+    request = FakeTelegramRequest()
+    app = main.build_application("123456:TEST", request, concurrent_updates=1)
+
+    async with app:
+        await app.start()
+        request.calls.clear()
+        await app.process_update(Update.de_json(raw_update, app.bot))
+        if restarted:
+            # Another instance only shares the claims stored in MongoDB
+            forget_claims()
+        await app.process_update(Update.de_json(raw_update, app.bot))
+        await app.stop()
+
+    assert db.matches.count_documents({"user_id": FIRST_PLAYER_ID}) == 1
+    assert db.group_stats.find_one({"_id": group["group_id"]})["registrations"] == 1
+    assert request.calls.get("sendMessage") == 1
+
+
+def test_batch_skips_registration_stored_concurrently(db):
+    group = db.groups.find_one()
+    match_date = next_game_date(group["game_day"], datetime.now(timezone.utc))
+    # Two requests of the same player pass the lookup, the unique index rejects the second one
+    requests = [RegistrationRequest(FIRST_PLAYER_ID, group, match_date),
+                RegistrationRequest(FIRST_PLAYER_ID, group, match_date),
+                RegistrationRequest(FIRST_PLAYER_ID + 1, group, match_date)]
+
+    main.write_registration_batch(requests)
+
+    assert [request.position for request in requests] == [1, None, 2]
+    assert db.matches.count_documents({}) == 2
+    counter = db.match_counters.find_one({"group_id": group["group_id"], "match_date": match_date})
+    assert counter["last_position"] - counter["removed"] == 2
@@ -0,0 +1,79 @@
+"""The spreadsheet sync writes a worksheet only while it holds the group's shard lease."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import main
+from bench.fakes import install_backend, install_database
+from bench.sync import seed
+from bot.lease import Lease
+
+
+@pytest.fixture
+def synced():
+    db, _ = install_database()
+    backend = install_backend()
+    groups = seed(db, backend, group_count=1, date_count=2, player_count=4)
+    return db, backend, groups[0]["group_id"]
+
+
+def test_sync_stalled_after_taking_the_shard_lease_does_not_write_the_worksheet(synced, monkeypatch):
+    db, backend, group_id = synced
+    now = [datetime.now(timezone.utc)]
+    monkeypatch.setattr(main, "group_sync_lease", lambda group_id, owner: Lease(
+        db.leases, f"{main.SYNC_LEASE_NAME}:{group_id}", owner, ttl=15, clock=lambda: now[0]
+    ))
+    get_last_update_time = backend.get_last_update_time
+
+    def stall(spreadsheet):
+        # A pause longer than the TTL between taking the lease and the write, another process may hold it now
+        now[0] += timedelta(seconds=30)
+        return get_last_update_time(spreadsheet)
+
+    backend.get_last_update_time = stall
+
+    report = main.sync_spreadsheet()
+
+    assert report.interrupted
+    assert report.exit_code == 1
+    assert list(report.groups_failed) == [group_id]
+    assert backend.calls["batch_update"] == 0
+    assert db.worksheet_snapshots.count_documents({}) == 0
+
+
+def test_targeted_sync_runs_while_a_replica_leads_the_scheduled_sync(synced):
+    db, backend, group_id = synced
+    leader = Lease(db.leases, main.SYNC_LEASE_NAME, "replica-1", ttl=15)
+    assert leader.acquire()
+
+    report = main.sync_spreadsheet([group_id], owner="cli:test")
+
+    assert report.groups_synced == [group_id]
+    assert report.exit_code == 0
+    # The shard lease is given back once the group is written
+    assert main.group_sync_lease(group_id, "replica-1").acquire()
+
+
+def test_group_synced_by_another_process_is_reported_failed(synced):
+    db, backend, group_id = synced
+    assert main.group_sync_lease(group_id, "replica-1").acquire()
+
+    report = main.sync_spreadsheet([group_id], owner="cli:test")
+
+    assert list(report.groups_failed) == [group_id]
+    assert report.exit_code == 1
+    assert backend.calls["batch_update"] == 0
+
+
+def test_sync_stopped_before_the_last_group_lists_the_groups_left(monkeypatch):
+    db, _ = install_database()
+    backend = install_backend()
+    group_ids = [group["group_id"] for group in seed(db, backend, group_count=3, date_count=2, player_count=4)]
+    checks = iter([False, True, True])
+
+    report = main.sync_spreadsheet(should_stop=lambda: next(checks))
+
+    assert report.interrupted
+    assert report.exit_code == 1
+    assert len(report.groups_synced) == 1
+    assert sorted(report.groups_synced + report.groups_not_attempted) == sorted(group_ids)
@@ -0,0 +1,42 @@
+"""Live conversations are counted from the flow callbacks, through cancellation and timeout."""
+import asyncio
+
+import pytest
+from telegram import Update
+
+import main
+from bench.fakes import FakeTelegramRequest, install_backend, install_database
+from bench.handlers import GROUP_CHAT_ID, UpdateFactory
+from bot.dedup import forget_claims
+from bot.metrics import LIVE_CONVERSATIONS
+
+NEW_USER_ID = 42
+
+
+@pytest.mark.asyncio
+async def test_live_join_conversations_end_on_cancel_and_timeout(monkeypatch):
+    install_database()
+    install_backend()
+    forget_claims()
+    monkeypatch.setattr(main, "CONVERSATION_TIMEOUT_SECONDS", 0.2)
+    factory = UpdateFactory()
+    request = FakeTelegramRequest()
+    app = main.build_application("123456:TEST", request, concurrent_updates=1)
+
+    async def send(text: str):
+        await app.process_update(Update.de_json(factory.private_command(text, NEW_USER_ID), app.bot))
+
+    async with app:
+        await app.start()
+        await send(f"/join {GROUP_CHAT_ID}")
+        assert LIVE_CONVERSATIONS.get("join") == 1
+        await send("/cancel")
+        assert LIVE_CONVERSATIONS.get("join") == 0
+
+        await send(f"/join {GROUP_CHAT_ID}")
+        await send("Player")
+        assert LIVE_CONVERSATIONS.get("join") == 1
+        await asyncio.sleep(0.5)
+        assert LIVE_CONVERSATIONS.get("join") == 0
+        assert "timed out" in request.sent_texts()[-1]
+        await app.stop()
@@ -0,0 +1,49 @@
+"""Positions and ranks of registrations through cancellations."""
+from datetime import datetime
+
+import mongomock
+import pytest
+
+from bot.waitlist import ALREADY_REMOVED, ensure_indexes, find_counters, get_rank, remove_registration, \
+    reserve_position
+
+GROUP_ID = "-1000"
+MATCH_DATE = datetime(2030, 1, 7)
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient()["padel_bot"]
+    ensure_indexes(db.matches, db.match_counters)
+    return db
+
+
+def register(db, user_id: int) -> dict:
+    position, _ = reserve_position(db.match_counters, GROUP_ID, MATCH_DATE)
+    match = {"user_id": user_id, "group_id": GROUP_ID, "match_date": MATCH_DATE, "position": position}
+    db.matches.insert_one(match)
+    return match
+
+
+def test_concurrent_cancellations_remove_the_registration_once(db):
+    matches = [register(db, user_id) for user_id in range(1, 4)]
+
+    assert remove_registration(db.matches, db.match_counters, matches[0], slot_count=2) == matches[2]
+    # The second /cancel_game read the registration before the first one deleted it
+    assert remove_registration(db.matches, db.match_counters, matches[0], slot_count=2) is ALREADY_REMOVED
+
+    assert db.match_counters.find_one()["removed"] == 1
+    _, rank = reserve_position(db.match_counters, GROUP_ID, MATCH_DATE)
+    assert rank == 3
+
+
+def test_ranks_close_the_gaps_of_cancellations(db):
+    matches = [register(db, user_id) for user_id in range(1, 6)]
+    for match in (matches[3], matches[1]):
+        remove_registration(db.matches, db.match_counters, match, slot_count=2)
+    late = register(db, 6)
+
+    counter = find_counters(db.match_counters, [late])[(GROUP_ID, MATCH_DATE)]
+    ranks = [get_rank(counter, match["position"]) for match in (matches[0], matches[2], matches[4], late)]
+    assert ranks == [1, 2, 3, 4]
+    assert counter["removed_positions"] == [2, 4]
@@ -0,0 +1,33 @@
+"""Period worksheets created from a group's template."""
+from datetime import datetime, timedelta
+
+import main
+from bench.fakes import install_backend
+
+TEMPLATE = "Template"
+
+
+def test_worksheet_from_a_wider_shorter_template_fits_the_period_and_roster():
+    backend = install_backend()
+    start_date = datetime(2030, 1, 7)
+    # A 31-day template two rows high, with dates of an older period in its header
+    old_dates = [start_date - timedelta(days=60) + timedelta(days=offset) for offset in range(31)]
+    backend.create_worksheet("sheet", TEMPLATE, 2, 31)
+    backend.write_range("sheet", TEMPLATE, "A1:AE2", [
+        ["Header"] * 31, [date.strftime("%d.%m.%Y") for date in old_dates]
+    ])
+    group = {"spreadsheet": "sheet", "storage": "memory", "game_day": 0, "court_limit": 3,
+             "template_worksheet": TEMPLATE, "sheet_layout": main.SHEET_LAYOUT_COMPACT}
+
+    main.create_period_worksheet(group, "Period", start_date, 28)
+
+    grid = backend.read_grid("sheet", "Period")
+    period_dates = main.generate_worksheet_dates(28, 0, start_date, main.SHEET_LAYOUT_COMPACT)
+    assert list(main.map_dates_to_columns(grid)) == [date.strftime("%d.%m.%Y") for date in period_dates]
+    row_count, _ = backend.ensure_size("sheet", "Period", 0, 0)
+    assert row_count >= main.calculate_spreadsheet_row_count(main.calculate_player_count_for_courts(3))
+
+    # The sync writes the whole waiting list without growing the worksheet
+    participants = [f"Player {idx}" for idx in range(24)]
+    cells = main.generate_spreadsheet_cells(period_dates[0].strftime("%d.%m.%Y"), participants, 12, grid)
+    assert len(cells) <= row_count